@@ -0,0 +1,291 @@
+"""Generation overhead benchmarks against the in-process `exfer.testing.MockServer`.
+
+Measures exfer's own cost on the hot path: requests per second, time-to-first-token and inter-fragment
+latency for `generate_text` in sync, streaming, threaded and asyncio modes, the memory held per open
+stream, and image-encoding throughput. Leave the mock server's `--latency` and `--token-rate` unset to
+measure pure overhead, or set them to model a real backend.
+
+    python benchmarks/bench_generate.py
+    python benchmarks/bench_generate.py --provider lmstudio --tokens 64 --token-rate 200 --concurrency 16
+    python benchmarks/bench_generate.py --json results.json
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exfer import LMStudio, Ollama, Provider, Transport
+from exfer.testing import MockServer
+from exfer.utils.images import encode_images, encoded_image_cache
+
+PROVIDERS: dict[str, type[Provider]] = {"ollama": Ollama, "lmstudio": LMStudio}
+
+
+def summarize(values: list[float]) -> dict:
+    """Median, 95th percentile and mean of the values, in milliseconds."""
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "mean_ms": None}
+    ordered = sorted(values)
+    return {
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+def timed_stream(provider: Provider, prompt: str) -> tuple[float, list[float], int]:
+    """Consumes a stream, returning the time to first fragment, the gaps between fragments, and the fragment count."""
+    start = time.perf_counter()
+    first: Optional[float] = None
+    gaps: list[float] = []
+    previous = start
+    count = 0
+    for _ in provider.generate_text("mock", prompt, stream=True):
+        now = time.perf_counter()
+        if first is None:
+            first = now - start
+        else:
+            gaps.append(now - previous)
+        previous = now
+        count += 1
+    return first or 0.0, gaps, count
+
+
+def bench_sync(provider: Provider, requests: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        began = time.perf_counter()
+        provider.generate_text("mock", f"prompt {i}")
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    return {"requests_per_sec": requests / elapsed, "latency": summarize(latencies)}
+
+
+def bench_stream(provider: Provider, requests: int) -> dict:
+    firsts: list[float] = []
+    gaps: list[float] = []
+    fragments = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        first, stream_gaps, count = timed_stream(provider, f"prompt {i}")
+        firsts.append(first)
+        gaps.extend(stream_gaps)
+        fragments += count
+    elapsed = time.perf_counter() - start
+    return {
+        "requests_per_sec": requests / elapsed,
+        "fragments_per_sec": fragments / elapsed,
+        "time_to_first_token": summarize(firsts),
+        "inter_fragment": summarize(gaps),
+    }
+
+
+def bench_concurrent(provider: Provider, requests: int, concurrency: int) -> dict:
+    def run(fn: Callable[[int], object]) -> float:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            list(executor.map(fn, range(requests)))
+            return time.perf_counter() - start
+
+    sync_elapsed = run(lambda i: provider.generate_text("mock", f"prompt {i}"))
+    results: list[tuple[float, list[float], int]] = []
+    stream_elapsed = run(
+        lambda i: results.append(timed_stream(provider, f"prompt {i}"))
+    )
+    return {
+        "concurrency": concurrency,
+        "sync_requests_per_sec": requests / sync_elapsed,
+        "stream_requests_per_sec": requests / stream_elapsed,
+        "time_to_first_token": summarize([first for first, _, _ in results]),
+        "inter_fragment": summarize([gap for _, gaps, _ in results for gap in gaps]),
+    }
+
+
+def bench_async(provider: Provider, requests: int, concurrency: int) -> dict:
+    async def consume(i: int, limit: asyncio.Semaphore, firsts: list[float]) -> None:
+        async with limit:
+            start = time.perf_counter()
+            first = None
+            async for _ in provider.agenerate_text("mock", f"prompt {i}", stream=True):
+                if first is None:
+                    first = time.perf_counter() - start
+            firsts.append(first or 0.0)
+
+    async def generate(i: int, limit: asyncio.Semaphore) -> None:
+        async with limit:
+            await provider.agenerate_text("mock", f"prompt {i}")
+
+    async def main() -> tuple[float, float, list[float]]:
+        limit = asyncio.Semaphore(concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(generate(i, limit) for i in range(requests)))
+        sync_elapsed = time.perf_counter() - start
+
+        firsts: list[float] = []
+        start = time.perf_counter()
+        await asyncio.gather(*(consume(i, limit, firsts) for i in range(requests)))
+        stream_elapsed = time.perf_counter() - start
+        await provider.aclose()
+        return sync_elapsed, stream_elapsed, firsts
+
+    sync_elapsed, stream_elapsed, firsts = asyncio.run(main())
+    return {
+        "concurrency": concurrency,
+        "requests_per_sec": requests / sync_elapsed,
+        "stream_requests_per_sec": requests / stream_elapsed,
+        "time_to_first_token": summarize(firsts),
+    }
+
+
+def bench_memory(provider: Provider, streams: int) -> dict:
+    """Opens many streams at once, each past its first fragment, and measures the memory they hold."""
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    opened = []
+    for i in range(streams):
+        stream = provider.generate_text("mock", f"prompt {i}", stream=True)
+        next(stream)
+        opened.append(stream)
+    gc.collect()
+    held = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in held.compare_to(baseline, "filename"))
+    for stream in opened:
+        stream.close()
+    return {"streams": streams, "bytes_per_stream": total / streams}
+
+
+def bench_images(count: int, size: int) -> dict:
+    """Encoding throughput for passthrough, converted and downscaled images, without the encoded image cache."""
+    from PIL import Image
+
+    base = Image.effect_noise((size, size), 64).convert("RGB")
+
+    # Every image differs by a pixel, so that none are served from the content cache.
+    def variants(img_format: str) -> list[bytes]:
+        images = []
+        for i in range(count):
+            img = base.copy()
+            img.putpixel((0, 0), (i % 256, i // 256 % 256, 0))
+            buffer = io.BytesIO()
+            img.save(buffer, format=img_format)
+            images.append(buffer.getvalue())
+        return images
+
+    cases = {
+        "png_passthrough": (variants("PNG"), None),
+        "bmp_to_png": (variants("BMP"), None),
+        "png_downscale": (variants("PNG"), size // 2),
+    }
+    results = {}
+    for name, (images, max_size) in cases.items():
+        encoded_image_cache.clear()
+        start = time.perf_counter()
+        encode_images(images, max_size=max_size)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "images_per_sec": len(images) / elapsed,
+            "mb_per_sec": sum(len(data) for data in images) / elapsed / 1e6,
+        }
+
+    encoded_image_cache.clear()
+    images = variants("PNG")
+    encode_images(images)
+    start = time.perf_counter()
+    encode_images(images)
+    results["cache_hit"] = {"images_per_sec": count / (time.perf_counter() - start)}
+    return results
+
+
+def print_results(name: str, results: dict, indent: int = 0) -> None:
+    print(" " * indent + name)
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print_results(key, value, indent + 2)
+        elif isinstance(value, float):
+            print(" " * (indent + 2) + f"{key:<24} {value:12.2f}")
+        else:
+            print(" " * (indent + 2) + f"{key:<24} {value!s:>12}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--provider", choices=["all", *PROVIDERS], default="all")
+    parser.add_argument("--requests", type=int, default=200, help="requests per mode")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=32, help="fragments per response")
+    parser.add_argument(
+        "--token-rate",
+        type=float,
+        default=None,
+        help="fragments per second, unthrottled by default",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds before the first fragment"
+    )
+    parser.add_argument(
+        "--images", type=int, default=16, help="images per encoding case, 0 to skip"
+    )
+    parser.add_argument(
+        "--image-size", type=int, default=512, help="width and height of the images"
+    )
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    results: dict = {
+        "config": {
+            "tokens": args.tokens,
+            "token_rate": args.token_rate,
+            "latency": args.latency,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "python": sys.version.split()[0],
+        }
+    }
+    names = list(PROVIDERS) if args.provider == "all" else [args.provider]
+    with MockServer(
+        tokens=args.tokens, token_rate=args.token_rate, latency=args.latency
+    ) as server:
+        for name in names:
+            provider = PROVIDERS[name](
+                server.url, transport=Transport(pool_size=max(10, args.concurrency))
+            )
+            provider.refresh_models()
+            # Warm up the connection pool and the code paths being measured.
+            bench_sync(provider, 5)
+            bench_stream(provider, 5)
+            results[name] = {
+                "sync": bench_sync(provider, args.requests),
+                "stream": bench_stream(provider, args.requests),
+                "threaded": bench_concurrent(provider, args.requests, args.concurrency),
+                "asyncio": bench_async(provider, args.requests, args.concurrency),
+                "memory": bench_memory(provider, args.concurrency),
+            }
+            provider.close()
+            print_results(name, results[name])
+
+    if args.images > 0:
+        results["images"] = bench_images(args.images, args.image_size)
+        print_results("images", results["images"])
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Import-time regression benchmark.
+
+Measures how long common `exfer` imports take in fresh interpreters, and checks that the heavy
+dependencies (PIL, the HTTP clients, asyncio and sqlite3) are not imported until they are used.
+Exits with a non-zero status when either check fails, so it can be run in CI.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --runs 20 --max-ms 50
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["PIL", "requests", "urllib3", "httpx", "asyncio", "sqlite3"]
+"""Modules which must stay unloaded by the statements in `CASES`."""
+
+CASES = [
+    "import exfer",
+    "from exfer import Exfer",
+    "from exfer import Exfer, Model, Capability, Ollama, LMStudio",
+]
+"""Import statements measured, all of which should avoid the `HEAVY_MODULES`."""
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(statement: str) -> tuple[float, list[str]]:
+    """Runs an import statement in a fresh interpreter, returning its duration in seconds and the modules loaded."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(statement=statement)],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output)
+    return result["elapsed"], result["modules"]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--runs", type=int, default=10, help="fresh interpreters per statement"
+    )
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="fail if the median time of any statement exceeds this many milliseconds",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    # Warm the bytecode cache so the first run is not penalized for compiling.
+    measure(CASES[-1])
+    for statement in CASES:
+        timings = []
+        loaded: set[str] = set()
+        for _ in range(args.runs):
+            elapsed, modules = measure(statement)
+            timings.append(elapsed * 1000)
+            loaded.update(modules)
+
+        median = statistics.median(timings)
+        heavy = [
+            name
+            for name in HEAVY_MODULES
+            if any(module == name or module.startswith(name + ".") for module in loaded)
+        ]
+        print(
+            f"{statement:<64} median {median:7.2f}ms  min {min(timings):7.2f}ms  max {max(timings):7.2f}ms"
+        )
+        if heavy:
+            print(f"  FAIL: eagerly imported {', '.join(heavy)}")
+            failed = True
+        if args.max_ms is not None and median > args.max_ms:
+            print(f"  FAIL: median exceeds {args.max_ms:.2f}ms")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
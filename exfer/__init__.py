@@ -1,16 +1,109 @@
-from .provider import Provider, ModelNotFoundException
-from .capabilities import Capability, CapabilitiesException
-from .model import Model
-
-from .lmstudio import LMStudio
-from .ollama import Ollama
-
-__all__ = [
-    "Provider",
-    "ModelNotFoundException",
-    "CapabilitiesException",
-    "Capability",
-    "Model",
-    "LMStudio",
-    "Ollama",
-]
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+# Submodules are imported on first access of one of their names, so that `import exfer` stays cheap
+# for short-lived processes that only use part of the package.
+if TYPE_CHECKING:
+    from .provider import Provider, ModelNotFoundException
+    from .capabilities import Capability, CapabilitiesException
+    from .model import Model
+    from .catalog import ModelCatalog
+    from .transport import Transport, TransportException
+    from .stream import TextStream, AsyncTextStream, DeadlineExceededException
+    from .instrumentation import (
+        Instrumentation,
+        Observer,
+        Trace,
+        MetricsAggregator,
+        SpanRecorder,
+    )
+    from .singleflight import SingleFlight, FlightAbandonedException
+    from .admission import (
+        AdmissionController,
+        AdmissionException,
+        AdmissionStats,
+        Priority,
+        admission_priority,
+    )
+
+    from .lmstudio import LMStudio
+    from .ollama import Ollama, LoadedModel
+    from .warm import WarmSet
+    from .session import Session, SessionStore
+    from .hedging import HedgePolicy
+    from .utils.streams import JSONEvent, IncrementalJSONDecoder
+    from .gateway import Gateway
+    from .exfer import Exfer, ProviderNotFoundException
+    from .batch import BatchResult, JSONLProgress
+    from .cache import Cache, LRUCache, SQLiteCache, TieredCache
+    from .routing import (
+        Router,
+        RoundRobinRouter,
+        LeastOutstandingRouter,
+        EWMALatencyRouter,
+    )
+
+_LAZY_IMPORTS = {
+    "Exfer": ".exfer",
+    "ProviderNotFoundException": ".exfer",
+    "BatchResult": ".batch",
+    "JSONLProgress": ".batch",
+    "Cache": ".cache",
+    "LRUCache": ".cache",
+    "SQLiteCache": ".cache",
+    "TieredCache": ".cache",
+    "Router": ".routing",
+    "RoundRobinRouter": ".routing",
+    "LeastOutstandingRouter": ".routing",
+    "EWMALatencyRouter": ".routing",
+    "Provider": ".provider",
+    "ModelNotFoundException": ".provider",
+    "CapabilitiesException": ".capabilities",
+    "Capability": ".capabilities",
+    "Model": ".model",
+    "ModelCatalog": ".catalog",
+    "Transport": ".transport",
+    "TransportException": ".transport",
+    "TextStream": ".stream",
+    "AsyncTextStream": ".stream",
+    "DeadlineExceededException": ".stream",
+    "Instrumentation": ".instrumentation",
+    "Observer": ".instrumentation",
+    "Trace": ".instrumentation",
+    "MetricsAggregator": ".instrumentation",
+    "SpanRecorder": ".instrumentation",
+    "SingleFlight": ".singleflight",
+    "FlightAbandonedException": ".singleflight",
+    "AdmissionController": ".admission",
+    "AdmissionException": ".admission",
+    "AdmissionStats": ".admission",
+    "Priority": ".admission",
+    "admission_priority": ".admission",
+    "LMStudio": ".lmstudio",
+    "Ollama": ".ollama",
+    "LoadedModel": ".ollama",
+    "WarmSet": ".warm",
+    "Session": ".session",
+    "SessionStore": ".session",
+    "HedgePolicy": ".hedging",
+    "JSONEvent": ".utils.streams",
+    "IncrementalJSONDecoder": ".utils.streams",
+    "Gateway": ".gateway",
+}
+"""Maps each exported name to the submodule that defines it."""
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    module = _LAZY_IMPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    # Cache on the package so later lookups don't go through here again.
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
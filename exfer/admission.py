@@ -0,0 +1,466 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+from .instrumentation import current_trace
+
+if TYPE_CHECKING:
+    import asyncio
+
+
+class AdmissionException(Exception):
+    pass
+
+
+class Priority(IntEnum):
+    """Common priorities for admission. Lower values are admitted first, any integer can be used."""
+
+    INTERACTIVE = 0
+    """Calls a user is waiting on."""
+
+    NORMAL = 10
+    """Default priority of calls."""
+
+    BATCH = 20
+    """Background work, such as `Exfer.generate_batch()`, which yields to the other calls."""
+
+
+current_priority: ContextVar[int] = ContextVar(
+    "exfer_priority", default=Priority.NORMAL
+)
+"""Priority that calls made in the current context are admitted with. See `admission_priority()`."""
+
+
+@contextmanager
+def admission_priority(priority: int) -> Iterator[None]:
+    """Sets the priority of the calls made within the context, for providers with an `AdmissionController`.
+
+    Example:
+        with admission_priority(Priority.INTERACTIVE):
+            exference.generate('llama3.2', 'Why is the sky blue?')
+
+    Args:
+        priority (int): Priority to admit the calls with, lower is sooner. See `Priority`.
+    """
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def used_tokens(stats: Optional[dict], chars: int) -> int:
+    """Number of tokens a call used, for charging the tokens-per-second limit. Read from the statistics the
+    provider reported in either the Ollama or OpenAI formats, otherwise estimated at about four characters
+    per token.
+
+    Args:
+        stats (Optional[dict]): Final statistics reported by the provider, see `TextStream.stats`.
+        chars (int): Characters of the prompts and the response, for the estimate.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if stats:
+        usage = stats.get("usage") or {}
+        if "total_tokens" in usage:
+            return usage["total_tokens"]
+        if "eval_count" in stats:
+            return stats.get("prompt_eval_count", 0) + stats["eval_count"]
+    return chars // 4 + 1
+
+
+@dataclass
+class AdmissionStats:
+    """Point-in-time statistics of an `AdmissionController`."""
+
+    active: int
+    """Number of calls currently admitted and running."""
+
+    queued: int
+    """Number of calls currently waiting to be admitted."""
+
+    admitted: int
+    """Number of calls admitted so far."""
+
+    rejected: int
+    """Number of calls rejected because the queue was full, or that timed out waiting."""
+
+    wait_total: float
+    """Seconds the admitted calls spent waiting in the queue, combined."""
+
+    wait_max: float
+    """Longest wait of an admitted call, in seconds."""
+
+    @property
+    def wait_mean(self) -> float:
+        """Average wait of the admitted calls, in seconds."""
+        return self.wait_total / self.admitted if self.admitted else 0.0
+
+
+class _TokenBucket:
+    """Refills `rate` tokens per second, holding at most `capacity`. Its level can go negative when charged
+    for usage after the fact, which then delays the following calls until it has been paid back.
+    """
+
+    __slots__ = ("rate", "capacity", "level", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until the level reaches the amount, zero if it already has."""
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class _Waiter:
+    __slots__ = (
+        "priority",
+        "enqueued",
+        "granted",
+        "cancelled",
+        "delay",
+        "event",
+        "loop",
+        "future",
+    )
+
+    def __init__(self, priority: int, loop: Optional["asyncio.AbstractEventLoop"]):
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self.delay: Optional[float] = None
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future: Optional[asyncio.Future] = None
+
+    def wake(self) -> None:
+        """Wakes the waiter to check whether it was granted. Called with the controller's lock held."""
+        if self.event is not None:
+            self.event.set()
+        elif self.future is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future: "asyncio.Future") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Ticket:
+    """Admission of a single call. Must be released once the call has finished, which can be done by using it
+    as a context manager."""
+
+    __slots__ = ("controller", "priority", "wait", "_released")
+
+    priority: int
+    """Priority the call was admitted with."""
+
+    wait: float
+    """Seconds the call waited in the queue before being admitted."""
+
+    def __init__(self, controller: "AdmissionController", priority: int, wait: float):
+        self.controller = controller
+        self.priority = priority
+        self.wait = wait
+        self._released = False
+
+    def release(self, tokens: Optional[int] = None) -> None:
+        """Frees the call's concurrency slot. Releasing more than once does nothing.
+
+        Args:
+            tokens (Optional[int], optional): Tokens the call used, charged against the tokens-per-second limit. Defaults to None.
+        """
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(tokens)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """Limits the calls a provider issues to its backend, so that excess calls queue on the client where they
+    can be prioritized and observed, instead of invisibly on the server.
+
+    A call is admitted once there is a free concurrency slot and the rate limits allow it. Waiting calls are
+    admitted in order of priority (see `Priority`), then in the order they arrived, so interactive calls overtake
+    batch calls. The requests-per-second limit is charged when a call is admitted, and the tokens-per-second limit
+    when it finishes, with the tokens it used.
+
+    Threads and asyncio tasks can share the same controller.
+
+    Example:
+        ollama = Ollama(admission=AdmissionController(max_concurrency=4, tokens_per_second=2000))
+    """
+
+    max_concurrency: Optional[int]
+    """Maximum calls running at once, which should match the parallelism of the backend. None is unlimited."""
+
+    requests_per_second: Optional[float]
+    """Maximum rate calls are admitted at. None is unlimited."""
+
+    tokens_per_second: Optional[float]
+    """Maximum rate of tokens, prompt and generated, used by the calls. None is unlimited."""
+
+    max_queue: Optional[int]
+    """Maximum calls waiting to be admitted, beyond which calls are rejected. None is unlimited."""
+
+    queue_timeout: Optional[float]
+    """Default seconds a call waits to be admitted before it is rejected. None waits indefinitely."""
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        requests_per_second: Optional[float] = None,
+        tokens_per_second: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        """Constructs a new admission controller. Without any limits every call is admitted immediately.
+
+        Args:
+            max_concurrency (Optional[int], optional): Maximum calls running at once. Defaults to None.
+            requests_per_second (Optional[float], optional): Maximum rate calls are admitted at. Defaults to None.
+            tokens_per_second (Optional[float], optional): Maximum rate of tokens used by the calls. Defaults to None.
+            burst (Optional[float], optional): Seconds of each rate that can be used at once after being idle. Defaults to one second.
+            max_queue (Optional[int], optional): Maximum calls waiting to be admitted. Defaults to None.
+            queue_timeout (Optional[float], optional): Seconds a call waits to be admitted before it is rejected. Defaults to None.
+        """
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.tokens_per_second = tokens_per_second
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        burst = 1.0 if burst is None else burst
+        self._requests = (
+            _TokenBucket(requests_per_second, max(1.0, requests_per_second * burst))
+            if requests_per_second
+            else None
+        )
+        self._tokens = (
+            _TokenBucket(tokens_per_second, tokens_per_second * burst)
+            if tokens_per_second
+            else None
+        )
+        self._lock = threading.Lock()
+        self._heap: list[tuple[int, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def queued(self) -> int:
+        """Number of calls currently waiting to be admitted."""
+        return self._queued
+
+    @property
+    def active(self) -> int:
+        """Number of calls currently admitted and running."""
+        return self._active
+
+    def stats(self) -> AdmissionStats:
+        """Current queue depth, wait times and counts of the admitted and rejected calls."""
+        with self._lock:
+            return AdmissionStats(
+                self._active,
+                self._queued,
+                self._admitted,
+                self._rejected,
+                self._wait_total,
+                self._wait_max,
+            )
+
+    def acquire(
+        self, priority: Optional[int] = None, timeout: Optional[float] = None
+    ) -> Ticket:
+        """Waits for a call to be admitted.
+
+        Args:
+            priority (Optional[int], optional): Priority of the call, lower is sooner. Defaults to the `current_priority`.
+            timeout (Optional[float], optional): Seconds to wait before rejecting the call. Defaults to the `queue_timeout`.
+
+        Raises:
+            AdmissionException: If the queue is full, or the call timed out waiting.
+
+        Returns:
+            Ticket: Admission of the call, to be released once it has finished.
+        """
+        waiter, deadline = self._enqueue(priority, timeout, None)
+        while True:
+            with self._lock:
+                if waiter.granted:
+                    break
+                wait = self._next_wait(waiter, deadline)
+                waiter.event.clear()
+            if not waiter.event.wait(wait):
+                # Woken by the timeout, the rate limits may allow the call by now.
+                with self._lock:
+                    self._dispatch()
+        return self._ticket(waiter)
+
+    async def aacquire(
+        self, priority: Optional[int] = None, timeout: Optional[float] = None
+    ) -> Ticket:
+        """Waits for a call to be admitted using asyncio. Mirrors `AdmissionController.acquire()`.
+
+        Args:
+            priority (Optional[int], optional): Priority of the call, lower is sooner. Defaults to the `current_priority`.
+            timeout (Optional[float], optional): Seconds to wait before rejecting the call. Defaults to the `queue_timeout`.
+
+        Raises:
+            AdmissionException: If the queue is full, or the call timed out waiting.
+
+        Returns:
+            Ticket: Admission of the call, to be released once it has finished.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        waiter, deadline = self._enqueue(priority, timeout, loop)
+        try:
+            while True:
+                with self._lock:
+                    if waiter.granted:
+                        break
+                    wait = self._next_wait(waiter, deadline)
+                    future = waiter.future = loop.create_future()
+                try:
+                    await asyncio.wait_for(future, wait)
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._dispatch()
+        except BaseException:
+            # Cancelled while waiting, give up the place in the queue, or the slot if it was just granted.
+            with self._lock:
+                granted = waiter.granted
+                if not granted and not waiter.cancelled:
+                    self._abandon(waiter, rejected=False)
+            if granted:
+                self._release(None)
+            raise
+        return self._ticket(waiter)
+
+    def _enqueue(
+        self,
+        priority: Optional[int],
+        timeout: Optional[float],
+        loop: Optional["asyncio.AbstractEventLoop"],
+    ) -> tuple[_Waiter, Optional[float]]:
+        waiter = _Waiter(current_priority.get() if priority is None else priority, loop)
+        timeout = self.queue_timeout if timeout is None else timeout
+        deadline = None if timeout is None else waiter.enqueued + timeout
+        with self._lock:
+            if self.max_queue is not None and self._queued >= self.max_queue:
+                self._rejected += 1
+                raise AdmissionException(
+                    f"admission queue is full with {self._queued} waiting calls"
+                )
+            heapq.heappush(self._heap, (waiter.priority, next(self._sequence), waiter))
+            self._queued += 1
+            self._dispatch()
+        return waiter, deadline
+
+    def _next_wait(self, waiter: _Waiter, deadline: Optional[float]) -> Optional[float]:
+        """Seconds for a waiter to sleep until it should check again. Called with the lock held.
+
+        Raises:
+            AdmissionException: If the waiter's deadline has passed.
+        """
+        wait, waiter.delay = waiter.delay, None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._abandon(waiter, rejected=True)
+                raise AdmissionException(
+                    f"call was not admitted within {deadline - waiter.enqueued:.2f}s"
+                )
+            wait = remaining if wait is None else min(wait, remaining)
+        return wait
+
+    def _abandon(self, waiter: _Waiter, rejected: bool) -> None:
+        waiter.cancelled = True
+        self._queued -= 1
+        if rejected:
+            self._rejected += 1
+        # The waiter may have been holding up the ones behind it.
+        self._dispatch()
+
+    def _ticket(self, waiter: _Waiter) -> Ticket:
+        ticket = Ticket(self, waiter.priority, time.monotonic() - waiter.enqueued)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add("queue", ticket.wait)
+        return ticket
+
+    def _dispatch(self) -> None:
+        """Admits the waiters in order while the limits allow. Called with the lock held."""
+        now = time.monotonic()
+        if self._requests is not None:
+            self._requests.refill(now)
+        if self._tokens is not None:
+            self._tokens.refill(now)
+        while self._heap:
+            waiter = self._heap[0][2]
+            if waiter.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            if (
+                self.max_concurrency is not None
+                and self._active >= self.max_concurrency
+            ):
+                return
+            delay = 0.0
+            if self._requests is not None:
+                delay = self._requests.delay(1.0)
+            if self._tokens is not None:
+                # Tokens are only known once the call finishes, so calls wait until any overdraft is paid back.
+                delay = max(delay, self._tokens.delay(0.0))
+            if delay > 0:
+                # Only the first waiter needs to wake up when the limits allow, the rest follow it.
+                waiter.delay = delay
+                waiter.wake()
+                return
+
+            heapq.heappop(self._heap)
+            if self._requests is not None:
+                self._requests.level -= 1.0
+            wait = now - waiter.enqueued
+            waiter.granted = True
+            self._active += 1
+            self._queued -= 1
+            self._admitted += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            waiter.wake()
+
+    def _release(self, tokens: Optional[int]) -> None:
+        with self._lock:
+            self._active -= 1
+            if tokens and self._tokens is not None:
+                self._tokens.refill(time.monotonic())
+                self._tokens.level -= tokens
+            self._dispatch()
@@ -0,0 +1,315 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from .utils import read_snapshot, write_snapshot
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+T = TypeVar("T")
+
+
+@dataclass
+class BatchResult:
+    """Outcome of a single item within a batch. Exactly one of `result` or `error` is set."""
+
+    index: int
+    """Position of the item within the batch input."""
+
+    item: Any
+    """The input item as it was given."""
+
+    result: Optional[str] = None
+    """Generated text, if the item succeeded."""
+
+    error: Optional[Exception] = None
+    """Exception raised while generating, if the item failed."""
+
+    @property
+    def ok(self) -> bool:
+        """True if the item succeeded."""
+        return self.error is None
+
+
+def _run_item(fn: Callable[[T], str], index: int, item: T) -> BatchResult:
+    try:
+        return BatchResult(index, item, result=fn(item))
+    except Exception as e:
+        return BatchResult(index, item, error=e)
+
+
+def run_batch(
+    fn: Callable[[T], str],
+    items: Iterable[T],
+    max_workers: int,
+    ordered: bool = True,
+) -> Iterator[BatchResult]:
+    """Calls `fn` for each item over a bounded pool of worker threads, yielding the results as they become
+    available. Items are pulled from the iterable lazily, at most `2 * max_workers` are in-flight or
+    awaiting their turn at any time, so arbitrarily long iterators can be used without buffering them.
+
+    Exceptions raised by `fn` are captured into the item's `BatchResult` instead of ending the batch.
+
+    Args:
+        fn (Callable[[T], str]): Function to call with each item.
+        items (Iterable[T]): Items to process.
+        max_workers (int): Maximum number of concurrent calls.
+        ordered (bool, optional): Yield results in input order, otherwise in completion order. Defaults to True.
+
+    Yields:
+        BatchResult: Result of each item.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    window = max(1, max_workers) * 2
+    iterator = enumerate(items)
+    pending: dict["Future[BatchResult]", int] = {}
+    ready: dict[int, BatchResult] = {}
+    next_index = 0
+    exhausted = False
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        while True:
+            # Top up the window. When ordered, results waiting on an earlier item count against it too.
+            while not exhausted and len(pending) + len(ready) < window:
+                try:
+                    index, item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(_run_item, fn, index, item)] = index
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                result = future.result()
+                if ordered:
+                    ready[result.index] = result
+                else:
+                    yield result
+
+            while next_index in ready:
+                yield ready.pop(next_index)
+                next_index += 1
+    finally:
+        # If the consumer stopped early, don't start anything new or hold them up on what is running.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@dataclass
+class JSONLProgress:
+    """Progress of a JSONL job run by `run_jsonl()`, counting the lines of previous runs it resumed from."""
+
+    completed: int = 0
+    """Number of input lines with a result in the output, including failures."""
+
+    failed: int = 0
+    """Number of input lines whose result is an error."""
+
+    finished: bool = False
+    """True once every input line has a result."""
+
+
+class _InvalidLine:
+    """Stands in for an input line that isn't valid JSON, so that it fails on its own instead of the whole job."""
+
+    def __init__(self, error: ValueError):
+        self.error = error
+
+
+class _JSONLJob:
+    """State of a running JSONL job. Only touched from the thread consuming the batch, which also pulls the items."""
+
+    def __init__(
+        self,
+        input: BinaryIO,
+        output: BinaryIO,
+        checkpoint_path: str,
+        job: dict,
+        state: Optional[dict],
+    ):
+        self.input = input
+        self.output = output
+        self.checkpoint_path = checkpoint_path
+        self.job = job
+        self.progress = JSONLProgress()
+        self.read_index = 0
+        self.read_offset = 0
+        self.output_offset = 0
+        self.in_flight: dict[int, int] = {}
+        """Input offset of each line which has been read, but whose result isn't written yet."""
+        self.done: set[int] = set()
+        """Lines at or after the low-water mark whose results are written."""
+        if state is not None:
+            self.read_index = state["index"]
+            self.read_offset = state["input_offset"]
+            self.output_offset = state["output_offset"]
+            self.done = set(state["done"])
+            self.progress.completed = state["completed"]
+            self.progress.failed = state["failed"]
+        self.input.seek(self.read_offset)
+        # Anything written after the checkpoint is redone, including a partially written line.
+        self.output.seek(self.output_offset)
+        self.output.truncate()
+
+    def items(self) -> Iterator[tuple[int, Any]]:
+        """Reads the input lines lazily, skipping blank lines and those already done."""
+        while True:
+            offset = self.read_offset
+            line = self.input.readline()
+            if not line:
+                return
+            index = self.read_index
+            self.read_index += 1
+            self.read_offset += len(line)
+            if not line.strip() or index in self.done:
+                continue
+            self.in_flight[index] = offset
+            try:
+                item = json.loads(line)
+            except ValueError as error:
+                item = _InvalidLine(error)
+            yield index, item
+
+    def write(self, result: BatchResult) -> None:
+        index, item = result.item
+        record: dict[str, Any] = {"index": index}
+        if isinstance(item, dict) and "id" in item:
+            record["id"] = item["id"]
+        error = result.error
+        if error is None and not isinstance(result.result, str):
+            # Such as a stream, which is closed rather than left holding its connection.
+            close = getattr(result.result, "close", None)
+            if callable(close):
+                close()
+            error = TypeError(f"result is a {type(result.result).__name__}, not a str")
+        if error is None:
+            record["response"] = result.result
+        else:
+            record["error"] = f"{type(error).__name__}: {error}"
+            self.progress.failed += 1
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.output.write(line)
+        self.output_offset += len(line)
+        self.progress.completed += 1
+        del self.in_flight[index]
+        self.done.add(index)
+
+    def low_water(self) -> int:
+        """Index of the first line without a result, every line before it is done."""
+        return min(self.in_flight) if self.in_flight else self.read_index
+
+    def checkpoint(self) -> None:
+        """Makes the output durable, then records how far it got, so that a crash loses at most the work since."""
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        low = self.low_water()
+        self.done = {index for index in self.done if index >= low}
+        write_snapshot(
+            self.checkpoint_path,
+            {
+                "job": self.job,
+                "index": low,
+                "input_offset": self.in_flight.get(low, self.read_offset),
+                "output_offset": self.output_offset,
+                "done": sorted(self.done),
+                "completed": self.progress.completed,
+                "failed": self.progress.failed,
+                "finished": self.progress.finished,
+            },
+        )
+
+
+def run_jsonl(
+    fn: Callable[[Union[str, dict]], str],
+    input_path: str,
+    output_path: str,
+    max_workers: int,
+    ordered: bool = True,
+    checkpoint_interval: float = 10.0,
+    resume: bool = True,
+    on_progress: Optional[Callable[[JSONLProgress], None]] = None,
+) -> JSONLProgress:
+    """Calls `fn` for each line of a JSONL file, writing the results to another JSONL file, see `run_batch()`.
+    Lines are read lazily and results are written as soon as they can be, so memory use doesn't grow with the
+    size of the input.
+
+    Each input line is a JSON string or object, which is passed to `fn`. An `id` field of an object is removed,
+    and copied to its output line. Each output line holds the `index` of its input line (counting from 0,
+    including blank lines), the `id` if any, and either the `response` or the `error`. Lines that fail, including
+    invalid JSON, are recorded with their error rather than ending the job.
+
+    Progress is checkpointed to `<output_path>.checkpoint` every `checkpoint_interval` seconds, and when the job
+    stops. A job that is run again resumes from its checkpoint, so at most the work since the last checkpoint is
+    repeated after a crash. Lines appended to the input after a job has finished are picked up by running it again.
+
+    Args:
+        fn (Callable[[Union[str, dict]], str]): Function to call with each input line.
+        input_path (str): Filepath of the input JSONL.
+        output_path (str): Filepath of the output JSONL.
+        max_workers (int): Maximum number of concurrent calls.
+        ordered (bool, optional): Write results in input order, otherwise in completion order. Defaults to True.
+        checkpoint_interval (float, optional): Seconds between checkpoints. Defaults to 10.0.
+        resume (bool, optional): Resume from the checkpoint if there is one, otherwise start over. Defaults to True.
+        on_progress (Optional[Callable[[JSONLProgress], None]], optional): Called after each checkpoint. Defaults to None.
+
+    Raises:
+        ValueError: If the checkpoint belongs to a job with a different input, or ordering.
+
+    Returns:
+        JSONLProgress: Progress of the job once it has finished.
+    """
+    checkpoint_path = f"{output_path}.checkpoint"
+    job = {"input": os.path.abspath(input_path), "ordered": ordered}
+    state = read_snapshot(checkpoint_path) if resume else None
+    if state is not None and state.get("job") != job:
+        raise ValueError(
+            f"checkpoint {checkpoint_path} belongs to a different job, remove it or don't resume"
+        )
+    if state is not None and not os.path.exists(output_path):
+        state = None
+
+    def call(entry: tuple[int, Any]) -> str:
+        _, item = entry
+        if isinstance(item, _InvalidLine):
+            raise item.error
+        if isinstance(item, dict) and "id" in item:
+            item = {key: value for key, value in item.items() if key != "id"}
+        return fn(item)
+
+    with open(input_path, "rb") as input, open(
+        output_path, "r+b" if state is not None else "wb"
+    ) as output:
+        run = _JSONLJob(input, output, checkpoint_path, job, state)
+        checkpointed = time.monotonic()
+        try:
+            for result in run_batch(call, run.items(), max_workers, ordered):
+                run.write(result)
+                if time.monotonic() - checkpointed >= checkpoint_interval:
+                    run.checkpoint()
+                    checkpointed = time.monotonic()
+                    if on_progress is not None:
+                        on_progress(run.progress)
+            run.progress.finished = True
+        finally:
+            run.checkpoint()
+        if on_progress is not None:
+            on_progress(run.progress)
+        return run.progress
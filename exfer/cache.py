@@ -0,0 +1,270 @@
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from .model import Model
+from .utils import ImageInput, hash_images
+
+
+def make_cache_key(
+    model: Model,
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    images: Optional[ImageInput] = None,
+    options: Optional[dict] = None,
+) -> str:
+    """Builds a key identifying a generation request. Two requests with the same key are expected to
+    produce the same response when the generation is deterministic (such as with a temperature of 0).
+
+    Images are identified by a hash of their contents, so the same image given by different paths or
+    objects results in the same key.
+
+    Args:
+        model (Model): Resolved model the request is for.
+        prompt (str): Prompt of the request.
+        system_prompt (Optional[str], optional): System prompt of the request. Defaults to None.
+        images (ImageInput, optional): Images of the request. Defaults to None.
+        options (Optional[dict], optional): Generation options of the request. Defaults to None.
+
+    Returns:
+        str: Hex digest identifying the request.
+    """
+    payload = json.dumps(
+        [
+            model.key,
+            model.version,
+            model.tag,
+            prompt,
+            system_prompt,
+            hash_images(images) if images is not None else None,
+            options,
+        ],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cache(ABC):
+    """Abstract Base Class for response caches. Responses are stored as the list of fragments they were
+    generated as, so that streaming callers can be given the same fragments when replayed.
+
+    Implementations must be safe to use from multiple threads.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[list[str]]:
+        """Retrieves a cached response.
+
+        Args:
+            key (str): Key of the request, see `make_cache_key()`.
+
+        Returns:
+            Optional[list[str]]: The fragments of the response, or None if it is not cached.
+        """
+        ...
+
+    @abstractmethod
+    def set(self, key: str, fragments: list[str]) -> None:
+        """Stores a response.
+
+        Args:
+            key (str): Key of the request, see `make_cache_key()`.
+            fragments (list[str]): The fragments of the response.
+        """
+        ...
+
+    def clear(self) -> None:
+        """Removes all cached responses."""
+        ...
+
+
+class LRUCache(Cache):
+    """In-memory cache bounded to a number of entries, evicting the least recently used first."""
+
+    max_entries: int
+    """Maximum number of responses held."""
+
+    ttl: Optional[float]
+    """Seconds a response remains valid for, or None to never expire."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        """Constructs a new in-memory LRU cache.
+
+        Args:
+            max_entries (int, optional): Maximum number of responses held. Defaults to 1024.
+            ttl (Optional[float], optional): Seconds a response remains valid for. Defaults to None, which never expires.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[list[str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, fragments: list[str]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), fragments)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(Cache):
+    """Persistent cache stored in an SQLite database. Bounded by age, number of entries and total size,
+    evicting the least recently used first. Can be shared between processes."""
+
+    path: str
+    """Filepath of the SQLite database."""
+
+    ttl: Optional[float]
+    """Seconds a response remains valid for, or None to never expire."""
+
+    max_entries: Optional[int]
+    """Maximum number of responses held, or None for no limit."""
+
+    max_bytes: Optional[int]
+    """Maximum combined size of the stored responses in bytes, or None for no limit."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        """Constructs a new SQLite cache, creating the database if needed.
+
+        Args:
+            path (str): Filepath of the SQLite database.
+            ttl (Optional[float], optional): Seconds a response remains valid for. Defaults to None, which never expires.
+            max_entries (Optional[int], optional): Maximum number of responses held. Defaults to None.
+            max_bytes (Optional[int], optional): Maximum combined size of the stored responses in bytes. Defaults to None.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "fragments TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+
+    def get(self, key: str) -> Optional[list[str]]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT fragments, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, fragments: list[str]) -> None:
+        value = json.dumps(fragments)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        if self.ttl is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+            )
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        if self.max_bytes is not None:
+            # Keep the most recently accessed entries whose running total fits within the limit.
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM responses) "
+                "WHERE total > ?)",
+                (self.max_bytes,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self._lock:
+            self._connection.close()
+
+
+class TieredCache(Cache):
+    """Combines multiple caches, such as a fast `LRUCache` in front of a persistent `SQLiteCache`.
+    Lookups check each tier in order, and hits are copied into the faster tiers before it.
+    """
+
+    tiers: list[Cache]
+    """Caches ordered from fastest to slowest."""
+
+    def __init__(self, *tiers: Cache):
+        self.tiers = list(tiers)
+
+    def get(self, key: str) -> Optional[list[str]]:
+        for index, tier in enumerate(self.tiers):
+            fragments = tier.get(key)
+            if fragments is not None:
+                for faster in self.tiers[:index]:
+                    faster.set(key, fragments)
+                return fragments
+        return None
+
+    def set(self, key: str, fragments: list[str]) -> None:
+        for tier in self.tiers:
+            tier.set(key, fragments)
+
+    def clear(self) -> None:
+        for tier in self.tiers:
+            tier.clear()
@@ -1,4 +1,5 @@
 from enum import StrEnum
+from typing import Iterable, Union
 
 
 class Capability(StrEnum):
@@ -31,6 +32,46 @@ class Capability(StrEnum):
     TOOLS = "TOOLS"
     """Usage of tool calling by the model to help in accomplishing a given task. """
 
+    EMBEDDING = "EMBEDDING"
+    """Converts text into a vector embedding, for search and similarity. """
+
+    @property
+    def flag(self) -> int:
+        """Single bit representing this capability within a capability mask."""
+        return _FLAGS[self]
+
+    @staticmethod
+    def mask(
+        capabilities: Union[str, "Capability", Iterable[Union[str, "Capability"]]],
+    ) -> int:
+        """Combines one or more capabilities into a bitmask, so that sets of capabilities can be compared with a single bitwise operation.
+
+        Args:
+            capabilities (Union[str, Capability, Iterable[Union[str, Capability]]]): Individual, or multiple, capabilities.
+
+        Raises:
+            ValueError: If a string is not a known capability.
+
+        Returns:
+            int: Bitmask of the capabilities.
+        """
+        if isinstance(capabilities, str):
+            return _FLAGS[Capability(capabilities)]
+        result = 0
+        for capability in capabilities:
+            result |= _FLAGS[Capability(capability)]
+        return result
+
+    @staticmethod
+    def from_mask(mask: int) -> list["Capability"]:
+        """Expands a bitmask back into the list of capabilities it contains."""
+        return [capability for capability, flag in _FLAGS.items() if mask & flag]
+
+
+_FLAGS: dict[Capability, int] = {
+    capability: 1 << index for index, capability in enumerate(Capability)
+}
+
 
 class CapabilitiesException(Exception):
     pass
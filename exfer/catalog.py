@@ -0,0 +1,228 @@
+import threading
+from typing import Iterable, Iterator, Optional, Union
+
+from .capabilities import Capability
+from .model import Model
+
+
+class ModelCatalog:
+    """Index of the models available across providers. Keeps secondary indexes by provider and by capability,
+    so that lookups such as "which providers serve this model" or "which models can do TEXT and VISION" are
+    answered without scanning every model.
+
+    Capability queries are memoized per capability mask, and the memo is discarded whenever the catalog
+    changes, so repeated queries against a stable catalog are constant-time. The catalog is safe to use
+    from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: dict[str, dict[str, Model]] = {}
+        """Model key to the providers serving it, in registration order, with the model as that provider defines it."""
+        self._by_provider: dict[str, set[str]] = {}
+        """Provider key to the keys of the models it serves."""
+        self._by_capability: dict[int, set[str]] = {}
+        """Single capability flag to the keys of the models that have it."""
+        self._masks: dict[str, int] = {}
+        """Model key to the combined capability mask of the model across its providers."""
+        self._unhealthy: set[str] = set()
+        """Provider keys which are currently marked as unhealthy."""
+        self._queries: dict[tuple[int, bool], frozenset[str]] = {}
+        """Memoized results of `query()`."""
+
+    def __contains__(self, model: Union[str, Model]) -> bool:
+        return (model.key if isinstance(model, Model) else model) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Model]:
+        return iter(self.models())
+
+    def _invalidate(self) -> None:
+        self._queries = {}
+
+    def add(self, model: Model, provider_key: str) -> None:
+        """Registers a model as served by a provider. Replaces the provider's previous definition of the model, if any.
+
+        Args:
+            model (Model): The model to add.
+            provider_key (str): Key of the provider serving it.
+        """
+        with self._lock:
+            providers = self._entries.setdefault(model.key, {})
+            providers[provider_key] = model
+            self._by_provider.setdefault(provider_key, set()).add(model.key)
+            self._reindex(model.key)
+            self._invalidate()
+
+    def remove(self, model: Union[str, Model], provider_key: str) -> bool:
+        """Removes a provider from the model. The model itself is removed once no providers remain.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            provider_key (str): Key of the provider to remove.
+
+        Returns:
+            bool: True if the provider did serve the model.
+        """
+        key = model.key if isinstance(model, Model) else model
+        with self._lock:
+            providers = self._entries.get(key)
+            if providers is None or provider_key not in providers:
+                return False
+            del providers[provider_key]
+            provided = self._by_provider.get(provider_key)
+            if provided is not None:
+                provided.discard(key)
+                if not provided:
+                    del self._by_provider[provider_key]
+            if not providers:
+                del self._entries[key]
+            self._reindex(key)
+            self._invalidate()
+            return True
+
+    def remove_provider(self, provider_key: str) -> None:
+        """Removes a provider from all of the models it serves."""
+        with self._lock:
+            for key in list(self._by_provider.get(provider_key, ())):
+                self.remove(key, provider_key)
+            self._unhealthy.discard(provider_key)
+
+    def _reindex(self, key: str) -> None:
+        """Updates the capability indexes of a model after its providers changed."""
+        previous = self._masks.pop(key, 0)
+        for flag, keys in self._by_capability.items():
+            if previous & flag:
+                keys.discard(key)
+
+        providers = self._entries.get(key)
+        if not providers:
+            return
+        mask = 0
+        for model in providers.values():
+            mask |= model.capability_mask
+        self._masks[key] = mask
+        for capability in Capability:
+            if mask & capability.flag:
+                self._by_capability.setdefault(capability.flag, set()).add(key)
+
+    def get(
+        self, model: Union[str, Model], provider_key: Optional[str] = None
+    ) -> Optional[Model]:
+        """Retrieves a model definition.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            provider_key (Optional[str], optional): Provider whose definition to return. Defaults to the first provider that registered the model.
+
+        Returns:
+            Optional[Model]: The model, or None if it is not in the catalog (or not served by the given provider).
+        """
+        key = model.key if isinstance(model, Model) else model
+        providers = self._entries.get(key)
+        if not providers:
+            return None
+        if provider_key is not None:
+            return providers.get(provider_key)
+        return next(iter(providers.values()))
+
+    def models(self) -> list[Model]:
+        """All models in the catalog, one definition per model key."""
+        with self._lock:
+            return [
+                next(iter(providers.values())) for providers in self._entries.values()
+            ]
+
+    def model_keys(self) -> list[str]:
+        """Keys of all models in the catalog."""
+        return list(self._entries)
+
+    def providers_for(
+        self, model: Union[str, Model], healthy_only: bool = False
+    ) -> list[str]:
+        """Keys of the providers serving a model, in the order they registered it.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            healthy_only (bool, optional): Exclude providers marked as unhealthy. Defaults to False.
+
+        Returns:
+            list[str]: Provider keys. Empty if the model is not in the catalog.
+        """
+        key = model.key if isinstance(model, Model) else model
+        providers = self._entries.get(key)
+        if not providers:
+            return []
+        if healthy_only and self._unhealthy:
+            return [
+                provider for provider in providers if provider not in self._unhealthy
+            ]
+        return list(providers)
+
+    def models_for(self, provider_key: str) -> set[str]:
+        """Keys of the models served by a provider."""
+        return set(self._by_provider.get(provider_key, ()))
+
+    def provider_keys(self) -> list[str]:
+        """Keys of all providers serving at least one model."""
+        return list(self._by_provider)
+
+    def set_healthy(self, provider_key: str, healthy: bool = True) -> None:
+        """Marks a provider as healthy or unhealthy. Unhealthy providers are excluded from `healthy_only` lookups."""
+        with self._lock:
+            if healthy:
+                self._unhealthy.discard(provider_key)
+            else:
+                self._unhealthy.add(provider_key)
+            self._invalidate()
+
+    def is_healthy(self, provider_key: str) -> bool:
+        """True unless the provider has been marked as unhealthy."""
+        return provider_key not in self._unhealthy
+
+    def query(
+        self,
+        capabilities: Union[str, Capability, Iterable[Union[str, Capability]]] = (),
+        healthy_only: bool = True,
+    ) -> frozenset[str]:
+        """Finds the models which have all of the given capabilities.
+
+        Args:
+            capabilities (Union[str, Capability, Iterable[Union[str, Capability]]], optional): Capabilities the models must have. Defaults to (), which matches every model.
+            healthy_only (bool, optional): Only include models served by at least one healthy provider. Defaults to True.
+
+        Returns:
+            frozenset[str]: Keys of the matching models.
+        """
+        mask = Capability.mask(capabilities)
+        memo = (mask, healthy_only)
+        result = self._queries.get(memo)
+        if result is not None:
+            return result
+
+        with self._lock:
+            matches: Optional[set[str]] = None
+            for capability in Capability.from_mask(mask):
+                keys = self._by_capability.get(capability.flag, set())
+                # Start from the smallest set to keep the intersection cheap.
+                if matches is None or len(keys) < len(matches):
+                    matches, keys = set(keys), matches or keys
+                matches &= keys
+                if not matches:
+                    break
+            if matches is None:
+                matches = set(self._entries)
+            if healthy_only and self._unhealthy:
+                matches = {
+                    key
+                    for key in matches
+                    if any(
+                        provider not in self._unhealthy
+                        for provider in self._entries[key]
+                    )
+                }
+            result = frozenset(matches)
+            self._queries[memo] = result
+            return result
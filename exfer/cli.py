@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import sys
+from typing import Optional, Sequence
+
+from .admission import AdmissionController, Priority
+from .batch import JSONLProgress
+from .cache import LRUCache
+from .exfer import Exfer, ProviderNotFoundException
+from .lmstudio import LMStudio
+from .ollama import Ollama
+from .provider import ModelNotFoundException, Provider
+from .singleflight import SingleFlight
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Entry point of the `exfer` command.
+
+    Args:
+        argv (Optional[Sequence[str]], optional): Arguments, excluding the program name. Defaults to the process arguments.
+
+    Returns:
+        int: Exit status of the command.
+    """
+    parser = argparse.ArgumentParser(
+        prog="exfer", description="Inference through local and external providers."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser(
+        "serve",
+        help="run an OpenAI-compatible gateway shared by many processes",
+        description="Runs an OpenAI-compatible HTTP gateway in front of a single Exfer instance, so that "
+        "processes share its connection pools, model catalog, admission queues and cache.",
+    )
+    serve.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    serve.add_argument("--port", type=int, default=8080, help="port to listen on")
+    _add_exfer_arguments(serve)
+    serve.set_defaults(run=_serve)
+
+    run = commands.add_parser(
+        "run",
+        help="generate completions for the prompts of a JSONL file",
+        description="Generates completions for the prompts of a JSONL file, one string or object with a "
+        "`prompt` per line, writing one result per line to another JSONL file. The job is checkpointed, so "
+        "running the same command again after it was interrupted resumes where it left off. Exits with status 2 "
+        "if any prompt failed, its error being written in place of the result.",
+    )
+    run.add_argument("model", help="key of the model to use")
+    run.add_argument("input", help="JSONL file of prompts")
+    run.add_argument("output", help="JSONL file of results")
+    run.add_argument(
+        "--concurrency",
+        type=int,
+        metavar="N",
+        help="requests to run at once (default: the pool size of the providers)",
+    )
+    run.add_argument(
+        "--unordered",
+        action="store_true",
+        help="write results in completion order rather than input order",
+    )
+    run.add_argument("--system-prompt", help="system prompt used for every prompt")
+    run.add_argument(
+        "--options",
+        type=json.loads,
+        metavar="JSON",
+        help="generation options used for every prompt, such as temperature",
+    )
+    run.add_argument(
+        "--priority",
+        type=_priority,
+        default="batch",
+        help="admission priority of the requests, a number or a name such as interactive "
+        "(default: %(default)s)",
+    )
+    run.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=10.0,
+        metavar="SECONDS",
+        help="seconds between checkpoints (default: %(default)s)",
+    )
+    run.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the checkpoint of a previous run and start over",
+    )
+    _add_exfer_arguments(run)
+    run.set_defaults(run=_run)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.run(args)
+    except KeyboardInterrupt:
+        return 130
+
+
+def _add_exfer_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the arguments configuring the `Exfer` instance of a command."""
+    group = parser.add_argument_group("providers")
+    group.add_argument(
+        "--ollama",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="Ollama server to use, may be repeated (default: discover the local providers)",
+    )
+    group.add_argument(
+        "--lmstudio",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="LM Studio server to use, may be repeated",
+    )
+    group.add_argument(
+        "--discovery-timeout",
+        type=float,
+        default=2.0,
+        metavar="SECONDS",
+        help="deadline for discovering the local providers (default: %(default)s)",
+    )
+    group.add_argument(
+        "--snapshot",
+        metavar="PATH",
+        help="discovery snapshot to reuse and keep up to date",
+    )
+    group.add_argument(
+        "--refresh-interval",
+        type=float,
+        metavar="SECONDS",
+        help="refresh the providers' models in the background",
+    )
+    group.add_argument(
+        "--cache",
+        type=int,
+        default=0,
+        metavar="ENTRIES",
+        help="responses kept in a cache shared by every provider (default: no cache)",
+    )
+    group.add_argument(
+        "--single-flight",
+        action="store_true",
+        help="coalesce concurrent identical requests",
+    )
+    group.add_argument(
+        "--max-concurrency",
+        type=int,
+        metavar="N",
+        help="requests each provider runs at once, queueing the rest by priority",
+    )
+    group.add_argument(
+        "--max-queue",
+        type=int,
+        metavar="N",
+        help="requests each provider queues before rejecting more",
+    )
+
+
+def _priority(value: str) -> int:
+    """Parses a priority given as a number, or as the name of a `Priority`."""
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        return Priority[value.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"unknown priority {value}")
+
+
+def _build_exfer(args: argparse.Namespace) -> Exfer:
+    """Builds the `Exfer` instance configured by the arguments."""
+    single_flight = SingleFlight() if args.single_flight else None
+    if args.ollama or args.lmstudio:
+        providers: list[Provider] = []
+        for provider_type, urls in ((Ollama, args.ollama), (LMStudio, args.lmstudio)):
+            for index, url in enumerate(urls):
+                provider = provider_type(url)
+                if len(urls) > 1:
+                    provider.key_override = f"{provider.key}-{index + 1}"
+                providers.append(provider)
+        exfer = Exfer(providers, single_flight=single_flight)
+        exfer.snapshot_path = args.snapshot
+        exfer.refresh_models(timeout=args.discovery_timeout)
+        if args.refresh_interval is not None:
+            exfer.start_refresh(args.refresh_interval)
+    else:
+        exfer = Exfer.from_env(
+            timeout=args.discovery_timeout,
+            snapshot_path=args.snapshot,
+            refresh_interval=args.refresh_interval,
+            single_flight=single_flight,
+        )
+
+    cache = LRUCache(args.cache) if args.cache > 0 else None
+    for provider in exfer.providers.values():
+        if cache is not None:
+            provider.cache = cache
+        if args.max_concurrency is not None or args.max_queue is not None:
+            provider.admission = AdmissionController(
+                max_concurrency=args.max_concurrency, max_queue=args.max_queue
+            )
+    return exfer
+
+
+def _serve(args: argparse.Namespace) -> int:
+    from .gateway import Gateway
+
+    exfer = _build_exfer(args)
+    if not exfer.providers:
+        print("exfer: no providers found", file=sys.stderr)
+        return 1
+    gateway = Gateway(exfer, args.host, args.port)
+
+    async def run() -> None:
+        async with gateway:
+            models = ", ".join(sorted(model.key for model in exfer.models)) or "none"
+            print(
+                f"exfer: serving {len(exfer.providers)} providers at {gateway.url} (models: {models})",
+                file=sys.stderr,
+            )
+            await gateway.serve_forever()
+
+    try:
+        asyncio.run(run())
+    finally:
+        exfer.stop_refresh()
+    return 0
+
+
+def _run(args: argparse.Namespace) -> int:
+    exfer = _build_exfer(args)
+
+    def report(progress: JSONLProgress) -> None:
+        print(
+            f"exfer: {progress.completed} done, {progress.failed} failed",
+            file=sys.stderr,
+        )
+
+    try:
+        progress = exfer.generate_jsonl(
+            args.model,
+            args.input,
+            args.output,
+            system_prompt=args.system_prompt,
+            max_workers=args.concurrency,
+            ordered=not args.unordered,
+            options=args.options,
+            priority=args.priority,
+            checkpoint_interval=args.checkpoint_interval,
+            resume=not args.restart,
+            on_progress=report,
+        )
+    except (
+        ModelNotFoundException,
+        ProviderNotFoundException,
+        ValueError,
+        OSError,
+    ) as error:
+        print(f"exfer: {error}", file=sys.stderr)
+        return 1
+    finally:
+        exfer.stop_refresh()
+    return 0 if progress.failed == 0 else 2
@@ -0,0 +1,122 @@
+import os
+from typing import TYPE_CHECKING, Any, Iterator, Optional, Sequence, Union
+
+from .transport import TransportException
+
+if TYPE_CHECKING:
+    import numpy
+
+EmbeddingOutput = Union[str, os.PathLike, "numpy.ndarray"]
+"""Destination of the embeddings, given as either the path of a `.npy` file to create as a memory-mapped array, or an
+existing float32 array (which may itself be memory-mapped) with one row per input."""
+
+
+def _numpy() -> Any:
+    """Imports NumPy, which is only needed for embeddings."""
+    try:
+        import numpy
+    except ImportError as error:
+        raise ImportError(
+            "embeddings require NumPy, install it with `pip install exfer[numpy]`"
+        ) from error
+    return numpy
+
+
+def batch_ranges(
+    texts: Sequence[str], batch_size: int, max_batch_chars: int
+) -> Iterator[tuple[int, int]]:
+    """Splits the inputs into consecutive batches of at most `batch_size` inputs, starting a new batch early once
+    the next input would take it past `max_batch_chars`. An input longer than `max_batch_chars` is sent on its own.
+
+    Args:
+        texts (Sequence[str]): Inputs to split.
+        batch_size (int): Maximum number of inputs per batch.
+        max_batch_chars (int): Maximum combined length of the inputs per batch.
+
+    Yields:
+        tuple[int, int]: Start and end index of each batch.
+    """
+    start = 0
+    chars = 0
+    for index, text in enumerate(texts):
+        if index > start and (
+            index - start >= batch_size or chars + len(text) > max_batch_chars
+        ):
+            yield start, index
+            start = index
+            chars = 0
+        chars += len(text)
+    if start < len(texts):
+        yield start, len(texts)
+
+
+class EmbeddingWriter:
+    """Copies each batch of embeddings into a single contiguous float32 array as it arrives, so that only one
+    batch is ever held as Python floats. The array is allocated once the first batch reveals the dimensions.
+    """
+
+    count: int
+    """Number of inputs, and so rows of the array."""
+
+    def __init__(self, count: int, out: Optional[EmbeddingOutput] = None):
+        """Constructs a new writer.
+
+        Args:
+            count (int): Number of inputs being embedded.
+            out (Optional[EmbeddingOutput], optional): Destination of the embeddings. Defaults to None, which allocates a new array in memory.
+        """
+        self._numpy = _numpy()
+        self.count = count
+        self._out = out
+        self._array: Optional["numpy.ndarray"] = None
+
+    def _allocate(self, dimensions: int) -> "numpy.ndarray":
+        numpy = self._numpy
+        out = self._out
+        if out is None:
+            return numpy.empty((self.count, dimensions), dtype=numpy.float32)
+        if isinstance(out, numpy.ndarray):
+            if out.shape != (self.count, dimensions) or out.dtype != numpy.float32:
+                raise ValueError(
+                    f"output array must be float32 with shape {(self.count, dimensions)}, not {out.dtype} with shape {out.shape}"
+                )
+            return out
+        return numpy.lib.format.open_memmap(
+            os.fspath(out),
+            mode="w+",
+            dtype=numpy.float32,
+            shape=(self.count, dimensions),
+        )
+
+    def write(self, start: int, end: int, embeddings: list[list[float]]) -> None:
+        """Stores the embeddings of a batch.
+
+        Args:
+            start (int): Index of the batch's first input.
+            end (int): Index after the batch's last input.
+            embeddings (list[list[float]]): Embedding of each input in the batch, as returned by the provider.
+
+        Raises:
+            TransportException: If the embeddings don't match the batch, or the dimensions of the previous batches.
+        """
+        batch = self._numpy.asarray(embeddings, dtype=self._numpy.float32)
+        if batch.ndim != 2 or len(batch) != end - start:
+            raise TransportException(
+                f"provider returned embeddings of shape {batch.shape} for {end - start} inputs"
+            )
+        if self._array is None:
+            self._array = self._allocate(batch.shape[1])
+        elif batch.shape[1] != self._array.shape[1]:
+            raise TransportException(
+                f"provider returned embeddings of {batch.shape[1]} dimensions, after {self._array.shape[1]}"
+            )
+        self._array[start:end] = batch
+
+    def result(self) -> "numpy.ndarray":
+        """The embeddings of every input, flushed to disk if memory-mapped."""
+        if self._array is None:
+            # Nothing was embedded, so the dimensions are unknown.
+            self._array = self._allocate(0)
+        if isinstance(self._array, self._numpy.memmap):
+            self._array.flush()
+        return self._array
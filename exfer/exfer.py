@@ -1,25 +1,99 @@
-from typing import Optional, Union
-from .provider import Provider
+import json
+import threading
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Generator,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    TypeVar,
+    Union,
+    overload,
+)
+
+from .provider import Provider, ModelNotFoundException, aload_json, json_options
 from .model import Model
+from .capabilities import Capability
+from .catalog import ModelCatalog
+from .batch import BatchResult, JSONLProgress, run_batch, run_jsonl
+from .routing import Router, RoundRobinRouter
+from .stream import AsyncTextStream, TextStream
+from .instrumentation import Instrumentation
+from .singleflight import SingleFlight
+from .admission import Priority, admission_priority
+from .warm import WarmSet
+from .hedging import HedgePolicy, ahedge, hedge
+from .transport import TransportException
+from .embedding import EmbeddingOutput
 
 from .ollama import Ollama
 from .lmstudio import LMStudio
+from .utils import ImageInput, read_snapshot, write_snapshot
+
+if TYPE_CHECKING:
+    import numpy
+
+T = TypeVar("T")
+
+_BATCH_ITEM_KEYS = frozenset({"prompt", "system_prompt", "images", "options"})
+"""Arguments of `Exfer.generate()` that a batch item can set. Streaming, and the provider, apply to the whole batch."""
+
+
+class ProviderNotFoundException(Exception):
+    pass
 
 
 class Exfer:
     """Class which holds data-structures for managing and mapping different providers and models."""
 
-    providers: dict[str, Provider] = {}
+    providers: dict[str, Provider]
     """Dictionary of available providers which have been setup and can be used for further requests. Key is the provider's key, and the value is the provider itself. """
 
-    models: set[Model] = set()
-    """List of all available models that have been propagated from the providers. """
+    catalog: ModelCatalog
+    """Index of all available models that have been propagated from the providers, and which providers serve them. """
+
+    provider_types: list[type[Provider]] = [LMStudio, Ollama]
+    """Provider types which are checked for when populating from the environment. """
+
+    router: Router
+    """Strategy used to choose between multiple providers that serve the same model. """
+
+    loaded_weight: int = 2
+    """Weight of the providers which already have a model loaded when routing a request for it, relative to 1 for the others. They are chosen more often to avoid cold starts, without taking all of the requests."""
+
+    instrumentation: Optional[Instrumentation] = None
+    """Hooks observing the generation calls, given to registered providers that have none of their own."""
+
+    single_flight: Optional[SingleFlight] = None
+    """Coalescing of concurrent identical requests, given to registered providers that have none of their own. Being shared, identical requests routed to different providers of the same model are coalesced as well."""
 
-    model_providers: dict[str, Union[str, set[str]]] = {}
-    """Mapping dictionary of all model-keys to their respective providers. The key is the model key, and the value is an ordered list of the providers that can use them. """
+    warm_set: Optional[WarmSet] = None
+    """Policy keeping the most requested models loaded by their providers. Requests are recorded to it, and it is applied by `Exfer.maintain_warm_set()`."""
+
+    hedging: Optional[HedgePolicy] = None
+    """Policy duplicating slow requests to a second provider of the same model. Only applies to requests that don't specify their provider."""
+
+    snapshot_path: Optional[str] = None
+    """Filepath of the discovery snapshot, which is kept up to date with the providers and their models when set. """
 
     @classmethod
-    def from_env(cls):
+    def from_env(
+        cls,
+        timeout: float = 1.0,
+        snapshot_path: Optional[str] = None,
+        snapshot_ttl: float = 300.0,
+        refresh_interval: Optional[float] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ):
         """Constructs a new Exfer instance. Will attempt to automatically populate the providers based
         on the process environment. For local providers it will ping the common ports and known API endpoints
         to check for existence. For external third-party providers it will iterate the environment variables
@@ -27,49 +101,67 @@ class Exfer:
 
         See: Exfer.populate_from_env() for implementation details.
 
+        Args:
+            timeout (float, optional): Overall deadline in seconds for checking all providers. Defaults to 1.0.
+            snapshot_path (Optional[str], optional): Filepath of a discovery snapshot to reuse, and update. Defaults to None.
+            snapshot_ttl (float, optional): Seconds a discovery snapshot remains valid for. Defaults to 300.0.
+            refresh_interval (Optional[float], optional): Seconds between background refreshes of the providers' models. See `Exfer.start_refresh()`. Defaults to None, which does not refresh.
+            instrumentation (Optional[Instrumentation], optional): Hooks given to the discovered providers. Defaults to None.
+            single_flight (Optional[SingleFlight], optional): Coalescing of concurrent identical requests, given to the discovered providers. Defaults to None.
+
         Returns:
             Exfer: pre-populated Exfer instance.
         """
-        instance = cls()
-        instance.populate_from_env()
+        instance = cls(instrumentation=instrumentation, single_flight=single_flight)
+        instance.populate_from_env(timeout, snapshot_path, snapshot_ttl)
+        if refresh_interval is not None:
+            instance.start_refresh(refresh_interval)
         return instance
 
-    def __init__(self, providers: list[Provider] = []):
+    def __init__(
+        self,
+        providers: list[Provider] = [],
+        router: Optional[Router] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        single_flight: Optional[SingleFlight] = None,
+        warm_set: Optional[WarmSet] = None,
+        hedging: Optional[HedgePolicy] = None,
+    ):
         """Constructs a new Exfer instance. Each provider given (optional) will be registered, including
         all of it's constituent Models it provides for. These will be deduplicated.
 
         Args:
             providers (list[Provider], optional): List of providers to register. Defaults to [].
+            router (Optional[Router], optional): Strategy for choosing between providers of the same model. Defaults to a `RoundRobinRouter`.
+            instrumentation (Optional[Instrumentation], optional): Hooks given to the registered providers that have none. Defaults to None.
+            single_flight (Optional[SingleFlight], optional): Coalescing of concurrent identical requests, given to the registered providers that have none. Defaults to None.
+            warm_set (Optional[WarmSet], optional): Policy keeping the most requested models loaded. Defaults to None.
+            hedging (Optional[HedgePolicy], optional): Policy duplicating slow requests to a second provider. Defaults to None, which doesn't hedge.
         """
+        self.providers = {}
+        self.catalog = ModelCatalog()
+        self.router = router or RoundRobinRouter()
+        self.instrumentation = instrumentation
+        self.single_flight = single_flight
+        self.warm_set = warm_set
+        self.hedging = hedging
+        self._snapshot_lock = threading.Lock()
+        self._refresh_stop: Optional[threading.Event] = None
         for provider in providers:
             self.register_provider(provider)
 
-    def _add_model(self, model: Model, provider_key: str) -> None:
-        """Adds a model to the internal `self.models` and `self.model_providers` mappings while maintaining the data types and uniqueness."""
-        self.models.add(model)
-        if model.key in self.model_providers:
-            current = self.model_providers[model.key]
-            if type(current) is set:
-                current.add(provider_key)
-            elif type(current) is str:
-                self.model_providers[model.key] = set([current, provider_key])
-        else:
-            self.model_providers[model.key] = provider_key
-
-    def _remove_model(self, model: Union[str, Model]) -> None:
-        """Removes a model from the internal `self.models` and `self.model_providers` mappings."""
-        self.models = {existing for existing in self.models if existing != model}
-
-        key = model.key if isinstance(model, Model) else model
-        if key in self.model_providers:
-            current = self.model_providers[key]
-            if type(current) is set:
-                current.remove(key)
-                if len(current) == 1:
-                    current = current.pop()
-                self.model_providers[key] = current
-            elif type(current) is str:
-                del self.model_providers[key]
+    @property
+    def models(self) -> set[Model]:
+        """Set of all available models that have been propagated from the providers."""
+        return set(self.catalog.models())
+
+    @property
+    def model_providers(self) -> dict[str, set[str]]:
+        """Mapping dictionary of all model-keys to their respective providers. The key is the model key, and the value is the set of the providers that can use them."""
+        return {
+            key: set(self.catalog.providers_for(key))
+            for key in self.catalog.model_keys()
+        }
 
     def register_provider(self, provider: Provider) -> bool:
         """Adds a provider and all of the models it provides to the internal mappings. This will deduplicate based on the keys.
@@ -87,10 +179,14 @@ class Exfer:
 
         # Register the provider to the key
         self.providers[provider.key] = provider
+        if provider.instrumentation is None:
+            provider.instrumentation = self.instrumentation
+        if provider.single_flight is None:
+            provider.single_flight = self.single_flight
 
         # Add any models it provides
         for model in provider.models_list:
-            self._add_model(model, provider.key)
+            self.catalog.add(model, provider.key)
 
         return not exists
 
@@ -106,8 +202,7 @@ class Exfer:
         key = provider.key if isinstance(provider, Provider) else provider
         if key in self.providers:
             # First we need to remove any models it registered.
-            for model in self.providers[key].models_list:
-                self._remove_model(model)
+            self.catalog.remove_provider(key)
 
             # Then we can delete the provider entry
             del self.providers[key]
@@ -116,7 +211,12 @@ class Exfer:
             return True
         return False
 
-    def populate_from_env(self):
+    def populate_from_env(
+        self,
+        timeout: float = 1.0,
+        snapshot_path: Optional[str] = None,
+        snapshot_ttl: float = 300.0,
+    ) -> None:
         """Populates this `Exfer` instance will all the known available providers by checking the current system environment.
 
         For local providers like `LMStudio`, `Ollama`:
@@ -124,8 +224,902 @@ class Exfer:
 
         For external providers like `OpenAI`, `Google`, `Anthropic`, etc:
             Checks for environment variables that commonly hold their API keys.
+
+        All of the `provider_types` are checked concurrently, and any that have not responded by the deadline
+        are treated as unavailable. The models of the discovered providers are then listed concurrently within
+        the same deadline, and providers that are slower to respond have their models added once they do.
+
+        When a `snapshot_path` is given, the discovered providers and their models are saved to it, and later
+        calls within the `snapshot_ttl` will use the snapshot instead of checking again. This avoids blocking
+        on the providers' APIs at startup. A snapshot without any providers is not reused, so that providers
+        started after an empty discovery are found by the next call. The snapshot is updated whenever the models are refreshed.
+
+        Args:
+            timeout (float, optional): Overall deadline in seconds for checking all providers. Defaults to 1.0.
+            snapshot_path (Optional[str], optional): Filepath of a discovery snapshot to reuse, and update. Defaults to None.
+            snapshot_ttl (float, optional): Seconds a discovery snapshot remains valid for. Defaults to 300.0.
+        """
+        if snapshot_path is not None:
+            self.snapshot_path = snapshot_path
+            snapshot = read_snapshot(snapshot_path, snapshot_ttl)
+            if snapshot is not None and self._populate_from_snapshot(snapshot):
+                return
+
+        deadline = time.monotonic() + timeout
+        found = self._discover_provider_types(timeout)
+        providers = [provider_type.from_env() for provider_type in found]
+        for provider in providers:
+            self.register_provider(provider)
+
+        self.refresh_models(providers, timeout=max(0.0, deadline - time.monotonic()))
+        self.save_snapshot()
+
+    def _discover_provider_types(self, timeout: float) -> list[type[Provider]]:
+        """Concurrently runs `check_env()` for all of the `provider_types`, returning those which succeeded within the timeout."""
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.provider_types)))
+        try:
+            futures = {
+                executor.submit(provider_type.check_env, timeout): provider_type
+                for provider_type in self.provider_types
+            }
+            done, _ = wait(futures, timeout=timeout)
+        finally:
+            # Stragglers are abandoned instead of waited on, they will finish on their own socket timeout.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Keep the declared ordering so registration is deterministic.
+        return [
+            provider_type
+            for future, provider_type in futures.items()
+            if future in done and future.exception() is None and future.result()
+        ]
+
+    def _populate_from_snapshot(self, snapshot: list[dict]) -> bool:
+        """Registers the providers, and their models, recorded in a discovery snapshot. Returns False if the snapshot does not match the known `provider_types`, or is empty."""
+        if not snapshot:
+            return False
+        types = {
+            provider_type.__name__: provider_type
+            for provider_type in self.provider_types
+        }
+        try:
+            providers = []
+            for entry in snapshot:
+                provider = types[entry["type"]](
+                    entry["base_url"], key_override=entry.get("key")
+                )
+                for data in entry.get("models", ()):
+                    provider.register_model(Model.from_dict(data))
+                providers.append(provider)
+        except (KeyError, TypeError, ValueError):
+            return False
+        for provider in providers:
+            self.register_provider(provider)
+        return True
+
+    def save_snapshot(self) -> None:
+        """Writes the registered providers and their models to the `snapshot_path`, if one is set."""
+        if self.snapshot_path is None:
+            return
+        with self._snapshot_lock:
+            write_snapshot(
+                self.snapshot_path,
+                [
+                    {
+                        "type": type(provider).__name__,
+                        "base_url": provider.base_url,
+                        "key": provider.key_override,
+                        "models": [model.to_dict() for model in provider.models_list],
+                    }
+                    for provider in list(self.providers.values())
+                ],
+            )
+
+    def refresh_models(
+        self,
+        providers: Optional[Iterable[Union[str, Provider]]] = None,
+        max_age: Optional[float] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """Lists the models of the registered providers from their APIs, and applies any changes to the catalog.
+        Only the models which were added, changed or removed are updated, the providers stay registered.
+
+        Providers that cannot be reached keep their previous models, and are marked as unhealthy until a
+        later refresh succeeds. Providers are refreshed concurrently.
+
+        Args:
+            providers (Optional[Iterable[Union[str, Provider]]], optional): Keys of providers, or the providers themselves, to refresh. Defaults to all registered providers.
+            max_age (Optional[float], optional): Only refresh providers whose models were last refreshed more than this many seconds ago. Defaults to None, which refreshes regardless.
+            timeout (Optional[float], optional): Seconds to wait for the refreshes. Slower providers are still applied once they respond. Defaults to None, which waits for all of them.
+        """
+        if providers is None:
+            targets = list(self.providers.values())
+        else:
+            targets = [
+                self.providers[
+                    provider.key if isinstance(provider, Provider) else provider
+                ]
+                for provider in providers
+            ]
+        if max_age is not None:
+            now = time.monotonic()
+            targets = [
+                provider
+                for provider in targets
+                if provider.models_refreshed is None
+                or now - provider.models_refreshed >= max_age
+            ]
+        if not targets:
+            return
+
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        executor = ThreadPoolExecutor(max_workers=len(targets))
+        try:
+            futures = [
+                executor.submit(self._refresh_provider, provider)
+                for provider in targets
+            ]
+            wait(futures, timeout=timeout)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _refresh_provider(self, provider: Provider) -> None:
+        """Refreshes the models of a single provider and diffs the result into the catalog."""
+        try:
+            changed, removed = provider.refresh_models()
+        except TransportException:
+            self.catalog.set_healthy(provider.key, False)
+            return
+
+        # The provider may have been unregistered, or replaced, while its models were listed.
+        if self.providers.get(provider.key) is not provider:
+            return
+        for model in removed:
+            self.catalog.remove(model, provider.key)
+        for model in changed:
+            self.catalog.add(model, provider.key)
+        self.catalog.set_healthy(provider.key, True)
+        if changed or removed:
+            self.save_snapshot()
+
+    def start_refresh(self, interval: float) -> None:
+        """Starts refreshing the providers' models in a background thread. Each provider is refreshed once its
+        models are older than the interval, beginning with any that have never been refreshed, such as those
+        loaded from a snapshot. See `Exfer.refresh_models()`. Which models are loaded is refreshed each interval
+        too, and the `warm_set` maintained if there is one.
+
+        Args:
+            interval (float): Seconds between refreshes.
+        """
+        self.stop_refresh()
+        stop = threading.Event()
+        self._refresh_stop = stop
+
+        def run() -> None:
+            while not stop.is_set():
+                self.refresh_models(max_age=interval)
+                self.refresh_loaded()
+                if self.warm_set is not None:
+                    self.maintain_warm_set()
+                stop.wait(interval)
+
+        threading.Thread(target=run, name="exfer-refresh", daemon=True).start()
+
+    def refresh_loaded(
+        self, providers: Optional[Iterable[Union[str, Provider]]] = None
+    ) -> None:
+        """Updates which models the providers have loaded, which requests are routed by. See `Provider.refresh_loaded()`.
+        Providers that cannot be reached are skipped.
+
+        Args:
+            providers (Optional[Iterable[Union[str, Provider]]], optional): Keys of providers, or the providers themselves, to refresh. Defaults to all registered providers.
         """
-        if LMStudio.check_env():
-            self.register_provider(LMStudio.from_env())
-        if Ollama.check_env():
-            self.register_provider(Ollama.from_env())
+        if providers is None:
+            targets = list(self.providers.values())
+        else:
+            targets = [
+                self.providers[
+                    provider.key if isinstance(provider, Provider) else provider
+                ]
+                for provider in providers
+            ]
+        for provider in targets:
+            try:
+                provider.refresh_loaded()
+            except TransportException:
+                continue
+
+    def maintain_warm_set(self) -> list[str]:
+        """Preloads the models of the `warm_set`. A model already loaded by some of its providers has its keep
+        alive extended on those, otherwise it is loaded by the provider the router chooses. Providers that
+        can't preload, or can't be reached, are skipped.
+
+        Returns:
+            list[str]: Keys of the models which are loaded.
+        """
+        if self.warm_set is None:
+            return []
+        warm: list[str] = []
+        for model_key in self.warm_set.top():
+            try:
+                candidates = self.get_providers(model_key)
+            except ModelNotFoundException:
+                continue
+            targets = [
+                provider for provider in candidates if provider.is_loaded(model_key)
+            ]
+            if not targets:
+                targets = [self.router.select(model_key, candidates)]
+            for provider in targets:
+                try:
+                    if provider.preload(model_key, self.warm_set.keep_alive):
+                        warm.append(model_key)
+                except TransportException:
+                    continue
+        return list(dict.fromkeys(warm))
+
+    def stop_refresh(self) -> None:
+        """Stops the background refresh started with `Exfer.start_refresh()`, if any."""
+        if self._refresh_stop is not None:
+            self._refresh_stop.set()
+            self._refresh_stop = None
+
+    def get_provider(
+        self, model: Union[str, Model], provider: Optional[Union[str, Provider]] = None
+    ) -> Provider:
+        """Resolves the provider to use for a given model. If a provider is specified it will be used as-is,
+        otherwise the router chooses between the registered providers that have the model available. Providers
+        which already have the model loaded are weighted by `loaded_weight`, to avoid cold starts.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+
+        Raises:
+            ProviderNotFoundException: If the given provider is not registered.
+            ModelNotFoundException: If no provider was given, and no registered provider has the model available.
+
+        Returns:
+            Provider: The provider to issue the request to.
+        """
+        if provider is not None:
+            key = provider.key if isinstance(provider, Provider) else provider
+            if key not in self.providers:
+                raise ProviderNotFoundException(f"provider {key} is not registered")
+            return self.providers[key]
+
+        candidates = self.get_providers(model)
+        if len(candidates) == 1:
+            return candidates[0]
+        return self._route(model, candidates)
+
+    def _route(self, model: Union[str, Model], candidates: list[Provider]) -> Provider:
+        """Has the router choose between the candidates, repeating those with the model loaded by `loaded_weight`."""
+        model_key = model.key if isinstance(model, Model) else model
+        weighted: list[Provider] = []
+        for provider in candidates:
+            repeats = self.loaded_weight if provider.is_loaded(model_key) else 1
+            weighted.extend([provider] * repeats)
+        return self.router.select(model_key, weighted)
+
+    def get_providers(self, model: Union[str, Model]) -> list[Provider]:
+        """Lists all of the registered providers that have a given model available, in the order they were registered.
+        Providers marked as unhealthy are left out, unless there are no healthy providers for the model.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+
+        Raises:
+            ModelNotFoundException: If no registered provider has the model available.
+
+        Returns:
+            list[Provider]: Providers serving the model.
+        """
+        keys = self.catalog.providers_for(model, healthy_only=True)
+        if not keys:
+            keys = self.catalog.providers_for(model)
+        if not keys:
+            raise ModelNotFoundException(
+                f"model {model.key if isinstance(model, Model) else model} is not available from any registered provider"
+            )
+        return [self.providers[key] for key in keys]
+
+    def find_models(
+        self,
+        capabilities: Union[str, Capability, Sequence[Union[str, Capability]]] = (),
+        healthy_only: bool = True,
+    ) -> list[Model]:
+        """Finds the available models which have all of the given capabilities.
+
+        Args:
+            capabilities (Union[str, Capability, Sequence[Union[str, Capability]]], optional): Capabilities the models must have. Defaults to (), which matches every model.
+            healthy_only (bool, optional): Only include models served by at least one healthy provider. Defaults to True.
+
+        Returns:
+            list[Model]: The matching models.
+        """
+        return [
+            self.catalog.get(key)
+            for key in self.catalog.query(capabilities, healthy_only)
+        ]
+
+    def set_provider_health(
+        self, provider: Union[str, Provider], healthy: bool = True
+    ) -> None:
+        """Marks a provider as healthy or unhealthy. Requests avoid unhealthy providers while a healthy one serves the model.
+
+        Args:
+            provider (Union[str, Provider]): Either the key of the provider, or the Provider object itself.
+            healthy (bool, optional): Whether the provider is healthy. Defaults to True.
+        """
+        self.catalog.set_healthy(
+            provider.key if isinstance(provider, Provider) else provider, healthy
+        )
+
+    def _track(
+        self, provider: Provider, model: Union[str, Model], call: Callable[[], T]
+    ) -> T:
+        """Runs a request against the provider, reporting it to the router."""
+        model_key = model.key if isinstance(model, Model) else model
+        self.router.on_start(provider, model_key)
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            self.router.on_finish(provider, model_key, time.perf_counter() - start, e)
+            raise
+        self.router.on_finish(provider, model_key, time.perf_counter() - start)
+        return result
+
+    def _track_stream(
+        self, provider: Provider, model: Union[str, Model], stream: Iterator[str]
+    ) -> Generator[str]:
+        """Passes through a fragment stream from the provider, reporting it to the router once exhausted or closed."""
+        model_key = model.key if isinstance(model, Model) else model
+        self.router.on_start(provider, model_key)
+        start = time.perf_counter()
+        error: Optional[Exception] = None
+        try:
+            yield from stream
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.router.on_finish(
+                provider, model_key, time.perf_counter() - start, error
+            )
+
+    async def _atrack(
+        self,
+        provider: Provider,
+        model: Union[str, Model],
+        call: Coroutine[None, None, T],
+    ) -> T:
+        """Awaits a request against the provider, reporting it to the router."""
+        model_key = model.key if isinstance(model, Model) else model
+        self.router.on_start(provider, model_key)
+        start = time.perf_counter()
+        try:
+            result = await call
+        except Exception as e:
+            self.router.on_finish(provider, model_key, time.perf_counter() - start, e)
+            raise
+        self.router.on_finish(provider, model_key, time.perf_counter() - start)
+        return result
+
+    async def _atrack_stream(
+        self,
+        provider: Provider,
+        model: Union[str, Model],
+        stream: AsyncIterator[str],
+    ) -> AsyncGenerator[str]:
+        """Passes through an async fragment stream from the provider, reporting it to the router once exhausted or closed."""
+        model_key = model.key if isinstance(model, Model) else model
+        self.router.on_start(provider, model_key)
+        start = time.perf_counter()
+        error: Optional[Exception] = None
+        try:
+            async for fragment in stream:
+                yield fragment
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.router.on_finish(
+                provider, model_key, time.perf_counter() - start, error
+            )
+
+    def _alternates(
+        self, model: Union[str, Model], primary: Provider
+    ) -> list[Provider]:
+        """Lists the providers a request to the primary could be hedged to."""
+        return [
+            provider
+            for provider in self.get_providers(model)
+            if provider is not primary
+        ]
+
+    async def _ajoin(self, stream: AsyncTextStream) -> str:
+        return "".join([fragment async for fragment in stream])
+
+    @overload
+    def generate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[False] = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> str: ...
+
+    @overload
+    def generate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[True],
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> TextStream: ...
+
+    def generate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> Union[str, TextStream]:
+        """Generate a text completion using the first provider that has the model available, or the given provider.
+
+        See: Provider.generate_text() for details.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[str, TextStream]: Either the complete response, or a stream which yields fragments (requires stream = True).
+        """
+        target = self.get_provider(model, provider)
+        if self.warm_set is not None:
+            self.warm_set.record(model.key if isinstance(model, Model) else model)
+        if self.hedging is not None and provider is None:
+            alternates = self._alternates(model, target)
+            if alternates:
+                hedged = hedge(
+                    self.hedging,
+                    model.key if isinstance(model, Model) else model,
+                    target,
+                    lambda: self._route(model, alternates),
+                    lambda attempted: attempted.generate_text(
+                        model, prompt, True, system_prompt, images, options
+                    ).pipe(
+                        lambda fragments: self._track_stream(
+                            attempted, model, fragments
+                        )
+                    ),
+                )
+                return hedged if stream else "".join(hedged)
+        if stream:
+            return target.generate_text(
+                model, prompt, True, system_prompt, images, options
+            ).pipe(lambda fragments: self._track_stream(target, model, fragments))
+        return self._track(
+            target,
+            model,
+            lambda: target.generate_text(
+                model, prompt, False, system_prompt, images, options
+            ),
+        )
+
+    @overload
+    def agenerate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[False] = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> Coroutine[None, None, str]: ...
+
+    @overload
+    def agenerate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[True],
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> AsyncTextStream: ...
+
+    def agenerate(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        """Generate a text completion using asyncio. Mirrors `Exfer.generate()`.
+
+        See: Provider.agenerate_text() for details.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[Coroutine[None, None, str], AsyncTextStream]: Either a coroutine resolving to the complete response, or an async stream which yields fragments (requires stream = True).
+        """
+        target = self.get_provider(model, provider)
+        if self.warm_set is not None:
+            self.warm_set.record(model.key if isinstance(model, Model) else model)
+        if self.hedging is not None and provider is None:
+            alternates = self._alternates(model, target)
+            if alternates:
+                hedged = ahedge(
+                    self.hedging,
+                    model.key if isinstance(model, Model) else model,
+                    target,
+                    lambda: self._route(model, alternates),
+                    lambda attempted: attempted.agenerate_text(
+                        model, prompt, True, system_prompt, images, options
+                    ).pipe(
+                        lambda fragments: self._atrack_stream(
+                            attempted, model, fragments
+                        )
+                    ),
+                )
+                return hedged if stream else self._ajoin(hedged)
+        if stream:
+            return target.agenerate_text(
+                model, prompt, True, system_prompt, images, options
+            ).pipe(lambda fragments: self._atrack_stream(target, model, fragments))
+        return self._atrack(
+            target,
+            model,
+            target.agenerate_text(model, prompt, False, system_prompt, images, options),
+        )
+
+    def generate_json(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        schema: Optional[dict] = None,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Any, TextStream]:
+        """Generate structured output using the first provider that has the model available, or the given provider.
+
+        See: Provider.generate_json() for details.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            schema (Optional[dict], optional): JSON schema of the response. Defaults to None, which allows any JSON.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Raises:
+            ValueError: If the response is not valid JSON.
+
+        Returns:
+            Union[Any, TextStream]: Either the decoded response, or a stream of the response text, whose `json()` emits values as they complete (requires stream = True).
+        """
+        options = json_options(schema, options)
+        if stream:
+            return self.generate(
+                model, prompt, True, system_prompt, images, provider, options
+            )
+        return json.loads(
+            self.generate(
+                model, prompt, False, system_prompt, images, provider, options
+            )
+        )
+
+    def agenerate_json(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        schema: Optional[dict] = None,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Coroutine[None, None, Any], AsyncTextStream]:
+        """Generate structured output using asyncio. Mirrors `Exfer.generate_json()`.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            schema (Optional[dict], optional): JSON schema of the response. Defaults to None, which allows any JSON.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[Coroutine[None, None, Any], AsyncTextStream]: Either a coroutine resolving to the decoded response, or an async stream of the response text (requires stream = True).
+        """
+        options = json_options(schema, options)
+        if stream:
+            return self.agenerate(
+                model, prompt, True, system_prompt, images, provider, options
+            )
+        return aload_json(
+            self.agenerate(
+                model, prompt, False, system_prompt, images, provider, options
+            )
+        )
+
+    def embed(
+        self,
+        model: Union[str, Model],
+        inputs: Union[str, Sequence[str]],
+        batch_size: int = 64,
+        max_batch_chars: int = 32768,
+        out: Optional[EmbeddingOutput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+    ) -> "numpy.ndarray":
+        """Embeds the inputs using a provider that has the model available, or the given provider.
+
+        See: Provider.embed() for details.
+
+        Args:
+            model (Union[str, Model]): Either the key for the embedding model, or the model itself.
+            inputs (Union[str, Sequence[str]]): Text, or texts, to embed.
+            batch_size (int, optional): Maximum number of inputs per request. Defaults to 64.
+            max_batch_chars (int, optional): Maximum combined length of the inputs per request. Defaults to 32768.
+            out (Optional[EmbeddingOutput], optional): Path of a `.npy` file to write a memory-mapped result to, or a float32 array to fill. Defaults to None, which allocates a new array.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+
+        Returns:
+            numpy.ndarray: Contiguous float32 array with the embedding of each input as a row.
+        """
+        target = self.get_provider(model, provider)
+        return target.embed(model, inputs, batch_size, max_batch_chars, out)
+
+    async def aembed(
+        self,
+        model: Union[str, Model],
+        inputs: Union[str, Sequence[str]],
+        batch_size: int = 64,
+        max_batch_chars: int = 32768,
+        out: Optional[EmbeddingOutput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        concurrency: int = 1,
+    ) -> "numpy.ndarray":
+        """Embeds the inputs using asyncio. Mirrors `Exfer.embed()`.
+
+        See: Provider.aembed() for details.
+
+        Args:
+            model (Union[str, Model]): Either the key for the embedding model, or the model itself.
+            inputs (Union[str, Sequence[str]]): Text, or texts, to embed.
+            batch_size (int, optional): Maximum number of inputs per request. Defaults to 64.
+            max_batch_chars (int, optional): Maximum combined length of the inputs per request. Defaults to 32768.
+            out (Optional[EmbeddingOutput], optional): Path of a `.npy` file to write a memory-mapped result to, or a float32 array to fill. Defaults to None, which allocates a new array.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            concurrency (int, optional): Maximum number of batches in flight. Defaults to 1.
+
+        Returns:
+            numpy.ndarray: Contiguous float32 array with the embedding of each input as a row.
+        """
+        target = self.get_provider(model, provider)
+        return await target.aembed(
+            model, inputs, batch_size, max_batch_chars, out, concurrency
+        )
+
+    def generate_batch(
+        self,
+        model: Union[str, Model],
+        prompts: Iterable[Union[str, dict]],
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        max_workers: Optional[int] = None,
+        ordered: bool = True,
+        options: Optional[dict] = None,
+        priority: int = Priority.BATCH,
+    ) -> list[BatchResult]:
+        """Generate text completions for many prompts concurrently, collecting all of the results.
+
+        Each prompt can be a string, or a dictionary setting any of `prompt`, `system_prompt`, `images` and
+        `options`. Results are always complete strings, a prompt with any other key fails with a `ValueError`.
+
+        See: Exfer.generate_batch_iter() for details.
+
+        Returns:
+            list[BatchResult]: Result for every prompt. Failed prompts have their `error` set instead of failing the batch.
+        """
+        return list(
+            self.generate_batch_iter(
+                model,
+                prompts,
+                system_prompt,
+                images,
+                provider,
+                max_workers,
+                ordered,
+                options,
+                priority,
+            )
+        )
+
+    def generate_batch_iter(
+        self,
+        model: Union[str, Model],
+        prompts: Iterable[Union[str, dict]],
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        max_workers: Optional[int] = None,
+        ordered: bool = True,
+        options: Optional[dict] = None,
+        priority: int = Priority.BATCH,
+    ) -> Iterator[BatchResult]:
+        """Generate text completions for many prompts concurrently, yielding each result as it becomes available.
+        Prompts are consumed lazily, so large iterators can be used without loading them into memory.
+
+        Each prompt can be a string, or a dictionary of keyword arguments for `Exfer.generate()` (`prompt`,
+        `system_prompt`, `images`, `options`) which override the batch-wide defaults. Other arguments, such as
+        `stream`, can't be set per prompt, and fail that prompt with a `ValueError`.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompts (Iterable[Union[str, dict]]): Prompts to generate completions for.
+            system_prompt (str, optional): System prompt used for every prompt. Defaults to None.
+            images (ImageInput, optional): Image, or images, used for every prompt. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            max_workers (Optional[int], optional): Maximum concurrent requests. Defaults to the combined transport `pool_size` of the providers serving the model.
+            ordered (bool, optional): Yield results in input order, otherwise in completion order. Defaults to True.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+            priority (int, optional): Admission priority of the requests, for providers with an `AdmissionController`. Defaults to `Priority.BATCH`, yielding to other calls.
+
+        Yields:
+            BatchResult: Result of each prompt. Failed prompts have their `error` set instead of failing the batch.
+        """
+        if max_workers is None:
+            max_workers = self._batch_workers(model, provider)
+        generate = self._batch_generate(
+            model, system_prompt, images, provider, options, priority
+        )
+        return run_batch(generate, prompts, max_workers, ordered)
+
+    def generate_jsonl(
+        self,
+        model: Union[str, Model],
+        input_path: str,
+        output_path: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        provider: Optional[Union[str, Provider]] = None,
+        max_workers: Optional[int] = None,
+        ordered: bool = True,
+        options: Optional[dict] = None,
+        priority: int = Priority.BATCH,
+        checkpoint_interval: float = 10.0,
+        resume: bool = True,
+        on_progress: Optional[Callable[[JSONLProgress], None]] = None,
+    ) -> JSONLProgress:
+        """Generate text completions for the prompts of a JSONL file concurrently, writing them to another JSONL file.
+        The files are streamed, so memory use stays constant regardless of their size, and the job is checkpointed
+        to `<output_path>.checkpoint` so that running it again after a crash resumes where it left off.
+
+        Each input line is a prompt string, or an object of keyword arguments as for `Exfer.generate_batch_iter()`
+        (`prompt`, `system_prompt`, `images`, `options`), with an optional `id` copied to its output line. Each output line holds the `index` of its input line, the
+        `id` if any, and either the `response` or the `error`.
+
+        See: batch.run_jsonl() for the details of the files and checkpoints.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            input_path (str): Filepath of the input JSONL.
+            output_path (str): Filepath of the output JSONL.
+            system_prompt (str, optional): System prompt used for every prompt. Defaults to None.
+            images (ImageInput, optional): Image, or images, used for every prompt. Defaults to None.
+            provider (Optional[Union[str, Provider]], optional): Key of a provider, or the provider itself, to force its usage. Defaults to None.
+            max_workers (Optional[int], optional): Maximum concurrent requests. Defaults to the combined transport `pool_size` of the providers serving the model.
+            ordered (bool, optional): Write results in input order, otherwise in completion order. Defaults to True.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+            priority (int, optional): Admission priority of the requests, for providers with an `AdmissionController`. Defaults to `Priority.BATCH`, yielding to other calls.
+            checkpoint_interval (float, optional): Seconds between checkpoints. Defaults to 10.0.
+            resume (bool, optional): Resume from the checkpoint if there is one, otherwise start over. Defaults to True.
+            on_progress (Optional[Callable[[JSONLProgress], None]], optional): Called after each checkpoint. Defaults to None.
+
+        Raises:
+            ValueError: If the checkpoint belongs to a job with a different input, or ordering.
+
+        Returns:
+            JSONLProgress: Progress of the job once it has finished.
+        """
+        if max_workers is None:
+            max_workers = self._batch_workers(model, provider)
+        generate = self._batch_generate(
+            model, system_prompt, images, provider, options, priority
+        )
+        return run_jsonl(
+            generate,
+            input_path,
+            output_path,
+            max_workers,
+            ordered,
+            checkpoint_interval,
+            resume,
+            on_progress,
+        )
+
+    def _batch_workers(
+        self, model: Union[str, Model], provider: Optional[Union[str, Provider]]
+    ) -> int:
+        """Default concurrency of a batch, the combined transport `pool_size` of the providers serving the model."""
+        if provider is not None:
+            candidates = [self.get_provider(model, provider)]
+        else:
+            candidates = self.get_providers(model)
+        return sum(target.transport.pool_size for target in candidates)
+
+    def _batch_generate(
+        self,
+        model: Union[str, Model],
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        provider: Optional[Union[str, Provider]],
+        options: Optional[dict],
+        priority: int,
+    ) -> Callable[[Union[str, dict]], str]:
+        """Function generating the completion of a single batch item, applying the batch-wide defaults."""
+
+        def generate(item: Union[str, dict]) -> str:
+            kwargs = {
+                "system_prompt": system_prompt,
+                "images": images,
+                "options": options,
+            }
+            if isinstance(item, dict):
+                unknown = item.keys() - _BATCH_ITEM_KEYS
+                if unknown:
+                    raise ValueError(
+                        f"batch items can't set {', '.join(sorted(unknown))}"
+                    )
+                kwargs.update(item)
+            else:
+                kwargs["prompt"] = item
+            with admission_priority(priority):
+                return self.generate(model, provider=provider, **kwargs)
+
+        return generate
@@ -0,0 +1,668 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from .admission import AdmissionException, admission_priority, Priority
+from .capabilities import CapabilitiesException
+from .exfer import Exfer, ProviderNotFoundException
+from .provider import ModelNotFoundException, json_options
+from .stream import DeadlineExceededException
+from .transport import TransportException
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    429: "Too Many Requests",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    504: "Gateway Timeout",
+}
+
+_SAMPLING_OPTIONS = ("temperature", "top_p", "seed")
+"""Sampling parameters of the OpenAI API that Ollama and LM Studio both take under the same names."""
+
+_MAX_HEADERS = 100
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class _Request:
+    """A parsed HTTP request."""
+
+    __slots__ = ("method", "path", "headers", "body", "keep_alive")
+
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        headers: dict[str, str],
+        body: bytes,
+        keep_alive: bool,
+    ):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+
+    def json(self) -> dict:
+        try:
+            payload = json.loads(self.body or b"{}")
+        except ValueError as error:
+            raise _BadRequest(f"request body is not valid JSON: {error}") from error
+        if not isinstance(payload, dict):
+            raise _BadRequest("request body must be a JSON object")
+        return payload
+
+
+class _Connection:
+    """A client connection, with any bytes read past the end of the current request."""
+
+    __slots__ = ("reader", "writer", "pushback")
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pushback = b""
+
+
+class Gateway:
+    """OpenAI-compatible HTTP API in front of an `Exfer` instance, so that many processes can share its connection
+    pools, model catalog, admission queues and caches, and have their requests routed together. Runs on a single
+    asyncio event loop, with no dependencies beyond the standard library.
+
+    Serves `GET /v1/models`, `POST /v1/chat/completions`, `POST /v1/completions`, `POST /v1/embeddings` and
+    `GET /health`. Completions can be streamed as Server-Sent Events, and a client disconnecting cancels its
+    request, closing the connection to the backend so it stops generating.
+
+    Requests are translated onto `Exfer.agenerate()`. Conversations are sent as a transcript, `stop` is applied
+    with `AsyncTextStream.stop_at()`, `response_format` becomes structured output, and `temperature`, `top_p` and
+    `seed` are passed on. Other provider specific options can be given in an `options` object. The
+    `X-Exfer-Priority` header sets the admission priority, as a number or the name of a `Priority`.
+
+    Example:
+        async with Gateway(Exfer.from_env(), port=8080) as gateway:
+            await gateway.serve_forever()
+    """
+
+    exfer: Exfer
+    """Instance the requests are made through."""
+
+    host: str
+    """Interface to listen on."""
+
+    port: int
+    """Port to listen on. Updated to the bound port once started, if 0 was given."""
+
+    max_body: int
+    """Largest request body accepted, in bytes."""
+
+    def __init__(
+        self,
+        exfer: Exfer,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        max_body: int = 32 * 1024 * 1024,
+    ):
+        """Constructs a new gateway. It is not listening until `start()` is called, or it is used as an async context manager.
+
+        Args:
+            exfer (Exfer): Instance the requests are made through.
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on. Defaults to 8080, 0 picks a free port.
+            max_body (int, optional): Largest request body accepted, in bytes. Defaults to 32 MiB.
+        """
+        self.exfer = exfer
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._server: Optional[asyncio.Server] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running gateway."""
+        if self._server is None:
+            raise RuntimeError("gateway is not running")
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> "Gateway":
+        """Starts listening. Connections are served on the running event loop."""
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self) -> None:
+        """Serves until cancelled."""
+        await self.start()
+        await self._server.serve_forever()
+
+    async def stop(self) -> None:
+        """Stops listening, and closes every connection, cancelling the requests in progress."""
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.close()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.wait_closed()
+
+    async def __aenter__(self) -> "Gateway":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        connection = _Connection(reader, writer)
+        try:
+            while True:
+                try:
+                    request = await self._read_request(connection)
+                except _BadRequest as error:
+                    await self._send_error(connection, 400, str(error), False)
+                    break
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self._send_error(
+                        connection, 431, "request line or header too large", False
+                    )
+                    break
+                if request is None:
+                    break
+                if not await self._guard(connection, request):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _read_request(self, connection: _Connection) -> Optional[_Request]:
+        """Reads the next request, or returns None once the client has closed the connection."""
+        reader = connection.reader
+        line = b""
+        while not line.strip():
+            # Clients may send blank lines between requests, which are ignored.
+            line = connection.pushback + await reader.readline()
+            connection.pushback = b""
+            if not line:
+                return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise _BadRequest("malformed request line")
+
+        headers: dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= _MAX_HEADERS:
+                raise ValueError("too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise _BadRequest("chunked request bodies are not supported")
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise _BadRequest("invalid Content-Length")
+        if length > self.max_body:
+            raise _BadRequest(f"request body is larger than {self.max_body} bytes")
+        body = await reader.readexactly(length) if length > 0 else b""
+
+        connection_header = headers.get("connection", "").lower()
+        keep_alive = (
+            connection_header != "close"
+            if version == "HTTP/1.1"
+            else connection_header == "keep-alive"
+        )
+        return _Request(method, target.split("?", 1)[0], headers, body, keep_alive)
+
+    async def _guard(self, connection: _Connection, request: _Request) -> bool:
+        """Handles a request while watching for the client to disconnect, in which case the request is cancelled.
+        Returns whether the connection can be kept open."""
+        handling = asyncio.ensure_future(self._handle(connection, request))
+        watching = asyncio.ensure_future(connection.reader.read(1))
+        try:
+            done, _ = await asyncio.wait(
+                (handling, watching), return_when=asyncio.FIRST_COMPLETED
+            )
+            if watching in done:
+                data = watching.result()
+                if not data:
+                    handling.cancel()
+                    await asyncio.wait((handling,))
+                    return False
+                # The client sent its next request already, which is read once this one is done.
+                connection.pushback = data
+                return await handling
+            # The watch has to have stopped before the next request is read.
+            watching.cancel()
+            await asyncio.wait((watching,))
+            if not watching.cancelled():
+                connection.pushback = watching.result()
+            return handling.result()
+        finally:
+            for task in (handling, watching):
+                if not task.done():
+                    task.cancel()
+
+    async def _handle(self, connection: _Connection, request: _Request) -> bool:
+        routes: dict[
+            tuple[str, str], Callable[[_Connection, _Request], Awaitable[bool]]
+        ] = {
+            ("GET", "/health"): self._health,
+            ("GET", "/v1/models"): self._models,
+            ("POST", "/v1/chat/completions"): self._chat_completions,
+            ("POST", "/v1/completions"): self._completions,
+            ("POST", "/v1/embeddings"): self._embeddings,
+        }
+        handler = routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in routes):
+                return await self._send_error(
+                    connection,
+                    405,
+                    f"method {request.method} not allowed",
+                    request.keep_alive,
+                )
+            return await self._send_error(
+                connection, 404, f"unknown path {request.path}", request.keep_alive
+            )
+        try:
+            with admission_priority(_priority(request.headers)):
+                return await handler(connection, request)
+        except ConnectionError:
+            raise
+        except Exception as error:
+            status, message = _status_of(error)
+            return await self._send_error(
+                connection, status, message, request.keep_alive
+            )
+
+    async def _health(self, connection: _Connection, request: _Request) -> bool:
+        return await self._send_json(
+            connection,
+            200,
+            {"status": "ok", "providers": sorted(self.exfer.providers)},
+            request.keep_alive,
+        )
+
+    async def _models(self, connection: _Connection, request: _Request) -> bool:
+        providers = self.exfer.model_providers
+        return await self._send_json(
+            connection,
+            200,
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "id": model.key,
+                        "object": "model",
+                        "created": 0,
+                        "owned_by": ",".join(sorted(providers.get(model.key, ()))),
+                        "capabilities": [str(c) for c in model.capabilities],
+                    }
+                    for model in sorted(self.exfer.models, key=lambda m: m.key)
+                ],
+            },
+            request.keep_alive,
+        )
+
+    async def _chat_completions(
+        self, connection: _Connection, request: _Request
+    ) -> bool:
+        payload = request.json()
+        prompt, system_prompt, images = _chat_prompt(payload.get("messages"))
+        return await self._complete(
+            connection, request, payload, prompt, system_prompt, images, True
+        )
+
+    async def _completions(self, connection: _Connection, request: _Request) -> bool:
+        payload = request.json()
+        prompt = payload.get("prompt")
+        if isinstance(prompt, list) and len(prompt) == 1:
+            prompt = prompt[0]
+        if not isinstance(prompt, str):
+            raise _BadRequest("prompt must be a string")
+        return await self._complete(
+            connection, request, payload, prompt, None, None, False
+        )
+
+    async def _complete(
+        self,
+        connection: _Connection,
+        request: _Request,
+        payload: dict,
+        prompt: str,
+        system_prompt: Optional[str],
+        images: Optional[list[bytes]],
+        chat: bool,
+    ) -> bool:
+        model = payload.get("model")
+        if not isinstance(model, str):
+            raise _BadRequest("model must be a string")
+        stream = self.exfer.agenerate(
+            model, prompt, True, system_prompt, images, None, _options(payload)
+        )
+        stop = payload.get("stop")
+        if stop:
+            stream = stream.stop_at(*([stop] if isinstance(stop, str) else stop))
+
+        completion = _Completion(model, chat)
+        async with stream:
+            # The first fragment is awaited before responding, so that failures to start get an error status.
+            first = await anext(stream, None)
+            if not payload.get("stream"):
+                fragments = [] if first is None else [first]
+                async for fragment in stream:
+                    fragments.append(fragment)
+                return await self._send_json(
+                    connection,
+                    200,
+                    completion.response("".join(fragments), stream.stats),
+                    request.keep_alive,
+                )
+
+            await self._start_events(connection)
+            try:
+                if first is not None:
+                    await self._send_event(connection, completion.chunk(first))
+                    async for fragment in stream:
+                        await self._send_event(connection, completion.chunk(fragment))
+                await self._send_event(connection, completion.chunk(None))
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    await self._send_event(connection, completion.usage(stream.stats))
+            except ConnectionError:
+                raise
+            except Exception as error:
+                # The response has already started, so the failure is reported as an event instead.
+                await self._send_event(
+                    connection, {"error": _error_body(*_status_of(error))}
+                )
+            await self._end_events(connection)
+            return request.keep_alive
+
+    async def _embeddings(self, connection: _Connection, request: _Request) -> bool:
+        payload = request.json()
+        model = payload.get("model")
+        inputs = payload.get("input")
+        if not isinstance(model, str):
+            raise _BadRequest("model must be a string")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not isinstance(inputs, list) or not all(
+            isinstance(text, str) for text in inputs
+        ):
+            raise _BadRequest("input must be a string or a list of strings")
+        vectors = await self.exfer.aembed(model, inputs)
+        return await self._send_json(
+            connection,
+            200,
+            {
+                "object": "list",
+                "model": model,
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": vector}
+                    for index, vector in enumerate(vectors.tolist())
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            },
+            request.keep_alive,
+        )
+
+    async def _send_json(
+        self, connection: _Connection, status: int, payload: Any, keep_alive: bool
+    ) -> bool:
+        body = json.dumps(payload).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        connection.writer.write(head.encode("latin-1") + body)
+        await connection.writer.drain()
+        return keep_alive
+
+    async def _send_error(
+        self, connection: _Connection, status: int, message: str, keep_alive: bool
+    ) -> bool:
+        return await self._send_json(
+            connection, status, {"error": _error_body(status, message)}, keep_alive
+        )
+
+    async def _start_events(self, connection: _Connection) -> None:
+        connection.writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        await connection.writer.drain()
+
+    async def _send_event(self, connection: _Connection, payload: Any) -> None:
+        await self._send_chunk(
+            connection, b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+        )
+
+    async def _end_events(self, connection: _Connection) -> None:
+        await self._send_chunk(connection, b"data: [DONE]\n\n")
+        connection.writer.write(b"0\r\n\r\n")
+        await connection.writer.drain()
+
+    async def _send_chunk(self, connection: _Connection, data: bytes) -> None:
+        connection.writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        await connection.writer.drain()
+
+
+class _Completion:
+    """Formats the responses of a completion in the OpenAI chat or text completion format."""
+
+    def __init__(self, model: str, chat: bool):
+        self.model = model
+        self.chat = chat
+        self.id = ("chatcmpl-" if chat else "cmpl-") + os.urandom(12).hex()
+        self.created = int(time.time())
+        self._started = False
+
+    def _envelope(self, choices: list[dict], chunk: bool) -> dict:
+        if self.chat:
+            kind = "chat.completion.chunk" if chunk else "chat.completion"
+        else:
+            kind = "text_completion"
+        return {
+            "id": self.id,
+            "object": kind,
+            "created": self.created,
+            "model": self.model,
+            "choices": choices,
+        }
+
+    def response(self, text: str, stats: Optional[dict]) -> dict:
+        if self.chat:
+            choice = {
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }
+        else:
+            choice = {"index": 0, "text": text, "finish_reason": "stop"}
+        response = self._envelope([choice], False)
+        response["usage"] = _usage(stats)
+        return response
+
+    def chunk(self, fragment: Optional[str]) -> dict:
+        """A streamed chunk of the fragment, or the final chunk when None."""
+        finish_reason = "stop" if fragment is None else None
+        if not self.chat:
+            choice = {
+                "index": 0,
+                "text": fragment or "",
+                "finish_reason": finish_reason,
+            }
+            return self._envelope([choice], True)
+        delta: dict = {} if fragment is None else {"content": fragment}
+        if not self._started:
+            delta["role"] = "assistant"
+            self._started = True
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        return self._envelope([choice], True)
+
+    def usage(self, stats: Optional[dict]) -> dict:
+        chunk = self._envelope([], True)
+        chunk["usage"] = _usage(stats)
+        return chunk
+
+
+def _usage(stats: Optional[dict]) -> dict:
+    """Token usage in the OpenAI format, from the statistics reported in either the Ollama or OpenAI formats. Zero when unknown, such as for cached responses."""
+    stats = stats or {}
+    usage = stats.get("usage") or {}
+    prompt = stats.get("prompt_eval_count", usage.get("prompt_tokens")) or 0
+    completion = stats.get("eval_count", usage.get("completion_tokens")) or 0
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+    }
+
+
+def _chat_prompt(messages: Any) -> tuple[str, Optional[str], Optional[list[bytes]]]:
+    """Translates chat messages into a prompt, a system prompt, and images. Conversations of more than one turn
+    are sent as a transcript, like a `Session` without a context."""
+    if not isinstance(messages, list) or not messages:
+        raise _BadRequest("messages must be a non-empty list")
+    system: list[str] = []
+    turns: list[tuple[str, str]] = []
+    images: list[bytes] = []
+    for message in messages:
+        if not isinstance(message, dict):
+            raise _BadRequest("each message must be an object")
+        role = message.get("role")
+        text = _message_text(message.get("content"), images)
+        if role in ("system", "developer"):
+            system.append(text)
+        elif isinstance(role, str):
+            turns.append((role, text))
+        else:
+            raise _BadRequest("each message must have a role")
+    if not turns or turns[-1][0] != "user":
+        raise _BadRequest("the last message must be from the user")
+    prompt = turns[-1][1]
+    if len(turns) > 1:
+        transcript = "\n\n".join(
+            f"{role.capitalize()}: {text}" for role, text in turns[:-1]
+        )
+        prompt = f"{transcript}\n\nUser: {prompt}"
+    return prompt, "\n\n".join(system) if system else None, images or None
+
+
+def _message_text(content: Any, images: list[bytes]) -> str:
+    """Text of a message's content, collecting its images. Only images given as data URLs are accepted, as
+    anything else would be read from the gateway's filesystem."""
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, list):
+        raise _BadRequest("message content must be a string or a list of parts")
+    texts: list[str] = []
+    for part in content:
+        kind = part.get("type") if isinstance(part, dict) else None
+        if kind == "text":
+            texts.append(str(part.get("text", "")))
+        elif kind == "image_url":
+            image = part.get("image_url")
+            url = image.get("url") if isinstance(image, dict) else image
+            if not isinstance(url, str) or not url.startswith("data:"):
+                raise _BadRequest("images must be given as base64 data URLs")
+            header, _, data = url.partition(",")
+            if not header.endswith(";base64"):
+                raise _BadRequest("images must be given as base64 data URLs")
+            try:
+                images.append(base64.b64decode(data, validate=True))
+            except ValueError as error:
+                raise _BadRequest(f"invalid image data: {error}") from error
+        else:
+            raise _BadRequest(f"unsupported content part {kind!r}")
+    return "\n".join(texts)
+
+
+def _options(payload: dict) -> Optional[dict]:
+    """Generation options of a completion request."""
+    options = payload.get("options")
+    if options is not None and not isinstance(options, dict):
+        raise _BadRequest("options must be an object")
+    options = dict(options or {})
+    for name in _SAMPLING_OPTIONS:
+        if payload.get(name) is not None:
+            options[name] = payload[name]
+    response_format = payload.get("response_format")
+    if isinstance(response_format, dict):
+        kind = response_format.get("type")
+        if kind == "json_object":
+            options = json_options(None, options)
+        elif kind == "json_schema":
+            schema = (response_format.get("json_schema") or {}).get("schema")
+            options = json_options(schema, options)
+    return options or None
+
+
+def _priority(headers: dict[str, str]) -> int:
+    value = headers.get("x-exfer-priority")
+    if not value:
+        return Priority.NORMAL
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        return Priority[value.upper()]
+    except KeyError:
+        raise _BadRequest(f"unknown priority {value}")
+
+
+def _status_of(error: BaseException) -> tuple[int, str]:
+    """HTTP status of the error response for a failed request."""
+    if isinstance(error, (ModelNotFoundException, ProviderNotFoundException)):
+        return 404, str(error)
+    if isinstance(error, (_BadRequest, CapabilitiesException)):
+        return 400, str(error)
+    if isinstance(error, AdmissionException):
+        return 429, str(error)
+    if isinstance(error, (DeadlineExceededException, TimeoutError)):
+        return 504, str(error) or "timed out"
+    if isinstance(error, TransportException):
+        return 502, str(error)
+    return 500, f"{type(error).__name__}: {error}"
+
+
+def _error_body(status: int, message: str) -> dict:
+    kinds = {
+        400: "invalid_request_error",
+        404: "not_found_error",
+        429: "rate_limit_error",
+        502: "upstream_error",
+        504: "timeout_error",
+    }
+    return {
+        "message": message,
+        "type": kinds.get(status, "server_error"),
+        "code": status,
+    }
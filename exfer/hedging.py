@@ -0,0 +1,402 @@
+import contextvars
+import math
+import queue
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from .provider import Provider
+from .stream import AsyncTextStream, TextStream
+
+_END = object()
+"""Stands in for the first fragment of a stream that ended without any."""
+
+
+class HedgePolicy:
+    """Policy for hedging requests to models that are served by more than one provider. When the chosen provider
+    hasn't produced a first token within a percentile of its recent first token latencies for the model, the
+    request is duplicated to another provider. Whichever produces a first token first is used, and the other is
+    cancelled, closing its connection so its backend stops generating.
+
+    Hedging only after a high percentile means only the slowest requests are duplicated, and `max_ratio` caps the
+    extra load, so that an overloaded cluster isn't made worse. Safe to use from multiple threads.
+
+    Example:
+        exference = Exfer(providers=[ollama_a, ollama_b], hedging=HedgePolicy(percentile=95.0))
+    """
+
+    percentile: float
+    """Percentile of the provider's first token latencies to wait for before hedging, between 0 and 100."""
+
+    initial_delay: float
+    """Seconds to wait before hedging while a provider has fewer than `min_samples` latencies for the model."""
+
+    min_delay: float
+    """Minimum seconds to wait before hedging, however fast the provider usually is."""
+
+    min_samples: int
+    """Number of latencies needed before the percentile is used."""
+
+    window: int
+    """Number of the most recent latencies kept per provider and model."""
+
+    max_ratio: float
+    """Maximum fraction of requests that are hedged."""
+
+    requests: int
+    """Number of requests made under this policy."""
+
+    hedges: int
+    """Number of requests which were duplicated to a second provider."""
+
+    hedge_wins: int
+    """Number of hedged requests where the second provider responded first."""
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        initial_delay: float = 1.0,
+        min_delay: float = 0.05,
+        min_samples: int = 20,
+        window: int = 256,
+        max_ratio: float = 0.1,
+    ):
+        """Constructs a new hedging policy.
+
+        Args:
+            percentile (float, optional): Percentile of the first token latencies to wait for before hedging. Defaults to 95.0.
+            initial_delay (float, optional): Seconds to wait before hedging until there are enough latencies. Defaults to 1.0.
+            min_delay (float, optional): Minimum seconds to wait before hedging. Defaults to 0.05.
+            min_samples (int, optional): Number of latencies needed before the percentile is used. Defaults to 20.
+            window (int, optional): Number of recent latencies kept per provider and model. Defaults to 256.
+            max_ratio (float, optional): Maximum fraction of requests that are hedged. Defaults to 0.1.
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.max_ratio = max_ratio
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._latencies: dict[tuple[str, str], deque[float]] = {}
+
+    def record(self, provider: Provider, model_key: str, latency: float) -> None:
+        """Records the first token latency of a request.
+
+        Args:
+            provider (Provider): Provider the request was issued to.
+            model_key (str): Key of the requested model.
+            latency (float): Seconds from issuing the request to receiving its first fragment.
+        """
+        with self._lock:
+            samples = self._latencies.get((provider.key, model_key))
+            if samples is None:
+                samples = self._latencies[(provider.key, model_key)] = deque(
+                    maxlen=self.window
+                )
+            samples.append(latency)
+
+    def latency(
+        self, provider: Provider, model_key: str, percentile: Optional[float] = None
+    ) -> Optional[float]:
+        """Percentile of the recent first token latencies of a model on a provider.
+
+        Args:
+            provider (Provider): Provider serving the model.
+            model_key (str): Key of the model.
+            percentile (Optional[float], optional): Percentile between 0 and 100. Defaults to the policy's `percentile`.
+
+        Returns:
+            Optional[float]: The latency in seconds, or None if there are no latencies recorded.
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get((provider.key, model_key), ()))
+        if not samples:
+            return None
+        rank = (self.percentile if percentile is None else percentile) / 100.0
+        return samples[min(len(samples) - 1, math.ceil(rank * len(samples)) - 1)]
+
+    def delay(self, provider: Provider, model_key: str) -> float:
+        """Seconds to wait for a first token from the provider before hedging the request."""
+        with self._lock:
+            samples = len(self._latencies.get((provider.key, model_key), ()))
+        if samples < self.min_samples:
+            return max(self.initial_delay, self.min_delay)
+        return max(self.latency(provider, model_key) or 0.0, self.min_delay)
+
+    def _start(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def _allow_hedge(self) -> bool:
+        """Takes a hedge from the budget, if it allows for another."""
+        with self._lock:
+            if self.hedges >= self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _won(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+
+class _Race:
+    """Attempts at a request racing for the first fragment, each waited on by a thread of its own."""
+
+    def __init__(self, policy: HedgePolicy, model_key: str):
+        self.policy = policy
+        self.model_key = model_key
+        self.results: queue.SimpleQueue = queue.SimpleQueue()
+        self.entrants: list[tuple[Provider, TextStream]] = []
+        self.pending = 0
+        self.error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._finished: set[int] = set()
+
+    def enter(self, provider: Provider, stream: TextStream) -> None:
+        self.entrants.append((provider, stream))
+        self.pending += 1
+        # The context is copied so that the attempt is traced, and admitted, as if made by the caller.
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run, args=(self._first, provider, stream), daemon=True
+        ).start()
+
+    def _first(self, provider: Provider, stream: TextStream) -> None:
+        started = time.perf_counter()
+        try:
+            fragment = next(stream, _END)
+        except BaseException as error:
+            with self._lock:
+                self._finished.add(id(stream))
+            self.results.put((provider, stream, None, error))
+            return
+        with self._lock:
+            self._finished.add(id(stream))
+            if stream.cancelled:
+                # Lost the race while waiting, so nothing else will close it.
+                stream.close()
+                self.results.put((provider, stream, _END, None))
+                return
+        self.policy.record(provider, self.model_key, time.perf_counter() - started)
+        self.results.put((provider, stream, fragment, None))
+
+    def wait(
+        self, timeout: Optional[float], deadline: Optional[float]
+    ) -> Optional[tuple[Provider, TextStream, object]]:
+        """Waits for an attempt to produce its first fragment, for the timeout to pass, or for an attempt to fail.
+
+        Args:
+            timeout (Optional[float]): Seconds to wait for, or None to wait for the attempts to finish.
+            deadline (Optional[float]): Seconds until the deadline of the stream, if it has one.
+
+        Raises:
+            TimeoutError: If the deadline passed.
+            Exception: The error of the first attempt to fail, once every attempt has failed.
+
+        Returns:
+            Optional[tuple[Provider, TextStream, object]]: The winning attempt, or None if there is none yet.
+        """
+        limit = timeout
+        expires = deadline is not None and (timeout is None or deadline < timeout)
+        if expires:
+            limit = deadline
+        ends = None if limit is None else time.monotonic() + limit
+        while self.pending:
+            try:
+                provider, stream, fragment, error = self.results.get(
+                    timeout=None if ends is None else max(ends - time.monotonic(), 0.0)
+                )
+            except queue.Empty:
+                if expires:
+                    raise TimeoutError("no attempt responded before the deadline")
+                return None
+            self.pending -= 1
+            if error is None:
+                return provider, stream, fragment
+            self.error = self.error or error
+            if timeout is not None:
+                # Failing early moves the hedge forward, rather than waiting out the delay.
+                return None
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def cancel(self, winner: Optional[TextStream] = None) -> None:
+        """Cancels every attempt but the winner, closing those which are no longer being waited on."""
+        for _, stream in self.entrants:
+            if stream is winner:
+                continue
+            with self._lock:
+                stream.cancel()
+                if id(stream) in self._finished:
+                    stream.close()
+
+
+def hedge(
+    policy: HedgePolicy,
+    model_key: str,
+    primary: Provider,
+    alternate: Callable[[], Optional[Provider]],
+    attempt: Callable[[Provider], TextStream],
+) -> TextStream:
+    """Makes a request under a hedging policy. The race starts once the returned stream is first iterated.
+
+    Args:
+        policy (HedgePolicy): Policy deciding when to hedge.
+        model_key (str): Key of the requested model.
+        primary (Provider): Provider to send the request to first.
+        alternate (Callable[[], Optional[Provider]]): Chooses the provider to duplicate the request to, if any.
+        attempt (Callable[[Provider], TextStream]): Sends the request to a provider, as a stream.
+
+    Returns:
+        TextStream: Stream of the attempt that produced a first fragment first.
+    """
+    return TextStream(
+        lambda stream: _hedged(stream, policy, model_key, primary, alternate, attempt)
+    )
+
+
+def _hedged(
+    stream: TextStream,
+    policy: HedgePolicy,
+    model_key: str,
+    primary: Provider,
+    alternate: Callable[[], Optional[Provider]],
+    attempt: Callable[[Provider], TextStream],
+) -> Iterator[str]:
+    policy._start()
+    race = _Race(policy, model_key)
+    stream.on_cancel(race.cancel)
+    winner = None
+    try:
+        race.enter(primary, attempt(primary))
+        winner = race.wait(policy.delay(primary, model_key), stream.remaining)
+        if winner is None:
+            # A failed primary is replaced whatever the budget.
+            if race.pending == 0 or policy._allow_hedge():
+                second = alternate()
+                if second is not None:
+                    race.enter(second, attempt(second))
+            winner = race.wait(None, stream.remaining)
+    finally:
+        race.cancel(None if winner is None else winner[1])
+    if winner is None:
+        return
+    provider, chosen, fragment = winner
+    if provider is not primary:
+        policy._won()
+    with chosen:
+        if fragment is _END:
+            return
+        yield fragment
+        yield from chosen
+
+
+def ahedge(
+    policy: HedgePolicy,
+    model_key: str,
+    primary: Provider,
+    alternate: Callable[[], Optional[Provider]],
+    attempt: Callable[[Provider], AsyncTextStream],
+) -> AsyncTextStream:
+    """Makes a request under a hedging policy using asyncio. Mirrors `hedge()`.
+
+    Args:
+        policy (HedgePolicy): Policy deciding when to hedge.
+        model_key (str): Key of the requested model.
+        primary (Provider): Provider to send the request to first.
+        alternate (Callable[[], Optional[Provider]]): Chooses the provider to duplicate the request to, if any.
+        attempt (Callable[[Provider], AsyncTextStream]): Sends the request to a provider, as an async stream.
+
+    Returns:
+        AsyncTextStream: Stream of the attempt that produced a first fragment first.
+    """
+    return AsyncTextStream(
+        lambda stream: _ahedged(stream, policy, model_key, primary, alternate, attempt)
+    )
+
+
+async def _afirst(
+    policy: HedgePolicy, model_key: str, provider: Provider, stream: AsyncTextStream
+) -> object:
+    started = time.perf_counter()
+    fragment = await anext(stream, _END)
+    policy.record(provider, model_key, time.perf_counter() - started)
+    return fragment
+
+
+async def _ahedged(
+    stream: AsyncTextStream,
+    policy: HedgePolicy,
+    model_key: str,
+    primary: Provider,
+    alternate: Callable[[], Optional[Provider]],
+    attempt: Callable[[Provider], AsyncTextStream],
+) -> AsyncIterator[str]:
+    import asyncio
+
+    policy._start()
+    entrants: dict[asyncio.Task, tuple[Provider, AsyncTextStream]] = {}
+
+    def enter(provider: Provider) -> asyncio.Task:
+        attempted = attempt(provider)
+        task = asyncio.ensure_future(_afirst(policy, model_key, provider, attempted))
+        entrants[task] = (provider, attempted)
+        return task
+
+    def cancel() -> None:
+        for _, attempted in entrants.values():
+            attempted.cancel()
+
+    stream.on_cancel(cancel)
+    winner: Optional[asyncio.Task] = None
+    error: Optional[BaseException] = None
+    try:
+        pending = {enter(primary)}
+        timeout: Optional[float] = policy.delay(primary, model_key)
+        hedged = False
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+                error = error or task.exception()
+            if winner is None and not hedged:
+                # Hedge once the delay has passed, or straight away if the primary failed, whatever the budget.
+                hedged = True
+                timeout = None
+                if not pending or policy._allow_hedge():
+                    second = alternate()
+                    if second is not None:
+                        pending.add(enter(second))
+    finally:
+        for task, (_, attempted) in entrants.items():
+            if task is winner:
+                continue
+            task.cancel()
+            attempted.cancel()
+            if task.done():
+                await attempted.aclose()
+    if winner is None:
+        if error is not None:
+            raise error
+        return
+    provider, chosen = entrants[winner]
+    if provider is not primary:
+        policy._won()
+    async with chosen:
+        fragment = winner.result()
+        if fragment is _END:
+            return
+        yield fragment
+        async for fragment in chosen:
+            yield fragment
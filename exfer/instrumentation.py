@@ -0,0 +1,518 @@
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional, Sequence
+
+
+class Trace:
+    """Timings and sizes collected for a single `Provider.generate_text()` or `Provider.agenerate_text()`
+    call while instrumentation is enabled. Given to each `Observer` when the call starts, and again once
+    it has finished."""
+
+    __slots__ = (
+        "provider",
+        "model",
+        "stream",
+        "trace_id",
+        "span_id",
+        "start_time_ns",
+        "start",
+        "durations",
+        "gaps",
+        "bytes_out",
+        "bytes_in",
+        "prompt_tokens",
+        "completion_tokens",
+        "stats",
+        "cached",
+        "coalesced",
+        "error",
+        "_sent",
+        "_previous",
+    )
+
+    provider: str
+    """Key of the provider the request was issued to."""
+
+    model: str
+    """Key of the model requested."""
+
+    stream: bool
+    """Whether the response was streamed."""
+
+    trace_id: str
+    """Random 128-bit hex identifier, following the OpenTelemetry format."""
+
+    span_id: str
+    """Random 64-bit hex identifier, following the OpenTelemetry format."""
+
+    start_time_ns: int
+    """Wall-clock time the call started at, in nanoseconds since the epoch."""
+
+    durations: dict[str, float]
+    """Seconds spent in each phase of the call. `resolve` is looking up the model, `encode` is encoding images,
+    `queue` is waiting for admission by the provider's `AdmissionController`, `connect` is from sending the request until the response headers arrived, `first_token` is from the start
+    of the call until the first fragment, and `total` is the whole call. Phases that did not happen are absent."""
+
+    gaps: list[float]
+    """Seconds between consecutive fragments of a streamed response."""
+
+    bytes_out: int
+    """Size of the request bodies sent."""
+
+    bytes_in: int
+    """Size of the response bodies received."""
+
+    prompt_tokens: Optional[int]
+    """Number of prompt tokens processed, as reported by the provider."""
+
+    completion_tokens: Optional[int]
+    """Number of tokens generated, as reported by the provider."""
+
+    stats: Optional[dict]
+    """Final statistics reported by the provider. See `TextStream.stats`."""
+
+    cached: bool
+    """Whether the response was served from the provider's `cache`."""
+
+    coalesced: bool
+    """Whether the call subscribed to an identical generation already in flight. See `SingleFlight`."""
+
+    error: Optional[BaseException]
+    """Exception the call failed with, if any."""
+
+    def __init__(self, provider: str, model: str, stream: bool):
+        self.provider = provider
+        self.model = model
+        self.stream = stream
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_time_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.durations = {}
+        self.gaps = []
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.stats = None
+        self.cached = False
+        self.coalesced = False
+        self.error = None
+        self._sent: Optional[float] = None
+        self._previous: Optional[float] = None
+
+    @property
+    def end_time_ns(self) -> int:
+        """Wall-clock time the call finished at, in nanoseconds since the epoch."""
+        return self.start_time_ns + int(self.durations.get("total", 0.0) * 1e9)
+
+    def add(self, phase: str, seconds: float) -> None:
+        """Adds time spent in a phase. Repeated phases, such as encoding images more than once, are summed."""
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+
+    def request_sent(self, size: int) -> None:
+        """Records that a request body of the given size was sent."""
+        self.bytes_out += size
+        self._sent = time.perf_counter()
+
+    def response_started(self) -> None:
+        """Records that the headers of the response to the last request sent have arrived."""
+        if self._sent is not None:
+            self.add("connect", time.perf_counter() - self._sent)
+            self._sent = None
+
+    def fragment(self) -> None:
+        """Records that a fragment of a streamed response was received."""
+        now = time.perf_counter()
+        if self._previous is None:
+            self.durations["first_token"] = now - self.start
+        else:
+            self.gaps.append(now - self._previous)
+        self._previous = now
+
+    def report_stats(self, stats: Optional[dict]) -> None:
+        """Stores the final statistics reported by the provider, picking out the token counts of either the
+        Ollama (`prompt_eval_count`, `eval_count`) or OpenAI (`usage`) formats."""
+        if not stats:
+            return
+        self.stats = stats
+        usage = stats.get("usage") or {}
+        self.prompt_tokens = stats.get("prompt_eval_count", usage.get("prompt_tokens"))
+        self.completion_tokens = stats.get("eval_count", usage.get("completion_tokens"))
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("exfer_trace", default=None)
+"""Trace of the call in progress. Lets the transport and image encoding add to it without it being passed through."""
+
+
+def record(phase: str, seconds: float) -> None:
+    """Adds time spent in a phase to the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+def report_stats(stats: Optional[dict]) -> None:
+    """Stores the final statistics reported by the provider on the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.report_stats(stats)
+
+
+class Observer:
+    """Receives the traces of instrumented calls. Subclasses override the events they are interested in.
+    Called synchronously on the thread, or event loop, making the request, so should return quickly.
+    """
+
+    def on_start(self, trace: Trace) -> None:
+        """Called when a call starts, before any request is made."""
+        pass
+
+    def on_finish(self, trace: Trace) -> None:
+        """Called when a call has finished, including when it failed, or its stream was closed early."""
+        pass
+
+
+class Instrumentation:
+    """Hook surface for observing provider calls. Set it as a provider's `instrumentation`, or given to
+    `Exfer` for all of its providers, and each call will produce a `Trace` for the observers.
+
+    When a provider has no instrumentation, nothing is collected, and calls pay only for the check.
+    """
+
+    observers: list[Observer]
+    """Observers notified of each call."""
+
+    def __init__(self, observers: Iterable[Observer] = ()):
+        """Constructs a new instrumentation hook.
+
+        Args:
+            observers (Iterable[Observer], optional): Observers to notify of each call. Defaults to ().
+        """
+        self.observers = list(observers)
+
+    def add(self, observer: Observer) -> Observer:
+        """Adds an observer, returning it."""
+        self.observers.append(observer)
+        return observer
+
+    def start(self, provider: str, model: str, stream: bool) -> Trace:
+        """Begins the trace of a call."""
+        trace = Trace(provider, model, stream)
+        for observer in self.observers:
+            observer.on_start(trace)
+        return trace
+
+    def finish(self, trace: Trace, error: Optional[BaseException] = None) -> None:
+        """Completes the trace of a call."""
+        trace.durations["total"] = time.perf_counter() - trace.start
+        trace.error = error
+        for observer in self.observers:
+            observer.on_finish(trace)
+
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+"""Default upper bounds of the histogram buckets, in seconds."""
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds, as used by Prometheus."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        """Pairs of bucket upper bound and the number of observations at or below it, ending with `+Inf`."""
+        result = []
+        total = 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimates a quantile as the upper bound of the bucket it falls in. None if nothing was observed."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return None
+
+
+_HISTOGRAMS = {
+    "resolve": ("exfer_resolve_seconds", "Time spent resolving the model."),
+    "encode": ("exfer_encode_seconds", "Time spent encoding images."),
+    "queue": (
+        "exfer_queue_wait_seconds",
+        "Time spent waiting for admission to the provider.",
+    ),
+    "connect": (
+        "exfer_connect_seconds",
+        "Time from sending the request until the response headers arrived.",
+    ),
+    "first_token": (
+        "exfer_time_to_first_token_seconds",
+        "Time from the start of the call until the first fragment.",
+    ),
+    "gap": (
+        "exfer_inter_fragment_seconds",
+        "Time between consecutive fragments of streamed responses.",
+    ),
+    "total": ("exfer_request_duration_seconds", "Total duration of the call."),
+}
+
+_COUNTERS = {
+    "bytes_out": ("exfer_sent_bytes_total", "Size of the request bodies sent."),
+    "bytes_in": ("exfer_received_bytes_total", "Size of the response bodies received."),
+    "prompt_tokens": ("exfer_prompt_tokens_total", "Prompt tokens processed."),
+    "completion_tokens": ("exfer_completion_tokens_total", "Tokens generated."),
+}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class MetricsAggregator(Observer):
+    """Aggregates the traces into histograms and counters per provider and model, which can be exported in
+    the Prometheus text format."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """Constructs a new aggregator.
+
+        Args:
+            buckets (Sequence[float], optional): Upper bounds of the histogram buckets in seconds. Defaults to `DEFAULT_BUCKETS`.
+        """
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple[str, str, str], Histogram] = {}
+        self._counters: dict[tuple[str, str, str], int] = {}
+        self._requests: dict[tuple[str, str, str], int] = {}
+
+    def _observe(self, metric: str, provider: str, model: str, value: float) -> None:
+        key = (metric, provider, model)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def _count(self, metric: str, provider: str, model: str, value: int) -> None:
+        key = (metric, provider, model)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def on_finish(self, trace: Trace) -> None:
+        if trace.error is not None:
+            outcome = "error"
+        elif trace.cached:
+            outcome = "cached"
+        elif trace.coalesced:
+            outcome = "coalesced"
+        else:
+            outcome = "ok"
+        provider, model = trace.provider, trace.model
+        with self._lock:
+            key = (provider, model, outcome)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for phase, seconds in trace.durations.items():
+                self._observe(phase, provider, model, seconds)
+            for gap in trace.gaps:
+                self._observe("gap", provider, model, gap)
+            self._count("bytes_out", provider, model, trace.bytes_out)
+            self._count("bytes_in", provider, model, trace.bytes_in)
+            self._count("prompt_tokens", provider, model, trace.prompt_tokens or 0)
+            self._count(
+                "completion_tokens", provider, model, trace.completion_tokens or 0
+            )
+
+    def histogram(self, metric: str, provider: str, model: str) -> Optional[Histogram]:
+        """Retrieves a histogram.
+
+        Args:
+            metric (str): Either a phase of `Trace.durations`, or `gap` for the inter-fragment latency.
+            provider (str): Key of the provider.
+            model (str): Key of the model.
+
+        Returns:
+            Optional[Histogram]: The histogram, or None if nothing has been observed for it.
+        """
+        return self._histograms.get((metric, provider, model))
+
+    def reset(self) -> None:
+        """Discards everything aggregated so far."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._requests.clear()
+
+    def to_prometheus(self) -> str:
+        """Exports the aggregated metrics in the Prometheus text exposition format."""
+        lines: list[str] = []
+        with self._lock:
+            lines.append("# HELP exfer_requests_total Calls made, by outcome.")
+            lines.append("# TYPE exfer_requests_total counter")
+            for (provider, model, outcome), count in sorted(self._requests.items()):
+                lines.append(
+                    f'exfer_requests_total{{provider="{_escape(provider)}",model="{_escape(model)}",outcome="{outcome}"}} {count}'
+                )
+
+            for metric, (name, description) in _HISTOGRAMS.items():
+                series = sorted(
+                    (key[1:], histogram)
+                    for key, histogram in self._histograms.items()
+                    if key[0] == metric
+                )
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} histogram")
+                for (provider, model), histogram in series:
+                    labels = f'provider="{_escape(provider)}",model="{_escape(model)}"'
+                    for bound, total in histogram.cumulative():
+                        lines.append(
+                            f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {total}'
+                        )
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+            for metric, (name, description) in _COUNTERS.items():
+                series = sorted(
+                    (key[1:], value)
+                    for key, value in self._counters.items()
+                    if key[0] == metric
+                )
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                for (provider, model), value in series:
+                    lines.append(
+                        f'{name}{{provider="{_escape(provider)}",model="{_escape(model)}"}} {value}'
+                    )
+        return "\n".join(lines) + "\n"
+
+
+class SpanRecorder(Observer):
+    """Converts the traces into OpenTelemetry-style spans, following the OTLP JSON field names and the
+    `gen_ai` semantic conventions. The most recent spans are kept in memory, and each can also be handed
+    to an exporter as it finishes."""
+
+    def __init__(
+        self,
+        max_spans: int = 1024,
+        exporter: Optional[Callable[[dict], None]] = None,
+    ):
+        """Constructs a new span recorder.
+
+        Args:
+            max_spans (int, optional): Number of recent spans kept in memory. Defaults to 1024.
+            exporter (Optional[Callable[[dict], None]], optional): Called with each span as it finishes. Defaults to None.
+        """
+        self.exporter = exporter
+        self._spans: deque[dict] = deque(maxlen=max_spans)
+
+    @staticmethod
+    def to_span(trace: Trace) -> dict:
+        """Converts a finished trace into a span."""
+        attributes = {
+            "gen_ai.system": trace.provider,
+            "gen_ai.request.model": trace.model,
+            "exfer.stream": trace.stream,
+            "exfer.cached": trace.cached,
+            "exfer.coalesced": trace.coalesced,
+            "http.request.body.size": trace.bytes_out,
+            "http.response.body.size": trace.bytes_in,
+        }
+        if trace.prompt_tokens is not None:
+            attributes["gen_ai.usage.input_tokens"] = trace.prompt_tokens
+        if trace.completion_tokens is not None:
+            attributes["gen_ai.usage.output_tokens"] = trace.completion_tokens
+        for phase, seconds in trace.durations.items():
+            attributes[f"exfer.duration.{phase}"] = seconds
+        if trace.gaps:
+            attributes["exfer.fragments"] = len(trace.gaps) + 1
+            attributes["exfer.inter_fragment.max"] = max(trace.gaps)
+
+        events = []
+        if "first_token" in trace.durations:
+            events.append(
+                {
+                    "name": "first_token",
+                    "timeUnixNano": trace.start_time_ns
+                    + int(trace.durations["first_token"] * 1e9),
+                }
+            )
+
+        status = {"code": "STATUS_CODE_OK"}
+        if trace.error is not None:
+            status = {"code": "STATUS_CODE_ERROR", "message": str(trace.error)}
+            events.append(
+                {
+                    "name": "exception",
+                    "timeUnixNano": trace.end_time_ns,
+                    "attributes": {
+                        "exception.type": type(trace.error).__name__,
+                        "exception.message": str(trace.error),
+                    },
+                }
+            )
+
+        return {
+            "traceId": trace.trace_id,
+            "spanId": trace.span_id,
+            "name": f"generate_text {trace.model}",
+            "kind": "SPAN_KIND_CLIENT",
+            "startTimeUnixNano": trace.start_time_ns,
+            "endTimeUnixNano": trace.end_time_ns,
+            "attributes": attributes,
+            "events": events,
+            "status": status,
+        }
+
+    def on_finish(self, trace: Trace) -> None:
+        span = self.to_span(trace)
+        self._spans.append(span)
+        if self.exporter is not None:
+            self.exporter(span)
+
+    def spans(self) -> list[dict]:
+        """The most recent spans, oldest first."""
+        return list(self._spans)
+
+    def clear(self) -> None:
+        self._spans.clear()
@@ -1,26 +1,37 @@
-from typing import Generator, Optional, Union
+import json
+from typing import AsyncGenerator, Generator, Optional, Sequence, Union
 
 from .provider import Provider
 from .model import Model
 from .capabilities import Capability
-from .utils import ping
+from .stream import AsyncTextStream, TextStream
+from .instrumentation import report_stats
+from .transport import TransportException
+from .utils import ImageInput, ping
+from .utils.streams import SSEDecoder, SSEEvent
 
 
 class LMStudio(Provider):
     @staticmethod
-    def check_env() -> bool:
-        return ping("http://localhost:1234/api/v1/models")
+    def check_env(timeout: float = 2.0) -> bool:
+        return ping("http://localhost:1234/api/v1/models", timeout)
 
     @classmethod
     def from_env(cls):
         return cls()
 
-    def __init__(self, url_override: str | None = None):
-        super().__init__(base_url=url_override)
+    def __init__(self, url_override: str | None = None, **kwargs):
+        """Constructs a new provider.
+
+        Args:
+            url_override (str | None, optional): Base URL of the API. Defaults to the local default port.
+            **kwargs: Additional keyword arguments passed to `Provider.__init__`.
+        """
+        super().__init__(base_url=url_override, **kwargs)
 
     @property
     def key(self) -> str:
-        return "lm-studio"
+        return self.key_override or "lm-studio"
 
     @property
     def name(self) -> str:
@@ -28,20 +39,293 @@ class LMStudio(Provider):
 
     @property
     def capabilities(self) -> list[Capability]:
-        return [Capability.TEXT]
+        return [Capability.TEXT, Capability.EMBEDDING]
 
     def _default_base_url(self) -> str:
         return "http://localhost:1234"
 
-    def _generate_sync(
+    def fetch_models(self) -> list[Model]:
+        response = self.transport.get_json(self.path("/api/v1/models"))
+        entries = response.get("models") or response.get("data") or []
+        return [self._read_model(entry) for entry in entries]
+
+    def _read_model(self, entry: dict) -> Model:
+        """Converts an entry of the `/api/v1/models` listing into a model definition."""
+        key = entry.get("key") or entry.get("id") or ""
+        model_type = entry.get("type", "llm")
+
+        capabilities: list[Capability] = []
+        if model_type in ("llm", "vlm"):
+            capabilities.append(Capability.TEXT)
+        if model_type == "vlm" or (entry.get("capabilities") or {}).get("vision"):
+            capabilities.append(Capability.VISION)
+        if model_type == "embeddings":
+            capabilities.append(Capability.EMBEDDING)
+
+        quantization = entry.get("quantization")
+        if isinstance(quantization, dict):
+            quantization = quantization.get("name")
+
+        return Model(
+            key=key,
+            name=entry.get("display_name") or key,
+            tag=quantization or None,
+            capabilities=capabilities,
+        )
+
+    def _make_generate_request(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        stream: bool = False,
+        options: Optional[dict] = None,
+    ) -> dict:
+        capabilities = [Capability.TEXT]
+        if images is not None:
+            capabilities.append(Capability.VISION)
+
+        model = self.get_model(model, capabilities)
+
+        messages: list[dict] = []
+        if system_prompt is not None:
+            messages.append({"role": "system", "content": system_prompt})
+        if images is not None:
+            content: list[dict] = [{"type": "text", "text": prompt}]
+            for url in self._encode_images(
+                images, as_data=True, max_size=model.max_image_size
+            ):
+                content.append({"type": "image_url", "image_url": {"url": url}})
+            messages.append({"role": "user", "content": content})
+        else:
+            messages.append({"role": "user", "content": prompt})
+
+        request: dict = {
+            "model": model.key,
+            "messages": messages,
+            "stream": stream,
+        }
+        if options is not None and "format" in options:
+            options = dict(options)
+            request["response_format"] = _response_format(options.pop("format"))
+        # The OpenAI compatible API takes the sampling options at the top-level of the request.
+        if options is not None:
+            request.update(options)
+
+        return request
+
+    async def _amake_generate_request(
         self,
         model: Union[str, Model],
         prompt: str,
         system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        stream: bool = False,
+        options: Optional[dict] = None,
+    ) -> dict:
+        # Encoding images is CPU bound, so keep it off of the event loop.
+        if images is not None:
+            import asyncio
+
+            return await asyncio.to_thread(
+                self._make_generate_request,
+                model,
+                prompt,
+                system_prompt,
+                images,
+                stream,
+                options,
+            )
+        return self._make_generate_request(
+            model, prompt, system_prompt, images, stream, options
+        )
+
+    def _generate_text_sync(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
     ) -> str:
-        return ""
+        request = self._make_generate_request(
+            model, prompt, system_prompt, images, False, options
+        )
+        response = self.transport.post_json(self.path("/v1/chat/completions"), request)
+        return self._read_completion(response)
+
+    def _read_completion(self, response: dict) -> str:
+        choices = response.pop("choices", None) or [{}]
+        # The remaining fields, such as the usage, are reported as the stats.
+        report_stats(response)
+        return choices[0].get("message", {}).get("content") or ""
+
+    def _generate_text_async(
+        self,
+        model: str | Model,
+        prompt: str,
+        system_prompt: str | None = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> TextStream:
+        return TextStream(
+            lambda stream: self._stream_generate(
+                stream, model, prompt, system_prompt, images, options
+            )
+        )
+
+    def _make_stream_request(self, request: dict) -> dict:
+        # Ask for the token usage to be sent in a final chunk, so it can be reported in the stream's stats.
+        request["stream_options"] = {"include_usage": True}
+        return request
 
-    def _generate_async(
-        self, model: str | Model, prompt: str, system_prompt: str | None = None
+    def _read_event(
+        self, event: SSEEvent, stream: Union[TextStream, AsyncTextStream]
+    ) -> Optional[str]:
+        """Reads an event of the streamed response, returning its fragment, or None once the stream is done. The finish reason and usage are stored as the stream's stats."""
+        if event.data == "[DONE]":
+            return None
+        chunk = json.loads(event.data)
+        if "error" in chunk:
+            raise TransportException(f"{self.key} failed generating: {chunk['error']}")
+
+        stats = stream.stats if stream.stats is not None else {}
+        if chunk.get("usage"):
+            stats["usage"] = chunk["usage"]
+        fragment = ""
+        for choice in chunk.get("choices") or []:
+            fragment += (choice.get("delta") or {}).get("content") or ""
+            if choice.get("finish_reason"):
+                stats["finish_reason"] = choice["finish_reason"]
+        if stats:
+            if chunk.get("model"):
+                stats.setdefault("model", chunk["model"])
+            stream.stats = stats
+        return fragment
+
+    def _stream_generate(
+        self,
+        stream: TextStream,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
     ) -> Generator[str, None, None]:
-        yield ""
+        request = self._make_stream_request(
+            self._make_generate_request(
+                model, prompt, system_prompt, images, True, options
+            )
+        )
+        decoder = SSEDecoder()
+        with self.transport.stream(
+            "POST", self.path("/v1/chat/completions"), json=request
+        ) as response:
+            # A chunk size of None hands over the data as soon as it is received.
+            for chunk in response.iter_content(chunk_size=None):
+                for event in decoder.feed(chunk):
+                    fragment = self._read_event(event, stream)
+                    if fragment is None:
+                        return
+                    if fragment:
+                        yield fragment
+            for event in decoder.flush():
+                fragment = self._read_event(event, stream)
+                if fragment:
+                    yield fragment
+
+    async def _agenerate_text_sync(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> str:
+        request = await self._amake_generate_request(
+            model, prompt, system_prompt, images, False, options
+        )
+        response = await self.transport.apost_json(
+            self.path("/v1/chat/completions"), request
+        )
+        return self._read_completion(response)
+
+    def _agenerate_text_async(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> AsyncTextStream:
+        return AsyncTextStream(
+            lambda stream: self._astream_generate(
+                stream, model, prompt, system_prompt, images, options
+            )
+        )
+
+    async def _astream_generate(
+        self,
+        stream: AsyncTextStream,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> AsyncGenerator[str, None]:
+        request = self._make_stream_request(
+            await self._amake_generate_request(
+                model, prompt, system_prompt, images, True, options
+            )
+        )
+        decoder = SSEDecoder()
+        async with self.transport.astream(
+            "POST", self.path("/v1/chat/completions"), json=request
+        ) as response:
+            async for chunk in response.aiter_bytes():
+                for event in decoder.feed(chunk):
+                    fragment = self._read_event(event, stream)
+                    if fragment is None:
+                        return
+                    if fragment:
+                        yield fragment
+            for event in decoder.flush():
+                fragment = self._read_event(event, stream)
+                if fragment:
+                    yield fragment
+
+    def _read_embeddings(self, response: dict) -> list[list[float]]:
+        """Reads the embeddings from a `/v1/embeddings` response in the order of the inputs, reporting the remaining fields as its stats."""
+        data = response.pop("data", None)
+        if data is None:
+            raise TransportException(f"{self.key} returned no embeddings")
+        report_stats(response)
+        return [
+            entry["embedding"]
+            for entry in sorted(data, key=lambda entry: entry.get("index", 0))
+        ]
+
+    def _embed_batch(self, model: Model, texts: Sequence[str]) -> list[list[float]]:
+        response = self.transport.post_json(
+            self.path("/v1/embeddings"), {"model": model.key, "input": list(texts)}
+        )
+        return self._read_embeddings(response)
+
+    async def _aembed_batch(
+        self, model: Model, texts: Sequence[str]
+    ) -> list[list[float]]:
+        response = await self.transport.apost_json(
+            self.path("/v1/embeddings"), {"model": model.key, "input": list(texts)}
+        )
+        return self._read_embeddings(response)
+
+
+def _response_format(format: Union[str, dict]) -> dict:
+    """Translates the `format` option, as taken by Ollama, into the OpenAI compatible `response_format`."""
+    # Only schemas are supported, so any JSON is requested as any object.
+    schema = {"type": "object"} if format == "json" else format
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "response", "strict": True, "schema": schema},
+    }
@@ -1,24 +1,98 @@
-from typing import Optional, Sequence, Union
+from typing import Iterable, Optional, Sequence, Union
 from .capabilities import Capability
 
 
 class Model:
     """Individual model that a provider can issue inference for. Contains the information describing the model, and it's capabilities."""
 
+    __slots__ = (
+        "key",
+        "name",
+        "version",
+        "tag",
+        "max_image_size",
+        "_capabilities",
+        "_capability_mask",
+    )
+
     key: str
     """Unique URL-safe key for this model. Should be lower kebab-case and uses only ASCII characters."""
 
     name: str
     """Human-friendly displayable name for this provider. Should exclude any version information."""
 
-    version: str = "latest"
+    version: str
     """Version of the model. Suggested format is SEMVER."""
 
-    tag: Optional[str] = None
+    tag: Optional[str]
     """Optional tag that can be used to label quantization methods and bit sizing. """
 
-    capabilities: list[Capability] = []
-    """List of capabilities which this model provides. Can be more than one for multi-modal AI providers."""
+    max_image_size: Optional[int]
+    """Maximum width and height in pixels of images given to this model. Larger images are downscaled before being sent, avoiding the cost of encoding and transferring pixels the model would discard."""
+
+    def __init__(
+        self,
+        key: str = "",
+        name: Optional[str] = None,
+        version: str = "latest",
+        tag: Optional[str] = None,
+        capabilities: Iterable[Union[str, Capability]] = (),
+        max_image_size: Optional[int] = None,
+    ):
+        """Constructs a new model definition.
+
+        Args:
+            key (str, optional): Unique URL-safe key for this model. Defaults to "".
+            name (Optional[str], optional): Human-friendly displayable name. Defaults to the key.
+            version (str, optional): Version of the model. Defaults to "latest".
+            tag (Optional[str], optional): Tag labelling quantization methods and bit sizing. Defaults to None.
+            capabilities (Iterable[Union[str, Capability]], optional): Capabilities which this model provides. Defaults to ().
+            max_image_size (Optional[int], optional): Maximum width and height in pixels of images given to this model. Defaults to None.
+        """
+        self.key = key
+        self.name = name if name is not None else key
+        self.version = version
+        self.tag = tag
+        self.max_image_size = max_image_size
+        self.capabilities = capabilities
+
+    @property
+    def capabilities(self) -> list[Capability]:
+        """List of capabilities which this model provides. Can be more than one for multi-modal AI providers."""
+        return list(self._capabilities)
+
+    @capabilities.setter
+    def capabilities(self, capabilities: Iterable[Union[str, Capability]]) -> None:
+        self._capabilities = tuple(Capability(cap) for cap in capabilities)
+        self._capability_mask = Capability.mask(self._capabilities)
+
+    @property
+    def capability_mask(self) -> int:
+        """Bitmask of the capabilities this model provides. See `Capability.mask()`."""
+        return self._capability_mask
+
+    def to_dict(self) -> dict:
+        """Serializes the model definition into a JSON-compatible dictionary. See `Model.from_dict()`."""
+        return {
+            "key": self.key,
+            "name": self.name,
+            "version": self.version,
+            "tag": self.tag,
+            "capabilities": [cap.value for cap in self._capabilities],
+            "max_image_size": self.max_image_size,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Model":
+        """Constructs a model definition from a dictionary produced by `Model.to_dict()`."""
+        return cls(
+            key=data["key"],
+            name=data.get("name"),
+            version=data.get("version", "latest"),
+            tag=data.get("tag"),
+            capabilities=data.get("capabilities", ()),
+            max_image_size=data.get("max_image_size"),
+        )
 
     def __eq__(self, other):
         if isinstance(other, Model):
@@ -52,14 +126,9 @@ class Model:
         Returns:
             bool: True if the capability (or all capabilities) are provided by this model.
         """
-
-        if isinstance(capability, list):
-            for cap in capability:
-                if not self.has_capability(cap):
-                    return False
-            return True
-
-        for cap in self.capabilities:
-            if cap == capability:
-                return True
-        return False
+        try:
+            mask = Capability.mask(capability)
+        except ValueError:
+            # Unknown capabilities are never provided.
+            return False
+        return self._capability_mask & mask == mask
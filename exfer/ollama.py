@@ -1,27 +1,148 @@
-from typing import Generator, Optional, Sequence, Union
-from PIL.Image import Image
+import dataclasses
+import os
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncGenerator, Generator, Optional, Sequence, Union
 
 from .provider import Provider
+from .session import Session, SessionStore, current_session
+from .admission import AdmissionController
 from .model import Model
 from .capabilities import Capability
-from .utils import ping, encode_images
+from .stream import AsyncTextStream, TextStream
+from .instrumentation import report_stats
+from .transport import TransportException
+from .utils import ImageInput, ping
+from .utils.streams import NDJSONDecoder
+
+_VISION_FAMILIES = {"clip", "mllama"}
+"""Model families reported by `/api/tags` whose models accept images."""
+
+_EMBEDDING_FAMILIES = {"bert", "nomic-bert", "xlm-roberta"}
+"""Model families reported by `/api/tags` whose models only produce embeddings."""
+
+_DEFAULT_KEEP_ALIVE = 300.0
+"""Seconds Ollama keeps a model loaded after a request when no `keep_alive` is given, unless the server is configured otherwise."""
+
+_DURATION_UNITS = {
+    "ns": 1e-9,
+    "us": 1e-6,
+    "µs": 1e-6,
+    "ms": 1e-3,
+    "s": 1.0,
+    "m": 60.0,
+    "h": 3600.0,
+}
+_DURATION_PART = re.compile(r"(\d+(?:\.\d*)?|\.\d+)(ns|us|µs|ms|s|m|h)")
+
+
+def _keep_alive_seconds(keep_alive: Optional[Union[str, float]]) -> Optional[float]:
+    """Converts a `keep_alive`, either seconds or a Go duration such as "10m", into seconds. Returns None when
+    the model is kept loaded indefinitely, which Ollama does for negative durations."""
+    if keep_alive is None:
+        return _DEFAULT_KEEP_ALIVE
+    if isinstance(keep_alive, str):
+        text = keep_alive.strip()
+        try:
+            seconds = float(text)
+        except ValueError:
+            parts = _DURATION_PART.findall(text.lstrip("+-"))
+            if not parts:
+                return _DEFAULT_KEEP_ALIVE
+            seconds = sum(float(value) * _DURATION_UNITS[unit] for value, unit in parts)
+            if text.startswith("-"):
+                seconds = -seconds
+    else:
+        seconds = float(keep_alive)
+    return None if seconds < 0 else seconds
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[float]:
+    """Parses an RFC 3339 timestamp as given by Ollama into seconds since the epoch."""
+    if not value:
+        return None
+    # Go includes nanoseconds, which `datetime` does not accept.
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value).replace("Z", "+00:00")
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def _model_key(full_name: str) -> tuple[str, str, str]:
+    """Splits a model name reported by Ollama into its key, name and tag."""
+    name, _, tag = full_name.partition(":")
+    # Ollama resolves a name without a tag to ":latest", so the model is keyed the same way.
+    return (name if tag in ("", "latest") else full_name), name, tag
+
+
+@dataclass
+class LoadedModel:
+    """A model Ollama has loaded into memory, as listed by `/api/ps`."""
+
+    key: str
+    """Key of the model, matching the key in `Ollama.models`."""
+
+    size: Optional[int] = None
+    """Bytes of memory the model occupies."""
+
+    size_vram: Optional[int] = None
+    """Bytes of the model held in GPU memory."""
+
+    expires_at: Optional[float] = None
+    """Time the model will be unloaded at, in seconds since the epoch. None if it is kept loaded indefinitely."""
 
 
 class Ollama(Provider):
     @staticmethod
-    def check_env() -> bool:
-        return ping("http://localhost:11434/api/version")
+    def check_env(timeout: float = 2.0) -> bool:
+        return ping("http://localhost:11434/api/version", timeout)
+
+    keep_alive: Optional[Union[str, float]] = None
+    """How long models stay loaded after each request, given as seconds or a duration such as "10m". Negative values keep them loaded indefinitely. None uses the server's default, which is 5 minutes."""
+
+    loaded: dict[str, LoadedModel]
+    """Models the server has loaded, keyed like `models`. Listed by `Ollama.refresh_loaded()`, and updated as requests are made."""
+
+    loaded_refreshed: Optional[float] = None
+    """Monotonic timestamp of when `loaded` was last listed from the server, or None if it never has been."""
+
+    sessions: SessionStore
+    """Contexts returned for each `Session`, which are sent back with the session's next turn."""
 
     @classmethod
     def from_env(cls):
+        # Ollama runs OLLAMA_NUM_PARALLEL generations at once and queues the rest, so queue them here instead.
+        parallel = os.environ.get("OLLAMA_NUM_PARALLEL", "")
+        if parallel.isdigit() and int(parallel) > 0:
+            return cls(admission=AdmissionController(max_concurrency=int(parallel)))
         return cls()
 
-    def __init__(self, url_override: str | None = None):
-        super().__init__(base_url=url_override)
+    def __init__(
+        self,
+        url_override: str | None = None,
+        keep_alive: Optional[Union[str, float]] = None,
+        sessions: Optional[SessionStore] = None,
+        **kwargs,
+    ):
+        """Constructs a new provider.
+
+        Args:
+            url_override (str | None, optional): Base URL of the API. Defaults to the local default port.
+            keep_alive (Optional[Union[str, float]], optional): How long models stay loaded after each request. Defaults to None, which is the server's default.
+            sessions (Optional[SessionStore], optional): Store of the contexts returned for sessions. Defaults to a new `SessionStore`.
+            **kwargs: Additional keyword arguments passed to `Provider.__init__`.
+        """
+        super().__init__(base_url=url_override, **kwargs)
+        self.keep_alive = keep_alive
+        self.loaded = {}
+        self.sessions = sessions or SessionStore()
 
     @property
     def key(self) -> str:
-        return "ollama"
+        return self.key_override or "ollama"
 
     @property
     def name(self) -> str:
@@ -29,18 +150,151 @@ class Ollama(Provider):
 
     @property
     def capabilities(self) -> list[Capability]:
-        return [Capability.TEXT]
+        return [Capability.TEXT, Capability.EMBEDDING]
 
     def _default_base_url(self) -> str:
         return "http://localhost:11434"
 
+    def fetch_models(self) -> list[Model]:
+        response = self.transport.get_json(self.path("/api/tags"))
+        return [self._read_model(entry) for entry in response.get("models") or []]
+
+    def _read_model(self, entry: dict) -> Model:
+        """Converts an entry of the `/api/tags` listing into a model definition."""
+        key, name, tag = _model_key(entry.get("name") or entry.get("model") or "")
+
+        details = entry.get("details") or {}
+        families = set(details.get("families") or [details.get("family")])
+        if families & _EMBEDDING_FAMILIES or "embed" in name:
+            return Model(
+                key=key,
+                name=name,
+                tag=tag or None,
+                capabilities=[Capability.EMBEDDING],
+            )
+
+        capabilities = [Capability.TEXT]
+        if families & _VISION_FAMILIES:
+            capabilities.append(Capability.VISION)
+
+        return Model(key=key, name=name, tag=tag or None, capabilities=capabilities)
+
+    def fetch_loaded(self) -> list[LoadedModel]:
+        """Lists the models the server currently has loaded into memory. Does not modify `loaded`, see `Ollama.refresh_loaded()`.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+
+        Returns:
+            list[LoadedModel]: The loaded models.
+        """
+        response = self.transport.get_json(self.path("/api/ps"))
+        return [
+            LoadedModel(
+                key=_model_key(entry.get("name") or entry.get("model") or "")[0],
+                size=entry.get("size"),
+                size_vram=entry.get("size_vram"),
+                expires_at=_parse_timestamp(entry.get("expires_at")),
+            )
+            for entry in response.get("models") or []
+        ]
+
+    def refresh_loaded(self) -> None:
+        self.loaded = {model.key: model for model in self.fetch_loaded()}
+        self.loaded_refreshed = time.monotonic()
+
+    def is_loaded(self, model: Union[str, Model]) -> Optional[bool]:
+        loaded = self.loaded.get(model.key if isinstance(model, Model) else model)
+        if loaded is None:
+            return False
+        return loaded.expires_at is None or loaded.expires_at > time.time()
+
+    def _mark_loaded(self, key: str, keep_alive: Optional[Union[str, float]]) -> None:
+        """Records that a successful request has loaded the model, expiring after the keep alive."""
+        seconds = _keep_alive_seconds(keep_alive)
+        expires_at = None if seconds is None else time.time() + seconds
+        current = self.loaded.get(key)
+        if current is None:
+            self.loaded[key] = LoadedModel(key, expires_at=expires_at)
+        else:
+            self.loaded[key] = dataclasses.replace(current, expires_at=expires_at)
+
+    def _make_preload_request(
+        self, model: Union[str, Model], keep_alive: Optional[Union[str, float]]
+    ) -> dict:
+        # A request without a prompt only loads the model.
+        request: dict = {"model": self.get_model(model).key, "stream": False}
+        keep_alive = self.keep_alive if keep_alive is None else keep_alive
+        if keep_alive is not None:
+            request["keep_alive"] = keep_alive
+        return request
+
+    def preload(
+        self, model: Union[str, Model], keep_alive: Optional[Union[str, float]] = None
+    ) -> bool:
+        """Loads a model into the server's memory ahead of the requests for it. Preloading a model that is
+        already loaded extends how long it stays loaded for.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            keep_alive (Optional[Union[str, float]], optional): How long the model stays loaded for. Defaults to None, which is `Ollama.keep_alive`.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+
+        Returns:
+            bool: Always True.
+        """
+        request = self._make_preload_request(model, keep_alive)
+        self.transport.post_json(self.path("/api/generate"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return True
+
+    async def apreload(
+        self, model: Union[str, Model], keep_alive: Optional[Union[str, float]] = None
+    ) -> bool:
+        """Loads a model into the server's memory using asyncio. Mirrors `Ollama.preload()`."""
+        request = self._make_preload_request(model, keep_alive)
+        await self.transport.apost_json(self.path("/api/generate"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return True
+
+    def unload(self, model: Union[str, Model]) -> None:
+        """Unloads a model from the server's memory immediately.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+        """
+        request = self._make_preload_request(model, 0)
+        self.transport.post_json(self.path("/api/generate"), request)
+        self.loaded.pop(request["model"], None)
+
+    def session(
+        self, model: Union[str, Model], system_prompt: Optional[str] = None
+    ) -> Session:
+        """Starts a multi-turn conversation with a model. Each turn sends back the context returned for the
+        previous one, so the server continues from it rather than processing the conversation again.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            system_prompt (Optional[str], optional): System prompt of the conversation. Defaults to None.
+
+        Returns:
+            Session: The new session, whose contexts are kept in `sessions`.
+        """
+        return Session(self, model, system_prompt, self.sessions)
+
     def _make_generate_request(
         self,
         model: Union[str, Model],
         prompt: str,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
+        images: Optional[ImageInput] = None,
         stream: bool = False,
+        options: Optional[dict] = None,
     ) -> dict:
         capabilities = [Capability.TEXT]
         if images is not None:
@@ -56,30 +310,222 @@ class Ollama(Provider):
         if system_prompt is not None:
             request["system"] = system_prompt
         if images is not None:
-            request["images"] = encode_images(images)
-
+            request["images"] = self._encode_images(
+                images, as_data=False, max_size=model.max_image_size
+            )
+        if options is not None and "format" in options:
+            # Structured output is requested at the top-level, rather than as a model option.
+            options = dict(options)
+            request["format"] = options.pop("format")
+        if options is not None:
+            request["options"] = options
+        if self.keep_alive is not None:
+            request["keep_alive"] = self.keep_alive
+        session = current_session.get()
+        if session is not None:
+            context = session.context
+            if context is not None:
+                request["context"] = context.tolist()
         return request
 
-    def _generate_sync(
+    async def _amake_generate_request(
         self,
         model: Union[str, Model],
         prompt: str,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
+        images: Optional[ImageInput] = None,
+        stream: bool = False,
+        options: Optional[dict] = None,
+    ) -> dict:
+        # Encoding images is CPU bound, so keep it off of the event loop.
+        if images is not None:
+            import asyncio
+
+            return await asyncio.to_thread(
+                self._make_generate_request,
+                model,
+                prompt,
+                system_prompt,
+                images,
+                stream,
+                options,
+            )
+        return self._make_generate_request(
+            model, prompt, system_prompt, images, stream, options
+        )
+
+    def _generate_text_sync(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
     ) -> str:
         request = self._make_generate_request(
-            model, prompt, system_prompt, images, False
+            model, prompt, system_prompt, images, False, options
         )
-        return ""
+        response = self.transport.post_json(self.path("/api/generate"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return self._read_response(response)
+
+    def _read_response(self, response: dict) -> str:
+        """Reads the non-streamed response, reporting the remaining fields as its stats."""
+        text = response.pop("response", "")
+        self._take_context(response)
+        report_stats(response)
+        return text
 
-    def _generate_async(
+    def _take_context(self, response: dict) -> None:
+        """Hands the context returned with a response to the current session, if any, rather than keeping it in the stats."""
+        session = current_session.get()
+        if session is not None:
+            session.receive_context(response.pop("context", None))
+
+    def _generate_text_async(
         self,
         model: str | Model,
         prompt: str,
         system_prompt: str | None = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> TextStream:
+        return TextStream(
+            lambda stream: self._stream_generate(
+                stream, model, prompt, system_prompt, images, options
+            )
+        )
+
+    def _read_record(
+        self, record: dict, stream: Union[TextStream, AsyncTextStream]
+    ) -> str:
+        """Reads a record of the streamed NDJSON response, returning its fragment. The final record is stored as the stream's stats."""
+        if "error" in record:
+            raise TransportException(f"{self.key} failed generating: {record['error']}")
+        if record.get("done"):
+            stats = dict(record)
+            fragment = stats.pop("response", "")
+            self._take_context(stats)
+            stream.stats = stats
+            return fragment
+        return record.get("response", "")
+
+    def _stream_generate(
+        self,
+        stream: TextStream,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
     ) -> Generator[str, None, None]:
         request = self._make_generate_request(
-            model, prompt, system_prompt, images, True
+            model, prompt, system_prompt, images, True, options
         )
-        yield ""
+        decoder = NDJSONDecoder()
+        with self.transport.stream(
+            "POST", self.path("/api/generate"), json=request
+        ) as response:
+            # A chunk size of None hands over the data as soon as it is received.
+            for chunk in response.iter_content(chunk_size=None):
+                for record in decoder.feed(chunk):
+                    fragment = self._read_record(record, stream)
+                    if fragment:
+                        yield fragment
+                    if stream.stats is not None:
+                        self._mark_loaded(request["model"], request.get("keep_alive"))
+                        return
+            for record in decoder.flush():
+                fragment = self._read_record(record, stream)
+                if fragment:
+                    yield fragment
+            if stream.stats is not None:
+                self._mark_loaded(request["model"], request.get("keep_alive"))
+
+    async def _agenerate_text_sync(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> str:
+        request = await self._amake_generate_request(
+            model, prompt, system_prompt, images, False, options
+        )
+        response = await self.transport.apost_json(self.path("/api/generate"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return self._read_response(response)
+
+    def _agenerate_text_async(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> AsyncTextStream:
+        return AsyncTextStream(
+            lambda stream: self._astream_generate(
+                stream, model, prompt, system_prompt, images, options
+            )
+        )
+
+    async def _astream_generate(
+        self,
+        stream: AsyncTextStream,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> AsyncGenerator[str, None]:
+        request = await self._amake_generate_request(
+            model, prompt, system_prompt, images, True, options
+        )
+        decoder = NDJSONDecoder()
+        async with self.transport.astream(
+            "POST", self.path("/api/generate"), json=request
+        ) as response:
+            async for chunk in response.aiter_bytes():
+                for record in decoder.feed(chunk):
+                    fragment = self._read_record(record, stream)
+                    if fragment:
+                        yield fragment
+                    if stream.stats is not None:
+                        self._mark_loaded(request["model"], request.get("keep_alive"))
+                        return
+            for record in decoder.flush():
+                fragment = self._read_record(record, stream)
+                if fragment:
+                    yield fragment
+            if stream.stats is not None:
+                self._mark_loaded(request["model"], request.get("keep_alive"))
+
+    def _make_embed_request(self, model: Model, texts: Sequence[str]) -> dict:
+        request: dict = {"model": model.key, "input": list(texts)}
+        if self.keep_alive is not None:
+            request["keep_alive"] = self.keep_alive
+        return request
+
+    def _read_embeddings(self, response: dict) -> list[list[float]]:
+        """Reads the embeddings from an `/api/embed` response, reporting the remaining fields as its stats."""
+        embeddings = response.pop("embeddings", None)
+        if embeddings is None:
+            raise TransportException(f"{self.key} returned no embeddings")
+        report_stats(response)
+        return embeddings
+
+    def _embed_batch(self, model: Model, texts: Sequence[str]) -> list[list[float]]:
+        request = self._make_embed_request(model, texts)
+        response = self.transport.post_json(self.path("/api/embed"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return self._read_embeddings(response)
+
+    async def _aembed_batch(
+        self, model: Model, texts: Sequence[str]
+    ) -> list[list[float]]:
+        request = self._make_embed_request(model, texts)
+        response = await self.transport.apost_json(self.path("/api/embed"), request)
+        self._mark_loaded(request["model"], request.get("keep_alive"))
+        return self._read_embeddings(response)
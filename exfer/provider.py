@@ -1,9 +1,38 @@
+import json
+import time
 from abc import ABC, abstractmethod
-from typing import Generator, Literal, Optional, Sequence, Union, overload
-from PIL.Image import Image
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Generator,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Union,
+    overload,
+)
 
 from .capabilities import Capability, CapabilitiesException
 from .model import Model
+from .transport import Transport
+from .cache import Cache, make_cache_key
+from .instrumentation import Instrumentation, Trace, current_trace, record
+from .singleflight import SingleFlight
+from .admission import AdmissionController, used_tokens
+from .session import Session, current_session
+from .stream import AsyncTextStream, TextStream
+from .embedding import EmbeddingOutput, EmbeddingWriter, batch_ranges
+from .utils import ImageInput, encode_images
+
+if TYPE_CHECKING:
+    import numpy
 
 
 class ModelNotFoundException(Exception):
@@ -16,14 +45,38 @@ class Provider(ABC):
     base_url: str
     """Base url for the provider in which API endpoints will be appended to. Should follow standard HTTP protocol and domain name. Does not need the ending slash."""
 
-    models: dict[str, Model] = {}
+    models: dict[str, Model]
     """Dictionary mapping model keys to their model definition. These are the available models within a given provider."""
 
+    models_refreshed: Optional[float] = None
+    """Monotonic timestamp of when `models` was last refreshed from the provider's API, or None if it never has been."""
+
+    transport: Transport
+    """Pooled HTTP transport that all requests to this provider's API go through."""
+
+    key_override: Optional[str] = None
+    """Replaces the default `key` of the provider. Allows multiple instances of the same provider type, such as two Ollama hosts, to be registered side-by-side."""
+
+    cache: Optional[Cache] = None
+    """Opt-in cache of generated responses. When set, repeated requests for the same model, prompts, images and options are answered from the cache. Only suitable for deterministic generation."""
+
+    single_flight: Optional[SingleFlight] = None
+    """Opt-in coalescing of concurrent identical requests, which then share a single generation. Can be shared between providers, so that a request in flight on one also serves identical requests routed to another, when both describe the model the same way."""
+
+    admission: Optional[AdmissionController] = None
+    """Opt-in limits on the requests issued to the backend, queueing the excess by priority. Should be sized to the parallelism of the backend."""
+
+    instrumentation: Optional[Instrumentation] = None
+    """Opt-in hooks which observe the timings, sizes and token counts of each generation call. See `exfer.instrumentation`."""
+
     @staticmethod
     @abstractmethod
-    def check_env() -> bool:
+    def check_env(timeout: float = 2.0) -> bool:
         """Check if this Provider type might exist based on OS environment.
 
+        Args:
+            timeout (float, optional): Seconds to wait on any network checks. Defaults to 2.0.
+
         Returns:
             bool: True if we believe there are settings or availability for this provider type.
         """
@@ -36,8 +89,43 @@ class Provider(ABC):
         Should use `Provider.check_env()` first to ensure it is possible."""
         return cls()
 
-    def __init__(self, base_url: Optional[str] = None):
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        transport: Optional[Transport] = None,
+        key_override: Optional[str] = None,
+        cache: Optional[Cache] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        single_flight: Optional[SingleFlight] = None,
+        admission: Optional[AdmissionController] = None,
+    ):
+        """Constructs a new provider.
+
+        Args:
+            base_url (Optional[str], optional): Base URL of the provider's API. Defaults to the provider's default URL.
+            transport (Optional[Transport], optional): HTTP transport to use. Defaults to a new `Transport`.
+            key_override (Optional[str], optional): Replaces the default `key` of the provider. Defaults to None.
+            cache (Optional[Cache], optional): Cache of generated responses. Defaults to None, which disables caching.
+            instrumentation (Optional[Instrumentation], optional): Hooks observing each generation call. Defaults to None, which disables instrumentation.
+            single_flight (Optional[SingleFlight], optional): Coalescing of concurrent identical requests. Defaults to None, which disables coalescing.
+            admission (Optional[AdmissionController], optional): Limits on the requests issued to the backend. Defaults to None, which issues them immediately.
+        """
         self.base_url = base_url or self._default_base_url()
+        self.models = {}
+        self.transport = transport or Transport()
+        self.key_override = key_override
+        self.cache = cache
+        self.instrumentation = instrumentation
+        self.single_flight = single_flight
+        self.admission = admission
+
+    def close(self) -> None:
+        """Releases any pooled connections held by this provider's transport."""
+        self.transport.close()
+
+    async def aclose(self) -> None:
+        """Releases any pooled connections, synchronous and asynchronous, held by this provider's transport."""
+        await self.transport.aclose()
 
     @property
     @abstractmethod
@@ -62,6 +150,94 @@ class Provider(ABC):
         """Return the default base URL for this provider."""
         ...
 
+    @abstractmethod
+    def fetch_models(self) -> list[Model]:
+        """Lists the models currently available from the provider's API. Does not modify `models`, see `refresh_models()`.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+
+        Returns:
+            list[Model]: The available models.
+        """
+        ...
+
+    def refresh_models(self) -> tuple[list[Model], list[Model]]:
+        """Replaces `models` with the models currently available from the provider's API, and reports what changed.
+
+        Raises:
+            TransportException: If the provider could not be reached. The current `models` are kept.
+
+        Returns:
+            tuple[list[Model], list[Model]]: The models which were added or changed, and the models which were removed.
+        """
+        fetched = {model.key: model for model in self.fetch_models() if model.key}
+        current = self.models
+        for key, model in fetched.items():
+            # The API does not report client-side settings, so keep the ones configured on the previous definition.
+            if key in current and model.max_image_size is None:
+                model.max_image_size = current[key].max_image_size
+        changed = [
+            model
+            for key, model in fetched.items()
+            if key not in current or current[key].to_dict() != model.to_dict()
+        ]
+        removed = [model for key, model in current.items() if key not in fetched]
+        # Swapped in whole so that concurrent readers see either the old or the new listing.
+        self.models = fetched
+        self.models_refreshed = time.monotonic()
+        return changed, removed
+
+    def is_loaded(self, model: Union[str, Model]) -> Optional[bool]:
+        """Whether the backend currently has the model loaded into memory, so that a request avoids a cold start.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+
+        Returns:
+            Optional[bool]: True if loaded, False if not, or None if the provider doesn't track which models are loaded.
+        """
+        return None
+
+    def refresh_loaded(self) -> None:
+        """Updates which models the backend has loaded, see `Provider.is_loaded()`. Does nothing for providers that don't track it.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+        """
+        return None
+
+    def preload(
+        self, model: Union[str, Model], keep_alive: Optional[Union[str, float]] = None
+    ) -> bool:
+        """Loads a model into the backend's memory ahead of the requests for it.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            keep_alive (Optional[Union[str, float]], optional): How long the model stays loaded for. Defaults to None, which is the provider's default.
+
+        Raises:
+            TransportException: If the provider could not be reached.
+
+        Returns:
+            bool: True if the model was loaded, False if the provider doesn't support preloading.
+        """
+        return False
+
+    def session(
+        self, model: Union[str, Model], system_prompt: Optional[str] = None
+    ) -> Session:
+        """Starts a multi-turn conversation with a model, see `Session`.
+
+        Args:
+            model (Union[str, Model]): Either the key for the model, or the model itself.
+            system_prompt (Optional[str], optional): System prompt of the conversation. Defaults to None.
+
+        Returns:
+            Session: The new session. This provider sends it the conversation so far every turn.
+        """
+        return Session(self, model, system_prompt)
+
     @property
     def models_list(self) -> list[Model]:
         """The available models in this Provider returned as a list."""
@@ -113,18 +289,12 @@ class Provider(ABC):
             bool: True if the capability (or all capabilities) are provided by this provider.
         """
 
-        if isinstance(capability, list):
-            for cap in capability:
-                if not self.has_capability(cap):
-                    return False
-            return True
-        elif isinstance(capability, str):
-            capability = Capability(capability)
-
-        for cap in self.capabilities:
-            if cap == capability:
-                return True
-        return False
+        try:
+            mask = Capability.mask(capability)
+        except ValueError:
+            # Unknown capabilities are never provided.
+            return False
+        return Capability.mask(self.capabilities) & mask == mask
 
     def get_model(
         self, model: Union[str, Model], capabilities: Optional[list[Capability]] = None
@@ -142,16 +312,15 @@ class Provider(ABC):
         Returns:
             Model: Model as it exists in this provider's data.
         """
-        result: Model = (
-            self.models[model.key] if isinstance(model, Model) else self.models[model]
-        )
+        key = model.key if isinstance(model, Model) else model
+        result = self.models.get(key)
         if result is None:
             raise ModelNotFoundException(
-                f"model {model if type(model) is str else model.key} is not registered to the provider {self.key}"
+                f"model {key} is not registered to the provider {self.key}"
             )
         if capabilities is not None and not result.has_capability(capabilities):
             raise CapabilitiesException(
-                f"model {result.key} does not match the capabilities of {", ".join(capabilities)}"
+                f"model {result.key} does not match the capabilities of {', '.join(capabilities)}"
             )
         return result
 
@@ -175,7 +344,8 @@ class Provider(ABC):
         prompt: str,
         stream: Literal[False] = False,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
     ) -> str: ...
 
     @overload
@@ -185,8 +355,9 @@ class Provider(ABC):
         prompt: str,
         stream: Literal[True],
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
-    ) -> Generator[str]: ...
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> TextStream: ...
 
     def generate_text(
         self,
@@ -194,8 +365,9 @@ class Provider(ABC):
         prompt: str,
         stream: bool = False,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
-    ) -> Union[str, Generator[str]]:
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[str, TextStream]:
         """Generate a text completion. Requires that the model supports `Compatibility.TEXT`.
 
         Args:
@@ -203,13 +375,238 @@ class Provider(ABC):
             prompt (str): Given prompt string to provide as user context.
             stream (bool, optional): Whether to use streaming. Defaults to False.
             system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
 
         Returns:
-            Union[str, Generator[str]]: Either the complete response, or a generator which yields fragments (requires stream = True).
+            Union[str, TextStream]: Either the complete response, or a stream which yields fragments (requires stream = True).
         """
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            return self._generate_traced(
+                instrumentation,
+                model,
+                prompt,
+                stream,
+                system_prompt,
+                images,
+                options,
+            )
+        return self._generate_text(
+            model, prompt, stream, system_prompt, images, options
+        )
+
+    def _generate_text(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[str, TextStream]:
+        # Responses within a session depend on the conversation so far, so they can't be shared.
+        if (
+            self.cache is None and self.single_flight is None
+        ) or current_session.get() is not None:
+            return self._request(model, prompt, stream, system_prompt, images, options)
+
+        key = make_cache_key(
+            self.get_model(model), prompt, system_prompt, images, options
+        )
+        if self.cache is not None:
+            fragments = self.cache.get(key)
+            if fragments is not None:
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.cached = True
+                return TextStream.of(fragments) if stream else "".join(fragments)
+
+        def start() -> Union[str, TextStream]:
+            return self._generate_uncached(
+                key, model, prompt, stream, system_prompt, images, options
+            )
+
+        if self.single_flight is not None:
+            if stream:
+                return self.single_flight.stream(key, start)
+            return self.single_flight.generate(key, start)
+        return start()
+
+    def _generate_uncached(
+        self,
+        key: str,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[str, TextStream]:
+        """Generates a response which was not in the cache, adding it to the cache once complete."""
+        result = self._request(model, prompt, stream, system_prompt, images, options)
+        if self.cache is not None:
+            if isinstance(result, TextStream):
+                return result.pipe(lambda fragments: self._cache_stream(key, fragments))
+            self.cache.set(key, [result])
+        return result
+
+    def _request(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[str, TextStream]:
+        """Issues the request to the backend, once admitted by the `admission` controller if one is set."""
+        admission = self.admission
         if stream:
-            return self._generate_text_async(model, prompt, system_prompt)
-        return self._generate_text_sync(model, prompt, system_prompt)
+            result = TextStream.of(
+                self._generate_text_async(model, prompt, system_prompt, images, options)
+            )
+            if admission is None:
+                return result
+            return result.pipe(
+                lambda fragments: self._admit_stream(
+                    admission, result, fragments, prompt, system_prompt
+                )
+            )
+        if admission is None:
+            return self._generate_text_sync(
+                model, prompt, system_prompt, images, options
+            )
+        ticket = admission.acquire()
+        try:
+            text = self._generate_text_sync(
+                model, prompt, system_prompt, images, options
+            )
+        except BaseException:
+            ticket.release()
+            raise
+        ticket.release(used_tokens(None, _chars(prompt, system_prompt, text)))
+        return text
+
+    def _admit_stream(
+        self,
+        admission: AdmissionController,
+        stream: TextStream,
+        fragments: Iterator[str],
+        prompt: str,
+        system_prompt: Optional[str],
+    ) -> Generator[str]:
+        """Passes through a fragment stream, only starting it once admitted, and releasing the admission once it has finished."""
+        ticket = admission.acquire()
+        chars = _chars(prompt, system_prompt)
+        try:
+            for fragment in fragments:
+                chars += len(fragment)
+                yield fragment
+        finally:
+            ticket.release(used_tokens(stream.stats, chars))
+
+    def _start_trace(
+        self,
+        instrumentation: Instrumentation,
+        model: Union[str, Model],
+        stream: bool,
+    ) -> tuple[Trace, Model]:
+        """Begins the trace of a call, and resolves its model. The trace is current while resolving."""
+        trace = instrumentation.start(
+            self.key, model.key if isinstance(model, Model) else model, stream
+        )
+        token = current_trace.set(trace)
+        try:
+            start = time.perf_counter()
+            resolved = self.get_model(model)
+            trace.add("resolve", time.perf_counter() - start)
+        except BaseException as e:
+            instrumentation.finish(trace, e)
+            raise
+        finally:
+            current_trace.reset(token)
+        return trace, resolved
+
+    def _generate_traced(
+        self,
+        instrumentation: Instrumentation,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[str, TextStream]:
+        """Runs `_generate_text()` with a trace current, reporting it to the instrumentation once finished."""
+        trace, resolved = self._start_trace(instrumentation, model, stream)
+        token = current_trace.set(trace)
+        try:
+            result = self._generate_text(
+                resolved, prompt, stream, system_prompt, images, options
+            )
+        except BaseException as e:
+            instrumentation.finish(trace, e)
+            raise
+        finally:
+            current_trace.reset(token)
+
+        if isinstance(result, TextStream):
+            return result.pipe(
+                lambda fragments: self._trace_stream(
+                    instrumentation, trace, result, fragments
+                )
+            )
+        instrumentation.finish(trace)
+        return result
+
+    def _trace_stream(
+        self,
+        instrumentation: Instrumentation,
+        trace: Trace,
+        stream: TextStream,
+        fragments: Iterator[str],
+    ) -> Generator[str]:
+        """Passes through a fragment stream, making the trace current while each fragment is produced."""
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                # The request is only issued once the stream is iterated, so the trace needs to be current then.
+                token = current_trace.set(trace)
+                try:
+                    fragment = next(fragments)
+                except StopIteration:
+                    break
+                finally:
+                    current_trace.reset(token)
+                trace.fragment()
+                yield fragment
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            trace.report_stats(stream.stats)
+            instrumentation.finish(trace, error)
+
+    def _cache_stream(self, key: str, stream: Iterator[str]) -> Generator[str]:
+        """Passes through a fragment stream, caching the fragments once it has completed."""
+        fragments: list[str] = []
+        for fragment in stream:
+            fragments.append(fragment)
+            yield fragment
+        if self.cache is not None:
+            self.cache.set(key, fragments)
+
+    def _encode_images(
+        self, images: ImageInput, as_data: bool, max_size: Optional[int]
+    ) -> list[str]:
+        """Encodes the images of a request, see `encode_images()`, adding the time spent to the current trace."""
+        start = time.perf_counter()
+        encoded = encode_images(images, as_data=as_data, max_size=max_size)
+        record("encode", time.perf_counter() - start)
+        return encoded
 
     @abstractmethod
     def _generate_text_sync(
@@ -217,7 +614,8 @@ class Provider(ABC):
         model: Union[str, Model],
         prompt: str,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
     ) -> str: ...
 
     @abstractmethod
@@ -226,5 +624,510 @@ class Provider(ABC):
         model: Union[str, Model],
         prompt: str,
         system_prompt: Optional[str] = None,
-        images: Optional[Union[str, Image, Sequence[Union[str, Image]]]] = None,
-    ) -> Generator[str]: ...
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Iterable[str]: ...
+
+    @overload
+    def agenerate_text(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[False] = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Coroutine[None, None, str]: ...
+
+    @overload
+    def agenerate_text(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: Literal[True],
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> AsyncTextStream: ...
+
+    def agenerate_text(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        """Generate a text completion using asyncio. Mirrors `Provider.generate_text()`, but the
+        complete response is returned as a coroutine to be awaited, and the streamed fragments as an
+        async stream to be used with `async for`.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[Coroutine[None, None, str], AsyncTextStream]: Either a coroutine resolving to the complete response, or an async stream which yields fragments (requires stream = True).
+        """
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            trace, resolved = self._start_trace(instrumentation, model, stream)
+            if stream:
+                result = self._agenerate_text(
+                    resolved, prompt, True, system_prompt, images, options
+                )
+                return result.pipe(
+                    lambda fragments: self._atrace_stream(
+                        instrumentation, trace, result, fragments
+                    )
+                )
+            return self._atrace(
+                instrumentation,
+                trace,
+                lambda: self._agenerate_text(
+                    resolved, prompt, False, system_prompt, images, options
+                ),
+            )
+        return self._agenerate_text(
+            model, prompt, stream, system_prompt, images, options
+        )
+
+    def _agenerate_text(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        if (
+            self.cache is None and self.single_flight is None
+        ) or current_session.get() is not None:
+            return self._arequest(model, prompt, stream, system_prompt, images, options)
+
+        key = make_cache_key(
+            self.get_model(model), prompt, system_prompt, images, options
+        )
+        if self.cache is not None:
+            fragments = self.cache.get(key)
+            if fragments is not None:
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.cached = True
+                if stream:
+                    return AsyncTextStream.of(self._areplay(fragments))
+                return self._ajoin(self._areplay(fragments))
+
+        def start() -> Union[Coroutine[None, None, str], AsyncTextStream]:
+            return self._agenerate_uncached(
+                key, model, prompt, stream, system_prompt, images, options
+            )
+
+        if self.single_flight is not None:
+            if stream:
+                return self.single_flight.astream(key, start)
+            return self.single_flight.agenerate(key, start)
+        return start()
+
+    def _agenerate_uncached(
+        self,
+        key: str,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        """Generates a response which was not in the cache using asyncio, adding it to the cache once complete."""
+        result = self._arequest(model, prompt, stream, system_prompt, images, options)
+        if self.cache is None:
+            return result
+        if isinstance(result, AsyncTextStream):
+            return result.pipe(lambda fragments: self._acache_stream(key, fragments))
+        return self._acache(key, result)
+
+    def _arequest(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        stream: bool,
+        system_prompt: Optional[str],
+        images: Optional[ImageInput],
+        options: Optional[dict],
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        """Issues the request to the backend using asyncio, once admitted by the `admission` controller if one is set."""
+        admission = self.admission
+        if stream:
+            result = AsyncTextStream.of(
+                self._agenerate_text_async(
+                    model, prompt, system_prompt, images, options
+                )
+            )
+            if admission is None:
+                return result
+            return result.pipe(
+                lambda fragments: self._aadmit_stream(
+                    admission, result, fragments, prompt, system_prompt
+                )
+            )
+        if admission is None:
+            return self._agenerate_text_sync(
+                model, prompt, system_prompt, images, options
+            )
+        return self._aadmit(
+            admission,
+            lambda: self._agenerate_text_sync(
+                model, prompt, system_prompt, images, options
+            ),
+            prompt,
+            system_prompt,
+        )
+
+    async def _aadmit(
+        self,
+        admission: AdmissionController,
+        call: Callable[[], Coroutine[None, None, str]],
+        prompt: str,
+        system_prompt: Optional[str],
+    ) -> str:
+        """Awaits a call once admitted, releasing the admission once it has finished."""
+        ticket = await admission.aacquire()
+        try:
+            text = await call()
+        except BaseException:
+            ticket.release()
+            raise
+        ticket.release(used_tokens(None, _chars(prompt, system_prompt, text)))
+        return text
+
+    async def _aadmit_stream(
+        self,
+        admission: AdmissionController,
+        stream: AsyncTextStream,
+        fragments: AsyncIterator[str],
+        prompt: str,
+        system_prompt: Optional[str],
+    ) -> AsyncGenerator[str]:
+        """Passes through an async fragment stream, only starting it once admitted, and releasing the admission once it has finished."""
+        ticket = await admission.aacquire()
+        chars = _chars(prompt, system_prompt)
+        try:
+            async for fragment in fragments:
+                chars += len(fragment)
+                yield fragment
+        finally:
+            ticket.release(used_tokens(stream.stats, chars))
+
+    async def _atrace(
+        self,
+        instrumentation: Instrumentation,
+        trace: Trace,
+        call: Callable[[], Coroutine[None, None, str]],
+    ) -> str:
+        """Awaits a call with a trace current, reporting it to the instrumentation once finished."""
+        token = current_trace.set(trace)
+        try:
+            result = await call()
+        except BaseException as e:
+            instrumentation.finish(trace, e)
+            raise
+        finally:
+            current_trace.reset(token)
+        instrumentation.finish(trace)
+        return result
+
+    async def _atrace_stream(
+        self,
+        instrumentation: Instrumentation,
+        trace: Trace,
+        stream: AsyncTextStream,
+        fragments: AsyncIterator[str],
+    ) -> AsyncGenerator[str]:
+        """Passes through an async fragment stream, making the trace current while each fragment is produced."""
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                token = current_trace.set(trace)
+                try:
+                    fragment = await anext(fragments)
+                except StopAsyncIteration:
+                    break
+                finally:
+                    current_trace.reset(token)
+                trace.fragment()
+                yield fragment
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            trace.report_stats(stream.stats)
+            instrumentation.finish(trace, error)
+
+    async def _areplay(self, fragments: list[str]) -> AsyncGenerator[str]:
+        for fragment in fragments:
+            yield fragment
+
+    async def _ajoin(self, fragments: AsyncIterator[str]) -> str:
+        return "".join([fragment async for fragment in fragments])
+
+    async def _acache(self, key: str, call: Coroutine[None, None, str]) -> str:
+        """Awaits a generation, and caches its result."""
+        result = await call
+        if self.cache is not None:
+            self.cache.set(key, [result])
+        return result
+
+    async def _acache_stream(
+        self, key: str, stream: AsyncIterator[str]
+    ) -> AsyncGenerator[str]:
+        """Passes through an async fragment stream, caching the fragments once it has completed."""
+        fragments: list[str] = []
+        async for fragment in stream:
+            fragments.append(fragment)
+            yield fragment
+        if self.cache is not None:
+            self.cache.set(key, fragments)
+
+    @abstractmethod
+    async def _agenerate_text_sync(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> str: ...
+
+    @abstractmethod
+    def _agenerate_text_async(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> AsyncIterable[str]: ...
+
+    def generate_json(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        schema: Optional[dict] = None,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Any, TextStream]:
+        """Generate structured output, constraining the model to produce JSON which matches a schema. The schema is
+        given to `generate_text()` as the `format` option, which each provider passes on to its API.
+
+        Example:
+            for event in ollama.generate_json('llama3.2', prompt, schema, stream=True).json():
+                if len(event.path) == 2 and event.path[0] == 'items':
+                    handle(event.value)  # Each item, as soon as it has been generated.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            schema (Optional[dict], optional): JSON schema of the response. Defaults to None, which allows any JSON.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Raises:
+            ValueError: If the response is not valid JSON.
+
+        Returns:
+            Union[Any, TextStream]: Either the decoded response, or a stream of the response text, whose `json()` emits values as they complete (requires stream = True).
+        """
+        options = json_options(schema, options)
+        if stream:
+            return self.generate_text(
+                model, prompt, True, system_prompt, images, options
+            )
+        return json.loads(
+            self.generate_text(model, prompt, False, system_prompt, images, options)
+        )
+
+    def agenerate_json(
+        self,
+        model: Union[str, Model],
+        prompt: str,
+        schema: Optional[dict] = None,
+        stream: bool = False,
+        system_prompt: Optional[str] = None,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Coroutine[None, None, Any], AsyncTextStream]:
+        """Generate structured output using asyncio. Mirrors `Provider.generate_json()`.
+
+        Args:
+            model (str | Model): Key for the model to use, or the actual model card.
+            prompt (str): Given prompt string to provide as user context.
+            schema (Optional[dict], optional): JSON schema of the response. Defaults to None, which allows any JSON.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            system_prompt (str, optional): An additional top-level system prompt to inject into the context. Defaults to None.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[Coroutine[None, None, Any], AsyncTextStream]: Either a coroutine resolving to the decoded response, or an async stream of the response text (requires stream = True).
+        """
+        options = json_options(schema, options)
+        if stream:
+            return self.agenerate_text(
+                model, prompt, True, system_prompt, images, options
+            )
+        return aload_json(
+            self.agenerate_text(model, prompt, False, system_prompt, images, options)
+        )
+
+    def embed(
+        self,
+        model: Union[str, Model],
+        inputs: Union[str, Sequence[str]],
+        batch_size: int = 64,
+        max_batch_chars: int = 32768,
+        out: Optional[EmbeddingOutput] = None,
+    ) -> "numpy.ndarray":
+        """Embeds the inputs, sending them to the backend in batches. Each batch is copied into the result as it
+        arrives, so embedding a large corpus into a memory-mapped `out` never holds more than one batch in memory.
+        Requires NumPy.
+
+        Args:
+            model (Union[str, Model]): Either the key for the embedding model, or the model itself.
+            inputs (Union[str, Sequence[str]]): Text, or texts, to embed.
+            batch_size (int, optional): Maximum number of inputs per request. Defaults to 64.
+            max_batch_chars (int, optional): Maximum combined length of the inputs per request. Defaults to 32768.
+            out (Optional[EmbeddingOutput], optional): Path of a `.npy` file to write a memory-mapped result to, or a float32 array to fill. Defaults to None, which allocates a new array.
+
+        Raises:
+            ModelNotFoundException: If the model is not registered to this provider.
+            CapabilitiesException: If the model, or this provider, doesn't support embeddings.
+            TransportException: If the provider could not be reached, or returned malformed embeddings.
+            AdmissionException: If the `admission` controller rejected a batch.
+
+        Returns:
+            numpy.ndarray: Contiguous float32 array with the embedding of each input as a row.
+        """
+        texts = [inputs] if isinstance(inputs, str) else inputs
+        model = self.get_model(model, [Capability.EMBEDDING])
+        writer = EmbeddingWriter(len(texts), out)
+        for start, end in batch_ranges(texts, batch_size, max_batch_chars):
+            batch = texts[start:end]
+            if self.admission is None:
+                writer.write(start, end, self._embed_batch(model, batch))
+                continue
+            ticket = self.admission.acquire()
+            try:
+                writer.write(start, end, self._embed_batch(model, batch))
+            finally:
+                ticket.release(used_tokens(None, _chars(*batch)))
+        return writer.result()
+
+    async def aembed(
+        self,
+        model: Union[str, Model],
+        inputs: Union[str, Sequence[str]],
+        batch_size: int = 64,
+        max_batch_chars: int = 32768,
+        out: Optional[EmbeddingOutput] = None,
+        concurrency: int = 1,
+    ) -> "numpy.ndarray":
+        """Embeds the inputs using asyncio. Mirrors `Provider.embed()`, additionally sending up to `concurrency` batches at once.
+
+        Args:
+            model (Union[str, Model]): Either the key for the embedding model, or the model itself.
+            inputs (Union[str, Sequence[str]]): Text, or texts, to embed.
+            batch_size (int, optional): Maximum number of inputs per request. Defaults to 64.
+            max_batch_chars (int, optional): Maximum combined length of the inputs per request. Defaults to 32768.
+            out (Optional[EmbeddingOutput], optional): Path of a `.npy` file to write a memory-mapped result to, or a float32 array to fill. Defaults to None, which allocates a new array.
+            concurrency (int, optional): Maximum number of batches in flight. Defaults to 1.
+
+        Raises:
+            ModelNotFoundException: If the model is not registered to this provider.
+            CapabilitiesException: If the model, or this provider, doesn't support embeddings.
+            TransportException: If the provider could not be reached, or returned malformed embeddings.
+            AdmissionException: If the `admission` controller rejected a batch.
+
+        Returns:
+            numpy.ndarray: Contiguous float32 array with the embedding of each input as a row.
+        """
+        import asyncio
+
+        texts = [inputs] if isinstance(inputs, str) else inputs
+        model = self.get_model(model, [Capability.EMBEDDING])
+        writer = EmbeddingWriter(len(texts), out)
+        ranges = batch_ranges(texts, batch_size, max_batch_chars)
+
+        async def worker() -> None:
+            # Workers share the range iterator, so no more than `concurrency` batches are pending at once.
+            for start, end in ranges:
+                batch = texts[start:end]
+                if self.admission is None:
+                    writer.write(start, end, await self._aembed_batch(model, batch))
+                    continue
+                ticket = await self.admission.aacquire()
+                try:
+                    writer.write(start, end, await self._aembed_batch(model, batch))
+                finally:
+                    ticket.release(used_tokens(None, _chars(*batch)))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        return writer.result()
+
+    def _embed_batch(self, model: Model, texts: Sequence[str]) -> list[list[float]]:
+        """Requests the embeddings of a batch of inputs. Providers supporting embeddings override this.
+
+        Raises:
+            CapabilitiesException: If the provider doesn't support embeddings.
+        """
+        raise CapabilitiesException(f"provider {self.key} does not support embeddings")
+
+    async def _aembed_batch(
+        self, model: Model, texts: Sequence[str]
+    ) -> list[list[float]]:
+        """Requests the embeddings of a batch of inputs using asyncio. Providers supporting embeddings override this.
+
+        Raises:
+            CapabilitiesException: If the provider doesn't support embeddings.
+        """
+        raise CapabilitiesException(f"provider {self.key} does not support embeddings")
+
+
+def json_options(schema: Optional[dict], options: Optional[dict]) -> dict:
+    """Adds the `format` option requesting structured output to the generation options.
+
+    Args:
+        schema (Optional[dict]): JSON schema of the response, or None to allow any JSON.
+        options (Optional[dict]): Generation options of the request.
+
+    Returns:
+        dict: A copy of the options with `format` set.
+    """
+    return {**(options or {}), "format": "json" if schema is None else schema}
+
+
+async def aload_json(call: Coroutine[None, None, str]) -> Any:
+    """Awaits a generation, and decodes its response as JSON."""
+    return json.loads(await call)
+
+
+def _chars(*texts: Optional[str]) -> int:
+    return sum(len(text) for text in texts if text)
@@ -0,0 +1,150 @@
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional, Sequence
+
+from .provider import Provider
+
+
+class Router(ABC):
+    """Abstract Base Class for strategies which choose between the providers that serve the same model.
+
+    `Exfer` calls `Router.select()` for each request, then `Router.on_start()` before issuing it and
+    `Router.on_finish()` once it has completed, allowing strategies to track the load and latency of
+    each provider. All methods may be called concurrently from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outstanding: dict[str, int] = {}
+
+    @abstractmethod
+    def select(self, model_key: str, providers: Sequence[Provider]) -> Provider:
+        """Chooses the provider to issue a request for a model to.
+
+        Args:
+            model_key (str): Key of the requested model.
+            providers (Sequence[Provider]): Providers that serve the model, in a stable order. Never empty. A provider may be repeated to weight it, such as when it already has the model loaded.
+
+        Returns:
+            Provider: The chosen provider.
+        """
+        ...
+
+    def outstanding(self, provider: Provider) -> int:
+        """Number of requests that have been started but not finished against the provider."""
+        return self._outstanding.get(provider.key, 0)
+
+    def on_start(self, provider: Provider, model_key: str) -> None:
+        """Called when a request to the provider is issued."""
+        with self._lock:
+            self._outstanding[provider.key] = self._outstanding.get(provider.key, 0) + 1
+
+    def on_finish(
+        self,
+        provider: Provider,
+        model_key: str,
+        latency: float,
+        error: Optional[Exception] = None,
+    ) -> None:
+        """Called when a request to the provider has completed, successfully or not.
+
+        Args:
+            provider (Provider): Provider the request was issued to.
+            model_key (str): Key of the requested model.
+            latency (float): Seconds taken from issuing the request to it completing.
+            error (Optional[Exception], optional): The exception raised, if the request failed. Defaults to None.
+        """
+        with self._lock:
+            self._outstanding[provider.key] = max(
+                0, self._outstanding.get(provider.key, 0) - 1
+            )
+
+
+class RoundRobinRouter(Router):
+    """Cycles through the providers of each model in turn."""
+
+    def __init__(self):
+        super().__init__()
+        self._counters: dict[str, itertools.count] = {}
+
+    def select(self, model_key: str, providers: Sequence[Provider]) -> Provider:
+        counter = self._counters.get(model_key)
+        if counter is None:
+            counter = self._counters.setdefault(model_key, itertools.count())
+        return providers[next(counter) % len(providers)]
+
+
+class LeastOutstandingRouter(RoundRobinRouter):
+    """Chooses the provider with the fewest in-flight requests. Ties are broken by round-robin so that idle
+    providers share the load evenly."""
+
+    def select(self, model_key: str, providers: Sequence[Provider]) -> Provider:
+        least = min(self.outstanding(provider) for provider in providers)
+        candidates = [
+            provider for provider in providers if self.outstanding(provider) == least
+        ]
+        return super().select(model_key, candidates)
+
+
+class EWMALatencyRouter(RoundRobinRouter):
+    """Chooses the provider with the lowest expected latency for the model, based on an exponentially
+    weighted moving average of past request latencies scaled by the provider's in-flight requests.
+
+    Providers without any latency samples for the model are preferred, so new providers are tried
+    before the averages decide.
+    """
+
+    alpha: float
+    """Weight given to the newest sample, between 0 and 1. Higher values react faster to changes."""
+
+    error_penalty: float
+    """Latency in seconds recorded for a failed request, so failing providers are avoided."""
+
+    def __init__(self, alpha: float = 0.3, error_penalty: float = 10.0):
+        """Constructs a new EWMA latency router.
+
+        Args:
+            alpha (float, optional): Weight given to the newest sample, between 0 and 1. Defaults to 0.3.
+            error_penalty (float, optional): Latency in seconds recorded for a failed request. Defaults to 10.0.
+        """
+        super().__init__()
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self._latencies: dict[tuple[str, str], float] = {}
+
+    def latency(self, provider: Provider, model_key: str) -> Optional[float]:
+        """Current average latency in seconds for the model on the provider, or None if there are no samples."""
+        return self._latencies.get((provider.key, model_key))
+
+    def select(self, model_key: str, providers: Sequence[Provider]) -> Provider:
+        scores: list[float] = []
+        for provider in providers:
+            latency = self.latency(provider, model_key)
+            if latency is None:
+                scores.append(0.0)
+            else:
+                scores.append(latency * (self.outstanding(provider) + 1))
+        best = min(scores)
+        candidates = [
+            provider for provider, score in zip(providers, scores) if score == best
+        ]
+        return super().select(model_key, candidates)
+
+    def on_finish(
+        self,
+        provider: Provider,
+        model_key: str,
+        latency: float,
+        error: Optional[Exception] = None,
+    ) -> None:
+        super().on_finish(provider, model_key, latency, error)
+        if error is not None:
+            latency = max(latency, self.error_penalty)
+        key = (provider.key, model_key)
+        with self._lock:
+            current = self._latencies.get(key)
+            if current is None:
+                self._latencies[key] = latency
+            else:
+                self._latencies[key] = self.alpha * latency + (1 - self.alpha) * current
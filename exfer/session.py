@@ -0,0 +1,330 @@
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import (
+    TYPE_CHECKING,
+    AsyncGenerator,
+    AsyncIterator,
+    Coroutine,
+    Generator,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from .stream import AsyncTextStream, TextStream
+from .utils import ImageInput
+
+if TYPE_CHECKING:
+    from .model import Model
+    from .provider import Provider
+
+current_session: ContextVar[Optional["Session"]] = ContextVar(
+    "exfer_session", default=None
+)
+"""Session the request being made belongs to. Providers which can continue from a returned context, such as
+Ollama, read it from and store it on the session. Requests within a session bypass the response cache and
+single-flight, as their responses depend on the conversation so far."""
+
+
+class SessionStore:
+    """Keeps the contexts returned by the provider for each session, evicting the least recently used once
+    there are more than `max_sessions`, or once they take more than `max_bytes`. Contexts are stored as
+    packed 32-bit token arrays. Safe to use from multiple threads.
+
+    Sessions whose context was evicted keep working, their next turn re-sends the conversation instead.
+    """
+
+    max_sessions: int
+    """Maximum number of contexts kept."""
+
+    max_bytes: int
+    """Maximum combined size of the contexts kept, in bytes."""
+
+    def __init__(self, max_sessions: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        """Constructs a new, empty, store.
+
+        Args:
+            max_sessions (int, optional): Maximum number of contexts kept. Defaults to 1024.
+            max_bytes (int, optional): Maximum combined size of the contexts kept, in bytes. Defaults to 64 MiB.
+        """
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._contexts: OrderedDict[str, array] = OrderedDict()
+        self._bytes = 0
+
+    @property
+    def bytes(self) -> int:
+        """Combined size of the contexts kept, in bytes."""
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._contexts
+
+    def get(self, session_id: str) -> Optional[array]:
+        """Retrieves the context of a session, marking it as the most recently used.
+
+        Args:
+            session_id (str): Identifier of the session.
+
+        Returns:
+            Optional[array]: The context, or None if there is none or it was evicted.
+        """
+        with self._lock:
+            context = self._contexts.get(session_id)
+            if context is not None:
+                self._contexts.move_to_end(session_id)
+            return context
+
+    def set(self, session_id: str, context: Sequence[int]) -> None:
+        """Stores the context of a session, replacing any previous one, and evicts as needed to stay within the limits.
+        A context larger than `max_bytes` on its own is not kept.
+
+        Args:
+            session_id (str): Identifier of the session.
+            context (Sequence[int]): Tokens of the context returned by the provider.
+        """
+        try:
+            packed = array("i", context)
+        except OverflowError:
+            packed = array("q", context)
+        size = len(packed) * packed.itemsize
+        with self._lock:
+            self._discard(session_id)
+            if size > self.max_bytes:
+                return
+            self._contexts[session_id] = packed
+            self._bytes += size
+            while self._contexts and (
+                len(self._contexts) > self.max_sessions or self._bytes > self.max_bytes
+            ):
+                _, evicted = self._contexts.popitem(last=False)
+                self._bytes -= len(evicted) * evicted.itemsize
+
+    def discard(self, session_id: str) -> None:
+        """Removes the context of a session, if it has one."""
+        with self._lock:
+            self._discard(session_id)
+
+    def _discard(self, session_id: str) -> None:
+        context = self._contexts.pop(session_id, None)
+        if context is not None:
+            self._bytes -= len(context) * context.itemsize
+
+    def clear(self) -> None:
+        """Removes every context."""
+        with self._lock:
+            self._contexts.clear()
+            self._bytes = 0
+
+
+class Session:
+    """Multi-turn conversation with a model. Each turn only sends the new prompt along with the context the
+    provider returned for the previous turn, so the backend doesn't have to process the whole conversation
+    again. Providers that don't return a context, and sessions whose context was evicted from the store, are
+    sent the conversation so far as part of the prompt instead.
+
+    A session holds one conversation, so its turns must not be sent concurrently.
+
+    Example:
+        session = ollama.session('llama3.2', system_prompt='Be concise.')
+        session.send('Why is the sky blue?')
+        session.send('And at sunset?')
+    """
+
+    id: str
+    """Random identifier, which the session's context is stored under."""
+
+    provider: "Provider"
+    """Provider the turns are sent to."""
+
+    model: Union[str, "Model"]
+    """Key of the model, or the model itself."""
+
+    system_prompt: Optional[str]
+    """System prompt of the conversation, sent with the first turn."""
+
+    store: Optional[SessionStore]
+    """Store of the returned contexts. None if the provider doesn't return them."""
+
+    turns: list[tuple[str, str]]
+    """Prompt and response of each completed turn."""
+
+    def __init__(
+        self,
+        provider: "Provider",
+        model: Union[str, "Model"],
+        system_prompt: Optional[str] = None,
+        store: Optional[SessionStore] = None,
+    ):
+        """Constructs a new session. See `Provider.session()`.
+
+        Args:
+            provider (Provider): Provider the turns are sent to.
+            model (Union[str, Model]): Key of the model, or the model itself.
+            system_prompt (Optional[str], optional): System prompt of the conversation. Defaults to None.
+            store (Optional[SessionStore], optional): Store of the returned contexts. Defaults to None, which sends the conversation every turn.
+        """
+        self.id = os.urandom(8).hex()
+        self.provider = provider
+        self.model = model
+        self.system_prompt = system_prompt
+        self.store = store
+        self.turns = []
+        self._received: Optional[list[int]] = None
+
+    @property
+    def context(self) -> Optional[array]:
+        """Context returned by the provider for the last turn, or None if there is none or it was evicted."""
+        if self.store is None:
+            return None
+        return self.store.get(self.id)
+
+    def receive_context(self, context: Optional[list[int]]) -> None:
+        """Called by the provider with the context it returned for the turn being sent."""
+        self._received = context
+
+    def _prepare(self, prompt: str) -> tuple[str, Optional[str]]:
+        """Builds the prompt and system prompt to send for a turn."""
+        self._received = None
+        if not self.turns:
+            return prompt, self.system_prompt
+        if self.context is not None:
+            # The system prompt is already part of the context.
+            return prompt, None
+        transcript = "\n\n".join(
+            f"User: {previous}\n\nAssistant: {response}"
+            for previous, response in self.turns
+        )
+        return f"{transcript}\n\nUser: {prompt}", self.system_prompt
+
+    def _complete(self, prompt: str, response: str) -> None:
+        self.turns.append((prompt, response))
+        if self.store is not None:
+            if self._received:
+                self.store.set(self.id, self._received)
+            else:
+                self.store.discard(self.id)
+        self._received = None
+
+    def send(
+        self,
+        prompt: str,
+        stream: bool = False,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[str, TextStream]:
+        """Sends the next turn of the conversation. The turn is only recorded once its response has completed,
+        a stream that is closed early leaves the conversation as it was.
+
+        Args:
+            prompt (str): Prompt of the turn.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[str, TextStream]: Either the complete response, or a stream which yields fragments (requires stream = True).
+        """
+        sent, system_prompt = self._prepare(prompt)
+        token = current_session.set(self)
+        try:
+            result = self.provider.generate_text(
+                self.model, sent, stream, system_prompt, images, options
+            )
+        finally:
+            current_session.reset(token)
+        if isinstance(result, TextStream):
+            return result.pipe(lambda fragments: self._stream(prompt, fragments))
+        self._complete(prompt, result)
+        return result
+
+    def _stream(self, prompt: str, fragments: Iterator[str]) -> Generator[str]:
+        """Passes through the fragments of a turn with the session current, recording the turn once complete."""
+        collected: list[str] = []
+        while True:
+            # The request is only issued once the stream is iterated, so the session needs to be current then.
+            token = current_session.set(self)
+            try:
+                fragment = next(fragments)
+            except StopIteration:
+                break
+            finally:
+                current_session.reset(token)
+            collected.append(fragment)
+            yield fragment
+        self._complete(prompt, "".join(collected))
+
+    def asend(
+        self,
+        prompt: str,
+        stream: bool = False,
+        images: Optional[ImageInput] = None,
+        options: Optional[dict] = None,
+    ) -> Union[Coroutine[None, None, str], AsyncTextStream]:
+        """Sends the next turn of the conversation using asyncio. Mirrors `Session.send()`.
+
+        Args:
+            prompt (str): Prompt of the turn.
+            stream (bool, optional): Whether to use streaming. Defaults to False.
+            images (ImageInput, optional): Image, or images, to provide to a vision model. Defaults to None.
+            options (Optional[dict], optional): Provider specific generation options, such as `temperature`. Defaults to None.
+
+        Returns:
+            Union[Coroutine[None, None, str], AsyncTextStream]: Either a coroutine resolving to the complete response, or an async stream which yields fragments (requires stream = True).
+        """
+        if stream:
+            sent, system_prompt = self._prepare(prompt)
+            token = current_session.set(self)
+            try:
+                result = self.provider.agenerate_text(
+                    self.model, sent, True, system_prompt, images, options
+                )
+            finally:
+                current_session.reset(token)
+            return result.pipe(lambda fragments: self._astream(prompt, fragments))
+        return self._asend(prompt, images, options)
+
+    async def _asend(
+        self, prompt: str, images: Optional[ImageInput], options: Optional[dict]
+    ) -> str:
+        sent, system_prompt = self._prepare(prompt)
+        token = current_session.set(self)
+        try:
+            result = await self.provider.agenerate_text(
+                self.model, sent, False, system_prompt, images, options
+            )
+        finally:
+            current_session.reset(token)
+        self._complete(prompt, result)
+        return result
+
+    async def _astream(
+        self, prompt: str, fragments: AsyncIterator[str]
+    ) -> AsyncGenerator[str]:
+        collected: list[str] = []
+        while True:
+            token = current_session.set(self)
+            try:
+                fragment = await anext(fragments)
+            except StopAsyncIteration:
+                break
+            finally:
+                current_session.reset(token)
+            collected.append(fragment)
+            yield fragment
+        self._complete(prompt, "".join(collected))
+
+    def reset(self) -> None:
+        """Forgets the conversation, so the next turn starts a new one."""
+        self.turns = []
+        self._received = None
+        if self.store is not None:
+            self.store.discard(self.id)
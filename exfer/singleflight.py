@@ -0,0 +1,484 @@
+import threading
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Iterator,
+    Optional,
+    Union,
+)
+
+from .instrumentation import current_trace
+from .stream import AsyncTextStream, TextStream
+
+if TYPE_CHECKING:
+    import asyncio
+
+
+class FlightAbandonedException(Exception):
+    pass
+
+
+Start = Callable[[], Union[str, TextStream]]
+"""Starts a generation, returning either the complete response or a stream of its fragments."""
+
+AsyncStart = Callable[[], Union[Coroutine[None, None, str], AsyncTextStream]]
+"""Starts a generation, returning either a coroutine resolving to the complete response or an async stream of its fragments."""
+
+
+class SingleFlight:
+    """Coalesces concurrent identical generation requests into a single in-flight generation. The first
+    caller for a key starts the generation, and every caller with the same key while it is in flight
+    subscribes to it instead of issuing its own request. Streamed fragments are fanned out to each
+    subscriber as they arrive, and subscribers joining late are first replayed the fragments they missed.
+
+    A generation is only shared while it is in flight. Once it has finished the next request starts a new
+    one, see `Cache` for reusing finished responses. When every subscriber has closed its stream before the
+    generation finished, the upstream request is closed as well.
+
+    Threads share flights with each other, and asyncio tasks share flights with the other tasks of the
+    same event loop. Only suitable for deterministic generation, as every subscriber receives the same
+    response.
+
+    Example:
+        exference = Exfer.from_env(single_flight=SingleFlight())
+    """
+
+    started: int
+    """Number of generations started."""
+
+    coalesced: int
+    """Number of requests which subscribed to a generation already in flight, instead of starting their own."""
+
+    def __init__(self):
+        """Constructs a new, empty, set of flights."""
+        self.started = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+        self._aflights: dict[tuple[str, "asyncio.AbstractEventLoop"], _AsyncFlight] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of generations currently in flight."""
+        with self._lock:
+            return len(self._flights) + len(self._aflights)
+
+    def stream(self, key: str, start: Start) -> TextStream:
+        """Subscribes to the generation for a key, starting it if none is in flight. The subscription is made once
+        the stream is first iterated.
+
+        Args:
+            key (str): Key identifying the request, see `make_cache_key()`.
+            start (Start): Starts the generation, returning either the complete response or a stream of fragments.
+
+        Returns:
+            TextStream: Stream of every fragment of the generation, starting from the first.
+        """
+        return TextStream(lambda stream: _Subscription(self, key, start, stream))
+
+    def generate(self, key: str, start: Start) -> str:
+        """Subscribes to the generation for a key like `SingleFlight.stream()`, but waits for the complete response.
+
+        Args:
+            key (str): Key identifying the request, see `make_cache_key()`.
+            start (Start): Starts the generation, returning either the complete response or a stream of fragments.
+
+        Returns:
+            str: The complete response.
+        """
+        return "".join(self.stream(key, start))
+
+    def astream(self, key: str, start: AsyncStart) -> AsyncTextStream:
+        """Subscribes to the generation for a key using asyncio. Mirrors `SingleFlight.stream()`, flights are shared
+        with the tasks of the event loop the stream is iterated in.
+
+        Args:
+            key (str): Key identifying the request, see `make_cache_key()`.
+            start (AsyncStart): Starts the generation, returning either a coroutine resolving to the complete response or an async stream of fragments.
+
+        Returns:
+            AsyncTextStream: Async stream of every fragment of the generation, starting from the first.
+        """
+        return AsyncTextStream(
+            lambda stream: _AsyncSubscription(self, key, start, stream)
+        )
+
+    async def agenerate(self, key: str, start: AsyncStart) -> str:
+        """Subscribes to the generation for a key like `SingleFlight.astream()`, but waits for the complete response.
+
+        Args:
+            key (str): Key identifying the request, see `make_cache_key()`.
+            start (AsyncStart): Starts the generation, returning either a coroutine resolving to the complete response or an async stream of fragments.
+
+        Returns:
+            str: The complete response.
+        """
+        return "".join([fragment async for fragment in self.astream(key, start)])
+
+    def _join(self, key: str, start: Start) -> "_Flight":
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(self, key, start)
+                self.started += 1
+            else:
+                self.coalesced += 1
+                _mark_coalesced()
+            flight.subscribers += 1
+            return flight
+
+    def _ajoin(self, key: str, start: AsyncStart) -> "_AsyncFlight":
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._aflights.get((key, loop))
+            if flight is None:
+                flight = self._aflights[(key, loop)] = _AsyncFlight(
+                    self, key, loop, start
+                )
+                self.started += 1
+            else:
+                self.coalesced += 1
+                _mark_coalesced()
+            flight.subscribers += 1
+            return flight
+
+    def _leave(self, flight: Union["_Flight", "_AsyncFlight"]) -> bool:
+        """Removes a subscriber, returning True if it was the last one while the generation is unfinished."""
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done:
+                return False
+            self._remove(flight)
+            return True
+
+    def _land(self, flight: Union["_Flight", "_AsyncFlight"]) -> None:
+        """Stops new subscribers from joining a finished generation."""
+        with self._lock:
+            self._remove(flight)
+
+    def _remove(self, flight: Union["_Flight", "_AsyncFlight"]) -> None:
+        if isinstance(flight, _AsyncFlight):
+            if self._aflights.get((flight.key, flight.loop)) is flight:
+                del self._aflights[(flight.key, flight.loop)]
+        elif self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+
+def _mark_coalesced() -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.coalesced = True
+
+
+def _abandoned() -> FlightAbandonedException:
+    return FlightAbandonedException(
+        "every subscriber closed before the generation finished"
+    )
+
+
+class _Flight:
+    """A generation shared between threads. There is no dedicated thread producing the fragments, instead
+    whichever subscriber first needs a fragment that hasn't arrived yet pulls it from the upstream, while
+    the others wait for it. Subscribers that stop early therefore never stall the remaining ones.
+    """
+
+    __slots__ = (
+        "owner",
+        "key",
+        "subscribers",
+        "fragments",
+        "done",
+        "error",
+        "stats",
+        "_start",
+        "_upstream",
+        "_stream",
+        "_pulling",
+        "_condition",
+    )
+
+    def __init__(self, owner: SingleFlight, key: str, start: Start):
+        self.owner = owner
+        self.key = key
+        self.subscribers = 0
+        self.fragments: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.stats: Optional[dict] = None
+        self._start = start
+        self._upstream: Optional[Iterator[str]] = None
+        self._stream: Optional[TextStream] = None
+        self._pulling = False
+        self._condition = threading.Condition()
+
+    def get(self, index: int) -> Optional[str]:
+        """Returns the fragment at an index, waiting for it to arrive. Returns None once there are no more fragments.
+
+        Raises:
+            Exception: The error the generation failed with, for every subscriber.
+        """
+        while True:
+            with self._condition:
+                while True:
+                    if index < len(self.fragments):
+                        return self.fragments[index]
+                    if self.done:
+                        if self.error is not None:
+                            raise self.error
+                        return None
+                    if not self._pulling:
+                        self._pulling = True
+                        break
+                    self._condition.wait()
+            self._pull()
+
+    def _pull(self) -> None:
+        """Pulls the next fragment from the upstream. Done outside of the lock, so that replays aren't blocked by it."""
+        fragment: Optional[str] = None
+        finished = False
+        error: Optional[BaseException] = None
+        try:
+            if self._upstream is None:
+                result = self._start()
+                if isinstance(result, TextStream):
+                    self._stream = result
+                    self._upstream = iter(result)
+                else:
+                    self._upstream = iter([result])
+            fragment = next(self._upstream)
+        except StopIteration:
+            finished = True
+        except BaseException as e:
+            finished = True
+            error = e
+        with self._condition:
+            if fragment is not None:
+                self.fragments.append(fragment)
+            if finished:
+                self.done = True
+                self.error = error
+                if self._stream is not None:
+                    self.stats = self._stream.stats
+            self._pulling = False
+            self._condition.notify_all()
+        if finished:
+            self.owner._land(self)
+
+    def abandon(self) -> None:
+        """Closes the upstream after the last subscriber has left."""
+        with self._condition:
+            if self.done:
+                return
+            self.done = True
+            self.error = _abandoned()
+            self._condition.notify_all()
+        if self._stream is not None:
+            self._stream.close()
+
+
+class _Subscription:
+    """Iterates the fragments of a flight for one subscriber, from the first fragment onwards."""
+
+    __slots__ = ("owner", "key", "start", "stream", "flight", "index", "closed")
+
+    def __init__(self, owner: SingleFlight, key: str, start: Start, stream: TextStream):
+        self.owner = owner
+        self.key = key
+        self.start = start
+        # A weak proxy, as the stream holds its subscription and the cycle would delay `__del__`.
+        self.stream = stream
+        self.flight: Optional[_Flight] = None
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        if self.closed:
+            raise StopIteration
+        if self.flight is None:
+            self.flight = self.owner._join(self.key, self.start)
+        try:
+            fragment = self.flight.get(self.index)
+        except BaseException:
+            self.close()
+            raise
+        if fragment is None:
+            try:
+                self.stream.stats = self.flight.stats
+            except ReferenceError:
+                pass
+            self.close()
+            raise StopIteration
+        self.index += 1
+        return fragment
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.flight is not None and self.owner._leave(self.flight):
+            self.flight.abandon()
+
+    def __del__(self) -> None:
+        # Streams which are dropped without being exhausted or closed still need to leave their flight.
+        self.close()
+
+
+class _AsyncFlight:
+    """A generation shared between the tasks of one event loop. The fragments are produced by a task of their
+    own, so that a subscriber being cancelled doesn't interrupt the generation for the others.
+    """
+
+    __slots__ = (
+        "owner",
+        "key",
+        "loop",
+        "subscribers",
+        "fragments",
+        "done",
+        "error",
+        "stats",
+        "_start",
+        "_task",
+        "_changed",
+    )
+
+    def __init__(
+        self,
+        owner: SingleFlight,
+        key: str,
+        loop: "asyncio.AbstractEventLoop",
+        start: AsyncStart,
+    ):
+        import asyncio
+
+        self.owner = owner
+        self.key = key
+        self.loop = loop
+        self.subscribers = 0
+        self.fragments: list[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.stats: Optional[dict] = None
+        self._start = start
+        self._task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    async def get(self, index: int) -> Optional[str]:
+        """Returns the fragment at an index, waiting for it to arrive. Returns None once there are no more fragments.
+
+        Raises:
+            Exception: The error the generation failed with, for every subscriber.
+        """
+        while True:
+            if index < len(self.fragments):
+                return self.fragments[index]
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return None
+            if self._task is None:
+                self._task = self.loop.create_task(self._produce())
+            await self._changed.wait()
+
+    def _notify(self) -> None:
+        import asyncio
+
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _produce(self) -> None:
+        import asyncio
+
+        stream: Optional[AsyncTextStream] = None
+        try:
+            result = self._start()
+            if isinstance(result, AsyncTextStream):
+                stream = result
+                async for fragment in stream:
+                    self.fragments.append(fragment)
+                    self._notify()
+                self.stats = stream.stats
+                stream = None
+            else:
+                self.fragments.append(await result)
+        except asyncio.CancelledError:
+            self.error = _abandoned()
+        except BaseException as e:
+            self.error = e
+        finally:
+            if stream is not None:
+                # Release the connection of a stream that was interrupted.
+                await stream.aclose()
+            self.done = True
+            self._notify()
+            self.owner._land(self)
+
+    def abandon(self) -> None:
+        """Cancels the generation after the last subscriber has left."""
+        if self._task is not None and not self._task.done():
+            # Subscribers may be dropped, and collected, from another thread.
+            self.loop.call_soon_threadsafe(self._task.cancel)
+
+
+class _AsyncSubscription:
+    """Iterates the fragments of an async flight for one subscriber, from the first fragment onwards."""
+
+    __slots__ = ("owner", "key", "start", "stream", "flight", "index", "closed")
+
+    def __init__(
+        self,
+        owner: SingleFlight,
+        key: str,
+        start: AsyncStart,
+        stream: AsyncTextStream,
+    ):
+        self.owner = owner
+        self.key = key
+        self.start = start
+        self.stream = stream
+        self.flight: Optional[_AsyncFlight] = None
+        self.index = 0
+        self.closed = False
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self
+
+    async def __anext__(self) -> str:
+        if self.closed:
+            raise StopAsyncIteration
+        if self.flight is None:
+            self.flight = self.owner._ajoin(self.key, self.start)
+        try:
+            fragment = await self.flight.get(self.index)
+        except BaseException:
+            self.close()
+            raise
+        if fragment is None:
+            try:
+                self.stream.stats = self.flight.stats
+            except ReferenceError:
+                pass
+            self.close()
+            raise StopAsyncIteration
+        self.index += 1
+        return fragment
+
+    async def aclose(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.flight is not None and self.owner._leave(self.flight):
+            self.flight.abandon()
+
+    def __del__(self) -> None:
+        self.close()
@@ -0,0 +1,439 @@
+import time
+import weakref
+from contextvars import ContextVar
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Union,
+)
+
+from .utils.streams import (
+    JSONEvent,
+    acoalesce,
+    adecode_json,
+    astop_at,
+    coalesce,
+    decode_json,
+    stop_at,
+)
+
+current_stream: ContextVar[Optional[Union["TextStream", "AsyncTextStream"]]] = (
+    ContextVar("exfer_stream", default=None)
+)
+"""Stream whose source is being iterated. The transport attaches the connection of a streamed response to it, so
+that cancelling the stream aborts the connection, and applies the stream's deadline to its reads."""
+
+
+class DeadlineExceededException(Exception):
+    pass
+
+
+class TextStream:
+    """Stream of text fragments returned when generating with `stream=True`. Iterate it to receive the
+    fragments as they are generated. Once exhausted, `stats` holds the final statistics the provider
+    reported for the generation, if any.
+
+    Closing the stream, using it as a context manager, or dropping it, closes the connection so that the backend
+    stops generating. `cancel()` does the same from any thread, interrupting a fragment being waited on.
+    """
+
+    def __init__(
+        self,
+        source: Callable[["TextStream"], Iterable[str]],
+        parent: Optional["TextStream"] = None,
+    ):
+        """Constructs a new stream.
+
+        Args:
+            source (Callable[[TextStream], Iterable[str]]): Called with the new stream to produce the fragments. The stream is given so that the source can set `stats`.
+            parent (Optional[TextStream], optional): Stream this one is derived from, whose `stats` are used if this stream has none. Defaults to None.
+        """
+        self._stats: Optional[dict] = None
+        self._parent = parent
+        self._cancelled = False
+        self._on_cancel: list[Callable[[], None]] = []
+        self._deadline: Optional[float] = None
+        # The source is given a weak proxy, so that it doesn't hold the stream in a cycle. Dropping the stream
+        # then closes its connection straight away, rather than once the garbage collector gets to it.
+        self._iterator = iter(source(weakref.proxy(self)))
+
+    @classmethod
+    def of(cls, fragments: Iterable[str]) -> "TextStream":
+        """Wraps an iterable of fragments as a stream."""
+        if isinstance(fragments, TextStream):
+            return fragments
+        return cls(lambda _: fragments)
+
+    @property
+    def stats(self) -> Optional[dict]:
+        """Final statistics reported by the provider, such as token counts and durations. Only available once the stream is exhausted."""
+        if self._stats is None and self._parent is not None:
+            return self._parent.stats
+        return self._stats
+
+    @stats.setter
+    def stats(self, value: Optional[dict]) -> None:
+        self._stats = value
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether `cancel()` was called on this stream, or a stream derived from it."""
+        return self._cancelled
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline of the next fragment, or None if there is none. See `TextStream.deadline()`."""
+        if self._deadline is None:
+            return None
+        return self._deadline - time.monotonic()
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        if self._cancelled:
+            self.close()
+            raise StopIteration
+        token = current_stream.set(self)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise
+        except Exception:
+            if not self._cancelled:
+                raise
+            # Aborting the connection interrupts the read with an error, which is the expected outcome of cancelling.
+            self.close()
+            raise StopIteration from None
+        finally:
+            current_stream.reset(token)
+
+    def __enter__(self) -> "TextStream":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops the stream, releasing the underlying connection."""
+        close = getattr(self._iterator, "close", None)
+        if close is not None:
+            close()
+        if self._parent is not None:
+            self._parent.close()
+
+    def cancel(self) -> None:
+        """Stops the stream from any thread, aborting the connection straight away so the backend stops generating.
+        Iteration then ends without an error, including a wait for the next fragment that was interrupted.
+        """
+        self._cancelled = True
+        callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            callback()
+        if self._parent is not None:
+            self._parent.cancel()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Registers a callback to abort the work behind the stream when it is cancelled, which is called straight
+        away if it already was. Callbacks can be called from any thread, and possibly more than once.
+        """
+        self._on_cancel.append(callback)
+        if self._cancelled:
+            callback()
+
+    def _limit(self, deadline: Optional[float]) -> None:
+        """Sets the deadline of the next fragment on this stream and the streams it is derived from."""
+        stream: Optional[TextStream] = self
+        while stream is not None:
+            stream._deadline = deadline
+            stream = stream._parent
+
+    def pipe(self, fn: Callable[[Iterator[str]], Iterable[str]]) -> "TextStream":
+        """Derives a new stream by passing the fragments of this one through a function. The derived stream shares the `stats` of this one."""
+        return TextStream(lambda _: fn(self), parent=self)
+
+    def coalesce(
+        self, min_chars: int = 0, max_delay: Optional[float] = None
+    ) -> "TextStream":
+        """Derives a stream that joins consecutive fragments together. See `utils.streams.coalesce()`.
+
+        Args:
+            min_chars (int, optional): Minimum characters per emitted fragment. Defaults to 0.
+            max_delay (Optional[float], optional): Maximum seconds to hold collected fragments for. Defaults to None.
+
+        Returns:
+            TextStream: The coalesced stream.
+        """
+        return self.pipe(lambda fragments: coalesce(fragments, min_chars, max_delay))
+
+    def stop_at(self, *sequences: str) -> "TextStream":
+        """Derives a stream that ends at the first of the stop sequences, closing the connection so the backend
+        stops generating. See `utils.streams.stop_at()`.
+
+        Args:
+            *sequences (str): Stop sequences, which are not included in the stream.
+
+        Returns:
+            TextStream: The stopping stream.
+        """
+        return self.pipe(lambda fragments: stop_at(fragments, sequences))
+
+    def json(self) -> Iterator[JSONEvent]:
+        """Decodes the stream as a JSON document, such as a response of `Provider.generate_json()`, emitting each
+        field and array element as soon as it is complete. Closing the iterator closes the stream.
+        See `utils.streams.IncrementalJSONDecoder`.
+
+        Raises:
+            ValueError: From iterating, if the response is not valid JSON.
+
+        Yields:
+            JSONEvent: Each completed value, innermost first, ending with the whole document.
+        """
+        with self:
+            yield from decode_json(self)
+
+    def deadline(
+        self, first_token: Optional[float] = None, total: Optional[float] = None
+    ) -> "TextStream":
+        """Derives a stream that raises once a deadline passes, closing the connection so the backend stops
+        generating. The deadlines count from when the stream is first iterated, and also bound the wait for the
+        response to start.
+
+        Args:
+            first_token (Optional[float], optional): Seconds to receive the first fragment within. Defaults to None.
+            total (Optional[float], optional): Seconds to receive the whole stream within. Defaults to None.
+
+        Raises:
+            DeadlineExceededException: From iterating the stream, once a deadline has passed.
+
+        Returns:
+            TextStream: The stream with deadlines.
+        """
+        return self.pipe(lambda _: self._deadlined(first_token, total))
+
+    def _deadlined(
+        self, first_token: Optional[float], total: Optional[float]
+    ) -> Iterator[str]:
+        started = time.monotonic()
+        first_at = None if first_token is None else started + first_token
+        total_at = None if total is None else started + total
+        received = False
+        try:
+            while True:
+                deadline = total_at
+                if not received and first_at is not None:
+                    deadline = first_at if total_at is None else min(first_at, total_at)
+                self._limit(deadline)
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise DeadlineExceededException(_deadline_message(received))
+                try:
+                    fragment = next(self)
+                except StopIteration:
+                    return
+                except Exception as error:
+                    # The read that timed out surfaces as a transport error.
+                    if deadline is not None and time.monotonic() >= deadline - 0.01:
+                        raise DeadlineExceededException(
+                            _deadline_message(received)
+                        ) from error
+                    raise
+                received = True
+                yield fragment
+        finally:
+            self.close()
+
+
+class AsyncTextStream:
+    """Asynchronous stream of text fragments returned when generating with `stream=True` using asyncio.
+    Mirrors `TextStream`, but is iterated with `async for`. Cancelling the task iterating it also closes the connection.
+    """
+
+    def __init__(
+        self,
+        source: Callable[["AsyncTextStream"], AsyncIterable[str]],
+        parent: Optional["AsyncTextStream"] = None,
+    ):
+        """Constructs a new stream.
+
+        Args:
+            source (Callable[[AsyncTextStream], AsyncIterable[str]]): Called with the new stream to produce the fragments. The stream is given so that the source can set `stats`.
+            parent (Optional[AsyncTextStream], optional): Stream this one is derived from, whose `stats` are used if this stream has none. Defaults to None.
+        """
+        self._stats: Optional[dict] = None
+        self._parent = parent
+        self._cancelled = False
+        self._on_cancel: list[Callable[[], None]] = []
+        self._iterator = aiter(source(weakref.proxy(self)))
+
+    @classmethod
+    def of(cls, fragments: AsyncIterable[str]) -> "AsyncTextStream":
+        """Wraps an async iterable of fragments as a stream."""
+        if isinstance(fragments, AsyncTextStream):
+            return fragments
+        return cls(lambda _: fragments)
+
+    @property
+    def stats(self) -> Optional[dict]:
+        """Final statistics reported by the provider, such as token counts and durations. Only available once the stream is exhausted."""
+        if self._stats is None and self._parent is not None:
+            return self._parent.stats
+        return self._stats
+
+    @stats.setter
+    def stats(self, value: Optional[dict]) -> None:
+        self._stats = value
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether `cancel()` was called on this stream, or a stream derived from it."""
+        return self._cancelled
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self
+
+    async def __anext__(self) -> str:
+        if self._cancelled:
+            await self.aclose()
+            raise StopAsyncIteration
+        token = current_stream.set(self)
+        try:
+            return await anext(self._iterator)
+        except StopAsyncIteration:
+            raise
+        except Exception:
+            if not self._cancelled:
+                raise
+            await self.aclose()
+            raise StopAsyncIteration from None
+        finally:
+            current_stream.reset(token)
+
+    async def __aenter__(self) -> "AsyncTextStream":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Stops the stream, releasing the underlying connection."""
+        aclose = getattr(self._iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        if self._parent is not None:
+            await self._parent.aclose()
+
+    def cancel(self) -> None:
+        """Stops the stream without awaiting, aborting the connection straight away. Mirrors `TextStream.cancel()`."""
+        self._cancelled = True
+        callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            callback()
+        if self._parent is not None:
+            self._parent.cancel()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Registers a callback to abort the work behind the stream when it is cancelled. Mirrors `TextStream.on_cancel()`."""
+        self._on_cancel.append(callback)
+        if self._cancelled:
+            callback()
+
+    def pipe(
+        self, fn: Callable[[AsyncIterator[str]], AsyncIterable[str]]
+    ) -> "AsyncTextStream":
+        """Derives a new stream by passing the fragments of this one through a function. The derived stream shares the `stats` of this one."""
+        return AsyncTextStream(lambda _: fn(self), parent=self)
+
+    def coalesce(
+        self, min_chars: int = 0, max_delay: Optional[float] = None
+    ) -> "AsyncTextStream":
+        """Derives a stream that joins consecutive fragments together. See `utils.streams.acoalesce()`.
+
+        Args:
+            min_chars (int, optional): Minimum characters per emitted fragment. Defaults to 0.
+            max_delay (Optional[float], optional): Maximum seconds to hold collected fragments for. Defaults to None.
+
+        Returns:
+            AsyncTextStream: The coalesced stream.
+        """
+        return self.pipe(lambda fragments: acoalesce(fragments, min_chars, max_delay))
+
+    def stop_at(self, *sequences: str) -> "AsyncTextStream":
+        """Derives a stream that ends at the first of the stop sequences. Mirrors `TextStream.stop_at()`.
+
+        Args:
+            *sequences (str): Stop sequences, which are not included in the stream.
+
+        Returns:
+            AsyncTextStream: The stopping stream.
+        """
+        return self.pipe(lambda fragments: astop_at(fragments, sequences))
+
+    async def json(self) -> AsyncIterator[JSONEvent]:
+        """Decodes the stream as a JSON document. Mirrors `TextStream.json()`.
+
+        Raises:
+            ValueError: From iterating, if the response is not valid JSON.
+
+        Yields:
+            JSONEvent: Each completed value, innermost first, ending with the whole document.
+        """
+        async with self:
+            async for event in adecode_json(self):
+                yield event
+
+    def deadline(
+        self, first_token: Optional[float] = None, total: Optional[float] = None
+    ) -> "AsyncTextStream":
+        """Derives a stream that raises once a deadline passes. Mirrors `TextStream.deadline()`.
+
+        Args:
+            first_token (Optional[float], optional): Seconds to receive the first fragment within. Defaults to None.
+            total (Optional[float], optional): Seconds to receive the whole stream within. Defaults to None.
+
+        Raises:
+            DeadlineExceededException: From iterating the stream, once a deadline has passed.
+
+        Returns:
+            AsyncTextStream: The stream with deadlines.
+        """
+        return self.pipe(lambda _: self._deadlined(first_token, total))
+
+    async def _deadlined(
+        self, first_token: Optional[float], total: Optional[float]
+    ) -> AsyncIterator[str]:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_at = None if first_token is None else started + first_token
+        total_at = None if total is None else started + total
+        received = False
+        try:
+            while True:
+                deadline = total_at
+                if not received and first_at is not None:
+                    deadline = first_at if total_at is None else min(first_at, total_at)
+                try:
+                    # Timing out cancels the wait, which closes the connection on its way out.
+                    async with asyncio.timeout_at(deadline):
+                        fragment = await anext(self)
+                except StopAsyncIteration:
+                    return
+                except TimeoutError as error:
+                    raise DeadlineExceededException(
+                        _deadline_message(received)
+                    ) from error
+                received = True
+                yield fragment
+        finally:
+            await self.aclose()
+
+
+def _deadline_message(received: bool) -> str:
+    if received:
+        return "stream did not complete before its deadline"
+    return "stream did not start before its deadline"
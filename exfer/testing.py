@@ -0,0 +1,423 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Sequence, Union
+
+
+class MockServer:
+    """In-process stand-in for the Ollama and LM Studio APIs, for benchmarking and testing without a real
+    backend. Both APIs are served from the same port, so `Ollama(server.url)` and `LMStudio(server.url)`
+    can be pointed at it together.
+
+    Generation responds with `tokens` fragments after waiting `latency` seconds, emitting them at
+    `token_rate` fragments per second. A model that isn't loaded first waits `cold_start` seconds, like
+    Ollama loading it into memory, and is then listed by `/api/ps` until its `keep_alive` runs out.
+    Streamed responses use chunked transfer-encoding and are written as they are produced, NDJSON for
+    Ollama's `/api/generate` and Server-Sent Events for the OpenAI-compatible `/v1/chat/completions`.
+
+    Example:
+        with MockServer(token_rate=50.0, latency=0.1) as server:
+            provider = Ollama(server.url)
+            provider.refresh_models()
+            provider.generate_text("mock", "Hello")
+    """
+
+    models: list[str]
+    """Keys of the models listed by `/api/tags` and `/api/v1/models`."""
+
+    tokens: int
+    """Number of fragments generated per request."""
+
+    token_rate: Optional[float]
+    """Fragments generated per second. None generates them as fast as possible."""
+
+    latency: float
+    """Seconds to wait before the first fragment, standing in for prompt processing."""
+
+    cold_start: float
+    """Extra seconds to wait when the requested model isn't loaded, standing in for loading it."""
+
+    loaded: dict[str, Optional[float]]
+    """Keys of the loaded models, mapped to the monotonic time they unload at, or None if they stay loaded."""
+
+    dimensions: int
+    """Dimensions of the embeddings returned by `/api/embed` and `/v1/embeddings`."""
+
+    requests: int
+    """Number of generation and embedding requests served so far."""
+
+    aborted: int
+    """Number of streamed generations stopped early because the client disconnected."""
+
+    def __init__(
+        self,
+        models: Sequence[str] = ("mock",),
+        tokens: int = 32,
+        token_rate: Optional[float] = None,
+        latency: float = 0.0,
+        cold_start: float = 0.0,
+        dimensions: int = 8,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """Constructs a new mock server. It is not listening until `start()` is called, or it is used as a context manager.
+
+        Args:
+            models (Sequence[str], optional): Keys of the models listed. Defaults to ("mock",).
+            tokens (int, optional): Number of fragments generated per request. Defaults to 32.
+            token_rate (Optional[float], optional): Fragments generated per second. Defaults to None, which is unthrottled.
+            latency (float, optional): Seconds to wait before the first fragment. Defaults to 0.0.
+            cold_start (float, optional): Extra seconds to wait when the model isn't loaded. Defaults to 0.0.
+            dimensions (int, optional): Dimensions of the returned embeddings. Defaults to 8.
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on. Defaults to 0, which picks a free port.
+        """
+        self.models = list(models)
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.latency = latency
+        self.cold_start = cold_start
+        self.dimensions = dimensions
+        self.loaded = {}
+        self.requests = 0
+        self.aborted = 0
+        self._address = (host, port)
+        self._server: Optional[_Server] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running server."""
+        if self._server is None:
+            raise RuntimeError("mock server is not running")
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        """Starts serving in a background thread."""
+        if self._server is not None:
+            return self
+        server = _Server(self._address, _make_handler(self), False)
+        # Benchmarks open many connections at once, which overflows the default listen backlog of 5.
+        server.request_queue_size = 1024
+        server.daemon_threads = True
+        server.server_bind()
+        server.server_activate()
+        self._server = server
+        self._thread = threading.Thread(
+            target=server.serve_forever, name="exfer-mock-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops serving, and closes the listening socket."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def fragments(self, structured: bool = False) -> list[str]:
+        """The fragments generated for each request.
+
+        Args:
+            structured (bool, optional): Whether structured output was requested, in which case the fragments form a JSON object listing the tokens. Defaults to False.
+        """
+        if structured:
+            return (
+                ['{"tokens": [']
+                + [f'{", " if i else ""}"token{i}"' for i in range(self.tokens)]
+                + ["]}"]
+            )
+        return [f"token{i} " for i in range(self.tokens)]
+
+    def _count(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def _load(self, model: str, keep_alive: object) -> None:
+        """Loads a model, waiting the `cold_start` if it wasn't loaded already."""
+        with self._lock:
+            expires = self.loaded.get(model, 0.0)
+            cold = expires is not None and expires <= time.monotonic()
+            seconds = _keep_alive_seconds(keep_alive)
+            if seconds == 0:
+                self.loaded.pop(model, None)
+                return
+            self.loaded[model] = None if seconds is None else time.monotonic() + seconds
+        if cold and self.cold_start > 0:
+            time.sleep(self.cold_start)
+
+    def _resident(self) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                key
+                for key, expires in self.loaded.items()
+                if expires is None or expires > now
+            ]
+
+    def _embed(self, inputs: Union[str, list[str]]) -> list[list[float]]:
+        """Deterministic embedding of each input, derived from its length so that results can be checked."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        texts = [inputs] if isinstance(inputs, str) else inputs
+        return [
+            [float(len(text) + index) for index in range(self.dimensions)]
+            for text in texts
+        ]
+
+    def _paced(self, fragments: list[str]):
+        """Yields the fragments, sleeping to honour the `latency` and `token_rate`."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        interval = 1.0 / self.token_rate if self.token_rate else 0.0
+        deadline = time.perf_counter()
+        for fragment in fragments:
+            if interval:
+                # Pace against a running deadline so that sleep overshoot doesn't accumulate.
+                deadline += interval
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield fragment
+
+
+def _keep_alive_seconds(keep_alive: object) -> Optional[float]:
+    """Seconds a model stays loaded for. Only plain seconds and the "m" and "s" suffixes are understood."""
+    if keep_alive is None:
+        return 300.0
+    text = str(keep_alive)
+    scale = 1.0
+    if text.endswith("m"):
+        text, scale = text[:-1], 60.0
+    elif text.endswith("s"):
+        text = text[:-1]
+    seconds = float(text) * scale
+    return None if seconds < 0 else seconds
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address) -> None:
+        # Clients closing their kept-alive connections is expected, anything else is still reported.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _make_handler(mock: MockServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Like the real servers, send small writes immediately instead of waiting on delayed ACKs.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def _send_json(self, payload: object, status: int = 200) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _start_chunked(self, content_type: str) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def _write_chunk(self, data: bytes) -> None:
+            try:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            except ConnectionError:
+                # Like a real backend, generation stops once the client has gone.
+                with mock._lock:
+                    mock.aborted += 1
+                raise
+
+        def _end_chunked(self) -> None:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def do_HEAD(self) -> None:
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self) -> None:
+            if self.path == "/api/version":
+                self._send_json({"version": "0.0.0-mock"})
+            elif self.path == "/api/tags":
+                self._send_json(
+                    {
+                        "models": [
+                            {"name": f"{key}:latest", "model": f"{key}:latest"}
+                            for key in mock.models
+                        ]
+                    }
+                )
+            elif self.path == "/api/ps":
+                self._send_json(
+                    {
+                        "models": [
+                            {"name": f"{key}:latest", "model": f"{key}:latest"}
+                            for key in mock._resident()
+                        ]
+                    }
+                )
+            elif self.path == "/api/v1/models":
+                self._send_json(
+                    {"models": [{"type": "llm", "key": key} for key in mock.models]}
+                )
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if request.get("model") not in mock.models:
+                self._send_json(
+                    {"error": f"model {request.get('model')} not found"}, 404
+                )
+                return
+
+            if self.path == "/api/generate" and not request.get("prompt"):
+                # Ollama only loads, or unloads, the model for requests without a prompt.
+                mock._load(request["model"], request.get("keep_alive"))
+                self._send_json(
+                    {"model": request["model"], "response": "", "done": True}
+                )
+                return
+
+            mock._count()
+            mock._load(request["model"], request.get("keep_alive"))
+            if self.path == "/api/generate":
+                self._ollama_generate(request)
+            elif self.path == "/v1/chat/completions":
+                self._openai_completion(request)
+            elif self.path == "/api/embed":
+                self._send_json(
+                    {
+                        "model": request["model"],
+                        "embeddings": mock._embed(request["input"]),
+                    }
+                )
+            elif self.path == "/v1/embeddings":
+                self._send_json(
+                    {
+                        "object": "list",
+                        "model": request["model"],
+                        "data": [
+                            {"object": "embedding", "index": index, "embedding": vector}
+                            for index, vector in enumerate(
+                                mock._embed(request["input"])
+                            )
+                        ],
+                    }
+                )
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def _ollama_generate(self, request: dict) -> None:
+            started = time.perf_counter_ns()
+            fragments = mock.fragments("format" in request)
+            # Stands in for the tokens of the conversation, which is continued from the given context.
+            prompt_tokens = len(request["prompt"]) // 4 + 1
+            context = request.get("context", []) + list(
+                range(prompt_tokens + len(fragments))
+            )
+            if not request.get("stream", True):
+                text = "".join(mock._paced(fragments))
+                self._send_json(
+                    {
+                        "model": request["model"],
+                        "response": text,
+                        "done": True,
+                        "context": context,
+                        "prompt_eval_count": prompt_tokens,
+                        "eval_count": len(fragments),
+                        "total_duration": time.perf_counter_ns() - started,
+                    }
+                )
+                return
+
+            self._start_chunked("application/x-ndjson")
+            for fragment in mock._paced(fragments):
+                record = {
+                    "model": request["model"],
+                    "response": fragment,
+                    "done": False,
+                }
+                self._write_chunk(json.dumps(record).encode("utf-8") + b"\n")
+            final = {
+                "model": request["model"],
+                "response": "",
+                "done": True,
+                "context": context,
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": len(fragments),
+                "total_duration": time.perf_counter_ns() - started,
+            }
+            self._write_chunk(json.dumps(final).encode("utf-8") + b"\n")
+            self._end_chunked()
+
+        def _openai_completion(self, request: dict) -> None:
+            fragments = mock.fragments("response_format" in request)
+            usage = {
+                "prompt_tokens": 0,
+                "completion_tokens": len(fragments),
+                "total_tokens": len(fragments),
+            }
+            if not request.get("stream"):
+                text = "".join(mock._paced(fragments))
+                self._send_json(
+                    {
+                        "model": request["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": text},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": usage,
+                    }
+                )
+                return
+
+            self._start_chunked("text/event-stream")
+            for fragment in mock._paced(fragments):
+                chunk = {
+                    "model": request["model"],
+                    "choices": [{"index": 0, "delta": {"content": fragment}}],
+                }
+                self._write_chunk(
+                    b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+                )
+            final = {
+                "model": request["model"],
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            self._write_chunk(b"data: " + json.dumps(final).encode("utf-8") + b"\n\n")
+            if (request.get("stream_options") or {}).get("include_usage"):
+                chunk = {"model": request["model"], "choices": [], "usage": usage}
+                self._write_chunk(
+                    b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+                )
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._end_chunked()
+
+    return Handler
@@ -0,0 +1,421 @@
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterator, Optional
+
+from .instrumentation import current_trace
+from .stream import current_stream
+
+# The HTTP clients, and asyncio, are only imported once a request is made. They account for most of
+# the time taken by `import exfer`.
+if TYPE_CHECKING:
+    import asyncio
+
+    import httpx
+    import requests
+
+
+class TransportException(Exception):
+    pass
+
+
+class Transport:
+    """Pooled HTTP transport used by a `Provider` to talk to its API. Connections are kept-alive and
+    reused between requests so that repeated calls to the same host do not pay TCP setup each time.
+
+    Synchronous requests go through a `requests.Session`, while the `a` prefixed methods use a
+    non-blocking `httpx.AsyncClient` with the same pool size, timeouts and retries. Both are lazily
+    created on first use.
+    """
+
+    pool_size: int
+    """Maximum number of kept-alive connections held per host."""
+
+    connect_timeout: float
+    """Seconds to wait for a connection to be established."""
+
+    read_timeout: float
+    """Seconds to wait between bytes received from the server. Generation can be slow to start, so this should be generous."""
+
+    retries: int
+    """Number of times a failed connection, or a 502/503/504 response, is retried before giving up."""
+
+    backoff_factor: float
+    """Factor applied between retry attempts. See `urllib3.util.retry.Retry` for details."""
+
+    headers: dict[str, str]
+    """Additional headers sent with every request."""
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        connect_timeout: float = 2.0,
+        read_timeout: float = 300.0,
+        retries: int = 2,
+        backoff_factor: float = 0.1,
+        headers: Optional[dict[str, str]] = None,
+    ):
+        """Constructs a new transport. No connections are made until the first request.
+
+        Args:
+            pool_size (int, optional): Maximum kept-alive connections per host. Defaults to 10.
+            connect_timeout (float, optional): Seconds to wait for a connection. Defaults to 2.0.
+            read_timeout (float, optional): Seconds to wait between received bytes. Defaults to 300.0.
+            retries (int, optional): Retry attempts for failed connections and gateway errors. Defaults to 2.
+            backoff_factor (float, optional): Backoff factor between retries. Defaults to 0.1.
+            headers (Optional[dict[str, str]], optional): Headers to send with every request. Defaults to None.
+        """
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.headers = headers or {}
+        self._session: Optional["requests.Session"] = None
+        self._async_client: Optional["httpx.AsyncClient"] = None
+        self._async_loop: Optional["asyncio.AbstractEventLoop"] = None
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        """The `(connect, read)` timeout pair passed with each request."""
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def session(self) -> "requests.Session":
+        """The pooled session backing this transport. Created on first access."""
+        if self._session is None:
+            self._session = self._make_session()
+        return self._session
+
+    def _make_session(self) -> "requests.Session":
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # Generation requests are POSTs, which urllib3 will not retry by default. Connection failures
+        # happen before anything reaches the server so they are always safe to retry, and the gateway
+        # statuses are what Ollama and proxies return when they are momentarily overloaded. Read errors
+        # are never retried since the server may already be generating.
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None,
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def request(self, method: str, url: str, **kwargs: Any) -> "requests.Response":
+        """Issues a request over the pooled session and checks the response status.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Complete URL to request.
+            **kwargs: Additional keyword arguments passed to `requests.Session.request`.
+
+        Raises:
+            TransportException: If the request could not be completed, or the server responded with an error status.
+
+        Returns:
+            requests.Response: The response.
+        """
+        import requests
+
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            raise TransportException(f"{method} {url} failed: {e}") from e
+        trace = current_trace.get()
+        if trace is not None:
+            body = response.request.body
+            trace.bytes_out += len(body) if body else 0
+            trace.add("connect", response.elapsed.total_seconds())
+            if not kwargs.get("stream"):
+                trace.bytes_in += len(response.content)
+        if response.status_code >= 400:
+            # Drain the body so the connection goes back to the pool.
+            body = response.text
+            response.close()
+            raise TransportException(
+                f"{method} {url} responded with {response.status_code}: {body}"
+            )
+        return response
+
+    def get_json(self, url: str, **kwargs: Any) -> Any:
+        """Performs a GET request and decodes the JSON response body."""
+        return self.request("GET", url, **kwargs).json()
+
+    def post_json(self, url: str, payload: Any, **kwargs: Any) -> Any:
+        """Performs a POST request with a JSON body and decodes the JSON response body."""
+        return self.request("POST", url, json=payload, **kwargs).json()
+
+    @contextmanager
+    def stream(
+        self, method: str, url: str, **kwargs: Any
+    ) -> Iterator["requests.Response"]:
+        """Issues a streaming request, yielding the response for the body to be iterated. The connection is
+        released back to the pool once the context exits. When made for a `TextStream`, cancelling the stream
+        aborts the connection, and its deadline bounds the wait for each chunk.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Complete URL to request.
+            **kwargs: Additional keyword arguments passed to `requests.Session.request`.
+
+        Raises:
+            TransportException: If the request could not be completed, or the server responded with an error status.
+
+        Yields:
+            requests.Response: The streaming response.
+        """
+        stream = current_stream.get()
+        if stream is not None and stream.remaining is not None:
+            kwargs["timeout"] = (
+                self.connect_timeout,
+                _clamp(stream.remaining, self.read_timeout),
+            )
+        # Not kept in this frame, as the stream holds it through its source.
+        del stream
+        response = self.request(method, url, stream=True, **kwargs)
+        trace = current_trace.get()
+        if trace is not None:
+            # urllib3 doesn't count the bytes of chunked bodies, so they are counted as they are iterated.
+            response.iter_content = _counted(response.iter_content, trace)
+        abort = self._attach(response)
+        try:
+            yield response
+        finally:
+            # The connection goes back to the pool, so cancelling the stream afterwards mustn't touch it.
+            abort.sock = None
+            response.close()
+
+    def _attach(self, response: "requests.Response") -> "_Abort":
+        """Attaches a streamed response to the current stream, so that cancelling the stream aborts its connection, and the stream's deadline bounds its reads."""
+        abort = _Abort(getattr(response.raw.connection, "sock", None))
+        stream = current_stream.get()
+        if stream is None or abort.sock is None:
+            return abort
+        stream.on_cancel(abort)
+        if stream.remaining is not None:
+            response.iter_content = _deadlined(
+                response.iter_content,
+                weakref.ref(stream),
+                abort.sock,
+                self.read_timeout,
+            )
+        return abort
+
+    def close(self) -> None:
+        """Closes all pooled connections. The transport can still be used afterwards, and will reconnect."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    @property
+    def async_client(self) -> "httpx.AsyncClient":
+        """The pooled asynchronous client backing this transport. Created on first access.
+
+        Pooled connections belong to the event loop they were opened on, so a new client is created
+        whenever the transport is used from a different event loop than before.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = self._make_async_client()
+            self._async_loop = loop
+        return self._async_client
+
+    def _make_async_client(self) -> "httpx.AsyncClient":
+        import httpx
+
+        # httpx only retries connection failures, which matches the synchronous session's behaviour
+        # for everything but the gateway statuses.
+        return httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=self.pool_size,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=self.retries),
+            event_hooks={"request": [_trace_request], "response": [_trace_response]},
+        )
+
+    async def _acheck(self, method: str, url: str, response: "httpx.Response") -> None:
+        if response.status_code >= 400:
+            body = (await response.aread()).decode("utf-8", "replace")
+            await response.aclose()
+            raise TransportException(
+                f"{method} {url} responded with {response.status_code}: {body}"
+            )
+
+    async def arequest(self, method: str, url: str, **kwargs: Any) -> "httpx.Response":
+        """Asynchronously issues a request over the pooled client and checks the response status.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Complete URL to request.
+            **kwargs: Additional keyword arguments passed to `httpx.AsyncClient.request`.
+
+        Raises:
+            TransportException: If the request could not be completed, or the server responded with an error status.
+
+        Returns:
+            httpx.Response: The response.
+        """
+        import httpx
+
+        try:
+            response = await self.async_client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise TransportException(f"{method} {url} failed: {e}") from e
+        trace = current_trace.get()
+        if trace is not None:
+            trace.bytes_in += response.num_bytes_downloaded
+        await self._acheck(method, url, response)
+        return response
+
+    async def aget_json(self, url: str, **kwargs: Any) -> Any:
+        """Asynchronously performs a GET request and decodes the JSON response body."""
+        return (await self.arequest("GET", url, **kwargs)).json()
+
+    async def apost_json(self, url: str, payload: Any, **kwargs: Any) -> Any:
+        """Asynchronously performs a POST request with a JSON body and decodes the JSON response body."""
+        return (await self.arequest("POST", url, json=payload, **kwargs)).json()
+
+    @asynccontextmanager
+    async def astream(
+        self, method: str, url: str, **kwargs: Any
+    ) -> AsyncIterator["httpx.Response"]:
+        """Asynchronously issues a streaming request, yielding the response for the body to be iterated.
+        The connection is released back to the pool once the context exits.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Complete URL to request.
+            **kwargs: Additional keyword arguments passed to `httpx.AsyncClient.stream`.
+
+        Raises:
+            TransportException: If the request could not be completed, or the server responded with an error status.
+
+        Yields:
+            httpx.Response: The streaming response.
+        """
+        import httpx
+
+        request = self.async_client.build_request(method, url, **kwargs)
+        try:
+            response = await self.async_client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise TransportException(f"{method} {url} failed: {e}") from e
+        abort = _aattach(response)
+        try:
+            await self._acheck(method, url, response)
+            yield response
+        finally:
+            abort.sock = None
+            trace = current_trace.get()
+            if trace is not None:
+                trace.bytes_in += response.num_bytes_downloaded
+            await response.aclose()
+
+    async def aclose(self) -> None:
+        """Closes all pooled connections, including the synchronous session."""
+        import asyncio
+
+        self.close()
+        if self._async_client is not None:
+            if self._async_loop is asyncio.get_running_loop():
+                await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
+
+
+class _Abort:
+    """Aborts the connection of a streamed response when its stream is cancelled."""
+
+    __slots__ = ("sock",)
+
+    def __init__(self, sock: Any):
+        self.sock = sock
+
+    def __call__(self) -> None:
+        sock = self.sock
+        if sock is None:
+            return
+        import socket
+
+        # Shutting the socket down wakes a read blocked on it in another thread, which closing it doesn't.
+        # The reader then closes the response as usual.
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _aattach(response: "httpx.Response") -> _Abort:
+    """Attaches an asynchronously streamed response to the current stream, so that cancelling the stream aborts its connection."""
+    abort = _Abort(None)
+    stream = current_stream.get()
+    network_stream = response.extensions.get("network_stream")
+    if stream is not None and network_stream is not None:
+        abort.sock = network_stream.get_extra_info("socket")
+        stream.on_cancel(abort)
+    return abort
+
+
+def _clamp(remaining: float, read_timeout: float) -> float:
+    return min(max(remaining, 0.001), read_timeout)
+
+
+def _deadlined(iter_content, stream_ref, sock, read_timeout):
+    # The stream is referenced weakly, as it holds the response through its source.
+    def iter_deadlined(*args: Any, **kwargs: Any) -> Iterator[bytes]:
+        chunks = iter_content(*args, **kwargs)
+        while True:
+            # The socket's timeout bounds each read, so it is narrowed to what is left until the deadline.
+            stream = stream_ref()
+            remaining = None if stream is None else stream.remaining
+            sock.settimeout(
+                read_timeout if remaining is None else _clamp(remaining, read_timeout)
+            )
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    return iter_deadlined
+
+
+def _counted(iter_content, trace):
+    def iter_counted(*args: Any, **kwargs: Any) -> Iterator[bytes]:
+        for chunk in iter_content(*args, **kwargs):
+            trace.bytes_in += len(chunk)
+            yield chunk
+
+    return iter_counted
+
+
+async def _trace_request(request: "httpx.Request") -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.request_sent(int(request.headers.get("content-length", 0)))
+
+
+async def _trace_response(response: "httpx.Response") -> None:
+    trace = current_trace.get()
+    if trace is not None:
+        trace.response_started()
@@ -1,4 +1,13 @@
 from .requests import ping
-from .images import encode_images
+from .images import ImageInput, ImageSource, encode_images, hash_images
+from .snapshots import read_snapshot, write_snapshot
 
-__all__ = ["ping", "encode_images"]
+__all__ = [
+    "ping",
+    "ImageInput",
+    "ImageSource",
+    "encode_images",
+    "hash_images",
+    "read_snapshot",
+    "write_snapshot",
+]
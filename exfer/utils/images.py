@@ -1,17 +1,71 @@
 import base64
+import hashlib
+import mmap
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
-from typing import Sequence, Union
-from PIL import Image
-from PIL.Image import Image as ImageType
+from typing import TYPE_CHECKING, Any, Iterator, Optional, Sequence, Union
 
+# PIL is only imported once an image actually needs decoding, since most requests have no images.
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
 
-def to_image(obj: Union[str, ImageType]) -> ImageType:
+    from PIL.Image import Image as ImageType
+
+Buffer = Union[bytes, bytearray, memoryview]
+"""Raw bytes of an encoded image file."""
+
+ImageSource = Union[str, Buffer, "ImageType"]
+"""A single image, given as either a filepath, the bytes of an image file, or a `PIL.Image`."""
+
+ImageInput = Union[ImageSource, Sequence[ImageSource]]
+"""One or more images."""
+
+_SINGLE_TYPES = (str, bytes, bytearray, memoryview)
+
+_PASSTHROUGH_FORMATS = {"PNG": "png", "JPEG": "jpeg", "WEBP": "webp"}
+
+
+def _is_image(obj: Any) -> bool:
+    """Checks if the object is a `PIL.Image`, without importing PIL. No image can exist before PIL is imported."""
+    module = sys.modules.get("PIL.Image")
+    return module is not None and isinstance(obj, module.Image)
+
+
+def _is_single(obj: Any) -> bool:
+    """Checks if the object is a single `ImageSource` rather than a sequence of them."""
+    return isinstance(obj, _SINGLE_TYPES) or _is_image(obj)
+
+
+def sniff_format(data: Buffer) -> Optional[str]:
+    """Identifies the format of an encoded image file from its leading bytes, without decoding it.
+
+    Args:
+        data (Buffer): Bytes of the image file.
+
+    Returns:
+        Optional[str]: The PIL format name (`PNG`, `JPEG` or `WEBP`), or None if it is not one of those.
+    """
+    head = bytes(data[:12])
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def to_image(obj: ImageSource) -> "ImageType":
     """Ensures the given argument is returned as a `PIL.Image`. If a string is provided,
-    it is treated as a filepath and the image will be loaded. Otherwise the object is
-    returned as it is.
+    it is treated as a filepath and the image will be loaded. If bytes are provided, they
+    are treated as the contents of an image file. Otherwise the object is returned as it is.
 
     Args:
-        obj (Union[str, ImageType]): Either a filepath to an image, or the image itself.
+        obj (ImageSource): Either a filepath to an image, the bytes of an image file, or the image itself.
 
     Raises:
         TypeError: If an invalid type was provided as an argument.
@@ -19,25 +73,35 @@ def to_image(obj: Union[str, ImageType]) -> ImageType:
     Returns:
         ImageType: Image data.
     """
+    from PIL import Image
+
     if isinstance(obj, str):
         return Image.open(obj)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(obj))
     elif isinstance(obj, Image.Image):
         return obj
     else:
         raise TypeError(f"Unsupported type: {type(obj)}")
 
 
-def encode_image(img: ImageType, as_data: bool = False) -> str:
+def encode_image(
+    img: "ImageType", as_data: bool = False, max_size: Optional[int] = None
+) -> str:
     """Encodes the given image as a Base64 encoded string. Optionally includes the
     data URI formatting.
 
     Args:
         img (ImageType): Image to encode.
         as_data (bool, optional): Whether to format as a data URI. Defaults to False.
+        max_size (Optional[int], optional): Maximum width and height in pixels. Larger images are downscaled to fit, keeping their aspect ratio. Defaults to None.
 
     Returns:
         str: Encoded image string.
     """
+    if max_size is not None and max(img.size) > max_size:
+        img = img.copy()
+        img.thumbnail((max_size, max_size))
     buffer = BytesIO()
     img_format = "PNG"
     img.save(buffer, format=img_format)
@@ -47,20 +111,254 @@ def encode_image(img: ImageType, as_data: bool = False) -> str:
     return b64_bytes
 
 
+class EncodedImageCache:
+    """Cache of encoded images keyed by the hash of their contents, so that an image sent with many requests
+    is only encoded once. Bounded by the combined length of the encoded strings, evicting the least recently
+    used first."""
+
+    max_bytes: int
+    """Maximum combined length of the cached encoded strings."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """Constructs a new cache of encoded images.
+
+        Args:
+            max_bytes (int, optional): Maximum combined length of the cached encoded strings. Defaults to 64MiB.
+        """
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+            return encoded
+
+    def set(self, key: tuple, encoded: str) -> None:
+        if len(encoded) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = encoded
+            self._size += len(encoded)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+encoded_image_cache = EncodedImageCache()
+"""Process-wide cache used by `encode_images()`. Set `max_bytes` to 0 to disable."""
+
+_executor: Optional["Executor"] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> "Executor":
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return _executor
+
+
+@contextmanager
+def _open_buffer(obj: Union[str, Buffer]) -> Iterator[Buffer]:
+    """Provides the bytes of an image file without copying them. Files are memory-mapped."""
+    if not isinstance(obj, str):
+        yield obj
+        return
+    with open(obj, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def _encode_buffer(data: Buffer, img_format: str, as_data: bool) -> str:
+    b64_bytes = base64.b64encode(data).decode("ascii")
+    if as_data:
+        return f"data:image/{_PASSTHROUGH_FORMATS[img_format]};base64,{b64_bytes}"
+    return b64_bytes
+
+
+def _passthrough(
+    obj: ImageSource, as_data: bool, max_size: Optional[int]
+) -> Optional[str]:
+    """Encodes the original bytes of an image file as-is, if it is in a format that can be sent without
+    conversion and does not need resizing. Returns None when the image needs to be decoded instead.
+    """
+    if _is_image(obj):
+        return None
+    with _open_buffer(obj) as data:
+        img_format = sniff_format(data)
+        if img_format is None:
+            return None
+        if max_size is not None:
+            from PIL import Image
+
+            # Opening only reads the header, the pixel data is not decoded. Memory-mapped files are read in
+            # place, rather than copied into a buffer.
+            header = data if isinstance(data, mmap.mmap) else BytesIO(data)
+            with Image.open(header) as img:
+                if max(img.size) > max_size:
+                    return None
+        return _encode_buffer(data, img_format, as_data)
+
+
+def _encode(obj: ImageSource, as_data: bool, max_size: Optional[int]) -> str:
+    return encode_image(to_image(obj), as_data, max_size)
+
+
 def encode_images(
-    images: Union[str, ImageType, Sequence[Union[str, ImageType]]],
+    images: ImageInput,
     as_data: bool = False,
+    max_size: Optional[int] = None,
+    parallel: bool = True,
+    passthrough: bool = True,
 ) -> list[str]:
-    """Encodes one or more images or filepaths to images, as Base64 strings with
+    """Encodes one or more images, filepaths to images, or bytes of image files, as Base64 strings with
     optional data URI formatting.
 
+    Image files that are already PNG, JPEG or WebP are encoded from their original bytes without being
+    decoded, unless they need downscaling to fit `max_size`. Everything else is converted to PNG.
+
+    Results are cached by the contents of the image, see `encoded_image_cache`. When more than one image
+    needs converting they are converted in parallel over a pool of worker processes.
+
     Args:
-        images (Union[str, ImageType, Sequence[Union[str, ImageType]]]): Either an image, a list of images, a path to an image, or a list of paths to images.
+        images (ImageInput): Either an image, a path to an image, the bytes of an image file, or a list of these.
         as_data (bool, optional): Whether to format the results as data URIs. Defaults to False.
+        max_size (Optional[int], optional): Maximum width and height in pixels. Larger images are downscaled to fit, keeping their aspect ratio. Defaults to None.
+        parallel (bool, optional): Whether to convert multiple images in worker processes. Defaults to True.
+        passthrough (bool, optional): Whether to send image files in supported formats as-is. Defaults to True.
 
     Returns:
         list[str]: List of Base64 encoded strings.
     """
-    if isinstance(images, (str, Image.Image)):
+    if _is_single(images):
+        images = [images]
+
+    results: list[Optional[str]] = []
+    misses: list[int] = []
+    keys: list[tuple] = []
+    for index, img in enumerate(images):
+        key = (hash_image(img), as_data, max_size, passthrough)
+        keys.append(key)
+        encoded = encoded_image_cache.get(key)
+        results.append(encoded)
+        if encoded is None:
+            misses.append(index)
+
+    conversions: list[int] = []
+    for index in misses:
+        encoded = (
+            _passthrough(images[index], as_data, max_size) if passthrough else None
+        )
+        if encoded is None:
+            conversions.append(index)
+        results[index] = encoded
+
+    if parallel and len(conversions) > 1 and (os.cpu_count() or 1) > 1:
+        futures = [
+            _get_executor().submit(
+                _encode,
+                # Memory views can't be sent to another process.
+                (
+                    bytes(images[index])
+                    if isinstance(images[index], memoryview)
+                    else images[index]
+                ),
+                as_data,
+                max_size,
+            )
+            for index in conversions
+        ]
+        for index, future in zip(conversions, futures):
+            results[index] = future.result()
+    else:
+        for index in conversions:
+            results[index] = _encode(images[index], as_data, max_size)
+
+    for index in misses:
+        encoded_image_cache.set(keys[index], results[index])
+    return results
+
+
+_file_hashes: OrderedDict[tuple, str] = OrderedDict()
+_file_hashes_lock = threading.Lock()
+
+
+def _hash_file(path: str) -> str:
+    """Hashes the contents of a file, remembering the result until the file is modified."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        cached = _file_hashes.get(key)
+        if cached is not None:
+            _file_hashes.move_to_end(key)
+            return cached
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    result = digest.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[key] = result
+        while len(_file_hashes) > 4096:
+            _file_hashes.popitem(last=False)
+    return result
+
+
+def hash_image(obj: ImageSource) -> str:
+    """Hashes the contents of an image, the file at a filepath to an image, or the bytes of an image file.
+
+    Args:
+        obj (ImageSource): Either a filepath to an image, the bytes of an image file, or the image itself.
+
+    Raises:
+        TypeError: If an invalid type was provided as an argument.
+
+    Returns:
+        str: Hex digest of the contents.
+    """
+    if isinstance(obj, str):
+        return _hash_file(obj)
+
+    digest = hashlib.sha256()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        digest.update(obj)
+    elif _is_image(obj):
+        digest.update(f"{obj.mode}:{obj.size}:".encode("utf-8"))
+        digest.update(obj.tobytes())
+    else:
+        raise TypeError(f"Unsupported type: {type(obj)}")
+    return digest.hexdigest()
+
+
+def hash_images(images: ImageInput) -> list[str]:
+    """Hashes the contents of one or more images, filepaths to images, or bytes of image files.
+
+    Args:
+        images (ImageInput): Either an image, a path to an image, the bytes of an image file, or a list of these.
+
+    Returns:
+        list[str]: Hex digests of the contents.
+    """
+    if _is_single(images):
         images = [images]
-    return [encode_image(to_image(img), as_data) for img in images]
+    return [hash_image(img) for img in images]
@@ -1,18 +1,18 @@
-import urllib.request
-
-
-def ping(url: str) -> bool:
+def ping(url: str, timeout: float = 2.0) -> bool:
     """Checks that an endpoint is responding with a valid status code.
 
     Args:
         url (str): The URL to test.
+        timeout (float, optional): Seconds to wait for a response. Defaults to 2.0.
 
     Returns:
         bool: True if the request succeeded with a 2XX or 3XX status code.
     """
+    import urllib.request
+
     try:
         req = urllib.request.Request(url, method="HEAD")
-        with urllib.request.urlopen(req, timeout=2) as response:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
             return response.status >= 200 and response.status < 400
     except Exception as e:
         return False
@@ -0,0 +1,48 @@
+import json
+import os
+import time
+from typing import Any, Optional
+
+
+def read_snapshot(path: str, ttl: Optional[float] = None) -> Optional[Any]:
+    """Reads a JSON snapshot previously written with `write_snapshot`.
+
+    Args:
+        path (str): Filepath of the snapshot.
+        ttl (Optional[float], optional): Maximum age of the snapshot in seconds. Older snapshots are ignored. Defaults to None, which never expires.
+
+    Returns:
+        Optional[Any]: The data stored in the snapshot, or None if it does not exist, is unreadable, or has expired.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            snapshot = json.load(file)
+        created = float(snapshot["created"])
+        data = snapshot["data"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if ttl is not None and time.time() - created > ttl:
+        return None
+    return data
+
+
+def write_snapshot(path: str, data: Any) -> None:
+    """Writes the given JSON-serializable data as a timestamped snapshot. The file is replaced atomically,
+    so concurrent readers never see a partially written snapshot.
+
+    Args:
+        path (str): Filepath of the snapshot.
+        data (Any): Data to store.
+    """
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".exfer-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"created": time.time(), "data": data}, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,591 @@
+import json
+import re
+import time
+from dataclasses import dataclass
+from json.decoder import scanstring
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+)
+
+
+class NDJSONDecoder:
+    """Incremental decoder for newline delimited JSON. Raw chunks of bytes are fed in as they arrive from
+    the network, and each complete line is decoded as soon as its newline is seen. Lines split across
+    chunks are buffered until they are complete."""
+
+    def __init__(self):
+        self._buffer = b""
+
+    def feed(self, chunk: bytes) -> list[Any]:
+        """Feeds a chunk of bytes into the decoder.
+
+        Args:
+            chunk (bytes): Next chunk of the stream.
+
+        Raises:
+            ValueError: If a complete line is not valid JSON.
+
+        Returns:
+            list[Any]: Values decoded from the lines completed by this chunk. Often empty, or a single value.
+        """
+        if self._buffer:
+            chunk = self._buffer + chunk
+        lines = chunk.split(b"\n")
+        self._buffer = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def flush(self) -> list[Any]:
+        """Decodes any remaining line that was not terminated by a newline, for use once the stream has ended.
+
+        Raises:
+            ValueError: If the remaining line is not valid JSON.
+
+        Returns:
+            list[Any]: The value of the remaining line, if any.
+        """
+        buffer, self._buffer = self._buffer, b""
+        if buffer.strip():
+            return [json.loads(buffer)]
+        return []
+
+
+@dataclass
+class SSEEvent:
+    """A single dispatched Server-Sent Event."""
+
+    data: str
+    """Data of the event. Multiple `data:` lines are joined by newlines."""
+
+    event: str = "message"
+    """Type of the event."""
+
+    id: Optional[str] = None
+    """ID of the event, if given."""
+
+
+_LINE_BREAK = re.compile(rb"\r\n|\r|\n")
+"""Line terminators of Server-Sent Events, any of which may be used."""
+
+
+class SSEDecoder:
+    """Incremental decoder for a Server-Sent Events stream. Raw chunks of bytes are fed in as they arrive
+    from the network, and each event is dispatched as soon as its terminating blank line is seen. Lines
+    split across chunks are buffered until they are complete, and comment lines (such as keep-alives)
+    are discarded. Lines may end with a CRLF, a LF, or a lone CR."""
+
+    def __init__(self):
+        self._buffer = b""
+        # Whether the previous chunk ended with a CR, whose LF could start the next chunk.
+        self._skip_lf = False
+        self._data: list[str] = []
+        self._event = ""
+        self._id: Optional[str] = None
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        """Feeds a chunk of bytes into the decoder.
+
+        Args:
+            chunk (bytes): Next chunk of the stream.
+
+        Returns:
+            list[SSEEvent]: Events completed by this chunk. Often empty, or a single event.
+        """
+        if not chunk:
+            return []
+        if self._skip_lf:
+            self._skip_lf = False
+            if chunk.startswith(b"\n"):
+                chunk = chunk[1:]
+        if self._buffer:
+            chunk = self._buffer + chunk
+        if b"\r" in chunk:
+            lines = _LINE_BREAK.split(chunk)
+            # A CR ending the chunk completes its line right away, rather than waiting to see if a LF follows.
+            self._skip_lf = chunk.endswith(b"\r")
+        else:
+            lines = chunk.split(b"\n")
+        self._buffer = lines.pop()
+        events: list[SSEEvent] = []
+        for line in lines:
+            event = self._read_line(line.decode("utf-8"))
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> list[SSEEvent]:
+        """Dispatches any remaining event that was not terminated by a blank line, for use once the stream has ended.
+
+        Returns:
+            list[SSEEvent]: The remaining event, if any.
+        """
+        buffer, self._buffer = self._buffer, b""
+        if buffer:
+            self._read_line(buffer.decode("utf-8"))
+        event = self._read_line("")
+        return [event] if event is not None else []
+
+    def _read_line(self, line: str) -> Optional[SSEEvent]:
+        if not line:
+            if not self._data:
+                self._event = ""
+                return None
+            event = SSEEvent("\n".join(self._data), self._event or "message", self._id)
+            self._data = []
+            self._event = ""
+            return event
+        if line.startswith(":"):
+            return None
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            self._id = value
+        return None
+
+
+@dataclass
+class JSONEvent:
+    """A value completed within a JSON document being streamed."""
+
+    path: tuple[Union[str, int], ...]
+    """Keys and indices leading to the value from the root of the document, which is the empty path."""
+
+    value: Any
+    """The completed value. Objects and arrays include everything within them."""
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_NUMBER_CHARS = re.compile(r"[-+.eE0-9]*")
+_NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+_LITERALS = {"true": True, "false": False, "null": None}
+
+# What the decoder expects next.
+_VALUE, _FIRST_VALUE, _KEY, _FIRST_KEY, _COLON, _NEXT, _DONE = range(7)
+
+
+class _Container:
+    __slots__ = ("path", "value", "key")
+
+    def __init__(self, path: tuple[Union[str, int], ...], value: Union[dict, list]):
+        self.path = path
+        self.value = value
+        self.key: Optional[str] = None
+
+
+class IncrementalJSONDecoder:
+    """Incremental decoder for a single JSON document arriving as text fragments, such as the response of a
+    model generating structured output. Every value is emitted as soon as it is complete, so the fields of an
+    object and the elements of an array can be used while the rest of the document is still being generated.
+    Values are emitted innermost first, ending with the whole document.
+
+    Strings split across fragments are collected without rescanning, so decoding takes linear time however
+    the document is fragmented. Numbers are only emitted once the character after them shows they are complete.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._string: Optional[list[str]] = None
+        self._escaped = False
+        self._stack: list[_Container] = []
+        self._expect = _VALUE
+        self._offset = 0
+
+    def feed(self, text: str) -> list[JSONEvent]:
+        """Feeds a fragment of the document into the decoder.
+
+        Args:
+            text (str): Next fragment of the document.
+
+        Raises:
+            ValueError: If the document is not valid JSON.
+
+        Returns:
+            list[JSONEvent]: Values completed by this fragment, innermost first. Often empty.
+        """
+        events: list[JSONEvent] = []
+        if self._string is not None:
+            end = self._string_end(text, 0)
+            if end == -1:
+                self._string.append(text)
+                self._offset += len(text)
+                return events
+            self._string.append(text[: end + 1])
+            string = "".join(self._string)
+            self._string = None
+            self._offset += end + 1
+            self._read_string(string, events, -len(string))
+            text = text[end + 1 :]
+        self._read(self._buffer + text, False, events)
+        return events
+
+    def flush(self) -> list[JSONEvent]:
+        """Completes the document, for use once the stream has ended.
+
+        Raises:
+            ValueError: If the document is incomplete, or not valid JSON.
+
+        Returns:
+            list[JSONEvent]: Values completed by the end of the stream, such as a trailing number.
+        """
+        if self._string is not None:
+            raise ValueError(f"unterminated string at offset {self._offset}")
+        events: list[JSONEvent] = []
+        buffer, self._buffer = self._buffer, ""
+        self._read(buffer, True, events)
+        if self._expect != _DONE:
+            raise ValueError(f"incomplete JSON document at offset {self._offset}")
+        return events
+
+    def _string_end(self, text: str, start: int) -> int:
+        """Index of the closing quote of the string being read, or -1 if it isn't in the text."""
+        if self._escaped:
+            if start >= len(text):
+                return -1
+            # The character after a backslash at the end of the previous fragment is escaped.
+            start += 1
+            self._escaped = False
+        end = _STRING_BODY.match(text, start).end()
+        if end < len(text) and text[end] == '"':
+            return end
+        # The body only stops short of the end at a backslash which is the last character.
+        self._escaped = end < len(text)
+        return -1
+
+    def _read(self, text: str, final: bool, events: list[JSONEvent]) -> None:
+        position = 0
+        length = len(text)
+        while True:
+            position = _WHITESPACE.match(text, position).end()
+            if position == length:
+                break
+            char = text[position]
+            if self._expect == _DONE:
+                raise self._error(char, position)
+            if char == '"':
+                end = self._string_end(text, position + 1)
+                if end == -1:
+                    if self._expect not in (_VALUE, _FIRST_VALUE, _KEY, _FIRST_KEY):
+                        raise self._error(char, position)
+                    self._string = [text[position:]]
+                    position = length
+                    break
+                self._read_string(text[position : end + 1], events, position)
+                position = end + 1
+            elif char in "{[":
+                if self._expect not in (_VALUE, _FIRST_VALUE):
+                    raise self._error(char, position)
+                self._stack.append(
+                    _Container(self._child_path(), {} if char == "{" else [])
+                )
+                self._expect = _FIRST_KEY if char == "{" else _FIRST_VALUE
+                position += 1
+            elif char in "}]":
+                top = self._stack[-1] if self._stack else None
+                closes = dict if char == "}" else list
+                if (
+                    top is None
+                    or not isinstance(top.value, closes)
+                    or self._expect not in (_NEXT, _FIRST_KEY, _FIRST_VALUE)
+                ):
+                    raise self._error(char, position)
+                self._stack.pop()
+                self._complete(top.value, events)
+                position += 1
+            elif char == ":":
+                if self._expect != _COLON:
+                    raise self._error(char, position)
+                self._expect = _VALUE
+                position += 1
+            elif char == ",":
+                if self._expect != _NEXT:
+                    raise self._error(char, position)
+                self._expect = (
+                    _KEY if isinstance(self._stack[-1].value, dict) else _VALUE
+                )
+                position += 1
+            elif self._expect not in (_VALUE, _FIRST_VALUE):
+                raise self._error(char, position)
+            elif char in "-0123456789":
+                end = _NUMBER_CHARS.match(text, position).end()
+                if end == length and not final:
+                    break
+                number = text[position:end]
+                match = _NUMBER.fullmatch(number)
+                if match is None:
+                    raise self._error(number, position)
+                if match.group(1) or match.group(2):
+                    self._complete(float(number), events)
+                else:
+                    self._complete(int(number), events)
+                position = end
+            else:
+                for literal, value in _LITERALS.items():
+                    if text.startswith(literal, position):
+                        self._complete(value, events)
+                        position += len(literal)
+                        break
+                else:
+                    rest = text[position:]
+                    if not final and any(
+                        literal.startswith(rest) for literal in _LITERALS
+                    ):
+                        break
+                    raise self._error(char, position)
+        self._offset += position
+        self._buffer = text[position:]
+
+    def _read_string(
+        self, string: str, events: list[JSONEvent], position: int = 0
+    ) -> None:
+        """Handles a complete string, including its quotes, as either a key or a value."""
+        if "\\" in string:
+            value = scanstring(string, 1, False)[0]
+        else:
+            value = string[1:-1]
+        if self._expect in (_KEY, _FIRST_KEY):
+            self._stack[-1].key = value
+            self._expect = _COLON
+        elif self._expect in (_VALUE, _FIRST_VALUE):
+            self._complete(value, events)
+        else:
+            raise self._error('"', position)
+
+    def _child_path(self) -> tuple[Union[str, int], ...]:
+        """Path of the value being started."""
+        if not self._stack:
+            return ()
+        parent = self._stack[-1]
+        if isinstance(parent.value, list):
+            return parent.path + (len(parent.value),)
+        return parent.path + (parent.key,)
+
+    def _complete(self, value: Any, events: list[JSONEvent]) -> None:
+        """Emits a completed value, and adds it to its parent."""
+        events.append(JSONEvent(self._child_path(), value))
+        if not self._stack:
+            self._expect = _DONE
+            return
+        parent = self._stack[-1]
+        if isinstance(parent.value, list):
+            parent.value.append(value)
+        else:
+            parent.value[parent.key] = value
+        self._expect = _NEXT
+
+    def _error(self, found: str, position: int) -> ValueError:
+        return ValueError(
+            f"unexpected {found[:16]!r} at offset {self._offset + position} of JSON document"
+        )
+
+
+def decode_json(fragments: Iterable[str]) -> Iterator[JSONEvent]:
+    """Decodes a JSON document from a stream of fragments, emitting each value as soon as it is complete.
+    See `IncrementalJSONDecoder`.
+
+    Args:
+        fragments (Iterable[str]): Stream of fragments of the document.
+
+    Raises:
+        ValueError: If the document is incomplete, or not valid JSON.
+
+    Yields:
+        JSONEvent: Each completed value, ending with the whole document.
+    """
+    decoder = IncrementalJSONDecoder()
+    for fragment in fragments:
+        yield from decoder.feed(fragment)
+    yield from decoder.flush()
+
+
+async def adecode_json(fragments: AsyncIterable[str]) -> AsyncIterator[JSONEvent]:
+    """Decodes a JSON document from an async stream of fragments. Mirrors `decode_json()`.
+
+    Args:
+        fragments (AsyncIterable[str]): Stream of fragments of the document.
+
+    Raises:
+        ValueError: If the document is incomplete, or not valid JSON.
+
+    Yields:
+        JSONEvent: Each completed value, ending with the whole document.
+    """
+    decoder = IncrementalJSONDecoder()
+    async for fragment in fragments:
+        for event in decoder.feed(fragment):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+def coalesce(
+    fragments: Iterable[str], min_chars: int = 0, max_delay: Optional[float] = None
+) -> Iterator[str]:
+    """Joins consecutive fragments of a stream together, so that consumers that don't need every token
+    individually can handle fewer, larger fragments.
+
+    A fragment is emitted once at least `min_chars` characters have been collected, or when `max_delay`
+    seconds have passed since the first collected fragment arrived. The delay is checked as each fragment
+    arrives, so a stalled stream does not emit early. Anything remaining is emitted once the stream ends.
+
+    Args:
+        fragments (Iterable[str]): Stream of fragments.
+        min_chars (int, optional): Minimum characters per emitted fragment. Defaults to 0.
+        max_delay (Optional[float], optional): Maximum seconds to hold collected fragments for. Defaults to None.
+
+    Yields:
+        str: Coalesced fragments.
+    """
+    parts: list[str] = []
+    size = 0
+    started = 0.0
+    for fragment in fragments:
+        if not parts:
+            started = time.monotonic()
+        parts.append(fragment)
+        size += len(fragment)
+        if size >= min_chars or (
+            max_delay is not None and time.monotonic() - started >= max_delay
+        ):
+            yield "".join(parts)
+            parts.clear()
+            size = 0
+    if parts:
+        yield "".join(parts)
+
+
+async def acoalesce(
+    fragments: AsyncIterable[str],
+    min_chars: int = 0,
+    max_delay: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """Joins consecutive fragments of an async stream together. Mirrors `coalesce()`.
+
+    Args:
+        fragments (AsyncIterable[str]): Stream of fragments.
+        min_chars (int, optional): Minimum characters per emitted fragment. Defaults to 0.
+        max_delay (Optional[float], optional): Maximum seconds to hold collected fragments for. Defaults to None.
+
+    Yields:
+        str: Coalesced fragments.
+    """
+    parts: list[str] = []
+    size = 0
+    started = 0.0
+    async for fragment in fragments:
+        if not parts:
+            started = time.monotonic()
+        parts.append(fragment)
+        size += len(fragment)
+        if size >= min_chars or (
+            max_delay is not None and time.monotonic() - started >= max_delay
+        ):
+            yield "".join(parts)
+            parts.clear()
+            size = 0
+    if parts:
+        yield "".join(parts)
+
+
+def _find_stop(text: str, sequences: Sequence[str]) -> int:
+    """Index of the earliest stop sequence in the text, or -1 if there is none."""
+    found = -1
+    for sequence in sequences:
+        index = text.find(sequence)
+        if index != -1 and (found == -1 or index < found):
+            found = index
+    return found
+
+
+def _partial_stop(text: str, sequences: Sequence[str], longest: int) -> int:
+    """Length of the longest end of the text which could be the start of a stop sequence."""
+    for length in range(min(len(text), longest - 1), 0, -1):
+        tail = text[-length:]
+        if any(sequence.startswith(tail) for sequence in sequences):
+            return length
+    return 0
+
+
+def stop_at(fragments: Iterable[str], sequences: Sequence[str]) -> Iterator[str]:
+    """Ends a stream at the first occurrence of any of the stop sequences, which is not emitted. Text that could
+    be the start of a stop sequence is held back until the following fragments show whether it is. Once a stop
+    sequence is found the stream is closed, if it can be, so the backend stops generating.
+
+    Args:
+        fragments (Iterable[str]): Stream of fragments.
+        sequences (Sequence[str]): Stop sequences.
+
+    Yields:
+        str: Fragments up to the first stop sequence.
+    """
+    sequences = [sequence for sequence in sequences if sequence]
+    if not sequences:
+        yield from fragments
+        return
+    longest = max(len(sequence) for sequence in sequences)
+    held = ""
+    for fragment in fragments:
+        held += fragment
+        index = _find_stop(held, sequences)
+        if index != -1:
+            if index:
+                yield held[:index]
+            close = getattr(fragments, "close", None)
+            if close is not None:
+                close()
+            return
+        keep = _partial_stop(held, sequences, longest)
+        if keep < len(held):
+            yield held[: len(held) - keep]
+            held = held[len(held) - keep :]
+    if held:
+        yield held
+
+
+async def astop_at(
+    fragments: AsyncIterable[str], sequences: Sequence[str]
+) -> AsyncIterator[str]:
+    """Ends an async stream at the first occurrence of any of the stop sequences. Mirrors `stop_at()`.
+
+    Args:
+        fragments (AsyncIterable[str]): Stream of fragments.
+        sequences (Sequence[str]): Stop sequences.
+
+    Yields:
+        str: Fragments up to the first stop sequence.
+    """
+    sequences = [sequence for sequence in sequences if sequence]
+    if not sequences:
+        async for fragment in fragments:
+            yield fragment
+        return
+    longest = max(len(sequence) for sequence in sequences)
+    held = ""
+    async for fragment in fragments:
+        held += fragment
+        index = _find_stop(held, sequences)
+        if index != -1:
+            if index:
+                yield held[:index]
+            aclose = getattr(fragments, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            return
+        keep = _partial_stop(held, sequences, longest)
+        if keep < len(held):
+            yield held[: len(held) - keep]
+            held = held[len(held) - keep :]
+    if held:
+        yield held
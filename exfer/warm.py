@@ -0,0 +1,88 @@
+import math
+import threading
+import time
+from typing import Optional, Union
+
+
+class WarmSet:
+    """Policy which keeps the most requested models loaded by their providers, so that requests for them avoid
+    cold starts. Each request adds to its model's score, and scores decay exponentially with the given half-life,
+    so the set follows shifts in traffic.
+
+    `Exfer` records its requests here, and `Exfer.maintain_warm_set()` preloads the top models. Models which drop
+    out of the set are not unloaded, they expire once their provider's keep alive runs out.
+
+    Example:
+        exference.warm_set = WarmSet(size=2, keep_alive="30m")
+        exference.start_refresh(60.0)  # Also maintains the warm set.
+    """
+
+    size: int
+    """Number of models kept loaded."""
+
+    keep_alive: Optional[Union[str, float]]
+    """How long the preloaded models stay loaded for, see `Provider.preload()`. Should outlast the interval the set is maintained at."""
+
+    half_life: float
+    """Seconds for a model's score to halve without requests."""
+
+    min_score: float
+    """Score a model needs before it is kept loaded, so that a single request doesn't claim a place."""
+
+    def __init__(
+        self,
+        size: int = 1,
+        keep_alive: Optional[Union[str, float]] = "30m",
+        half_life: float = 600.0,
+        min_score: float = 2.0,
+    ):
+        """Constructs a new warm set policy.
+
+        Args:
+            size (int, optional): Number of models kept loaded. Defaults to 1.
+            keep_alive (Optional[Union[str, float]], optional): How long the preloaded models stay loaded for. Defaults to "30m".
+            half_life (float, optional): Seconds for a model's score to halve without requests. Defaults to 600.0.
+            min_score (float, optional): Score a model needs before it is kept loaded. Defaults to 2.0.
+        """
+        self.size = size
+        self.keep_alive = keep_alive
+        self.half_life = half_life
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self._scores: dict[str, tuple[float, float]] = {}
+
+    def _decayed(self, score: float, updated: float, now: float) -> float:
+        return score * math.pow(0.5, (now - updated) / self.half_life)
+
+    def record(self, model_key: str, weight: float = 1.0) -> None:
+        """Records a request for a model.
+
+        Args:
+            model_key (str): Key of the requested model.
+            weight (float, optional): Amount added to the model's score. Defaults to 1.0.
+        """
+        now = time.monotonic()
+        with self._lock:
+            current = self._scores.get(model_key)
+            score = weight
+            if current is not None:
+                score += self._decayed(current[0], current[1], now)
+            self._scores[model_key] = (score, now)
+
+    def scores(self) -> dict[str, float]:
+        """Current score of every model that has been requested, forgetting those that have decayed away."""
+        now = time.monotonic()
+        with self._lock:
+            scores = {
+                key: self._decayed(score, updated, now)
+                for key, (score, updated) in self._scores.items()
+            }
+            for key, score in scores.items():
+                if score < 0.01:
+                    del self._scores[key]
+        return {key: score for key, score in scores.items() if score >= 0.01}
+
+    def top(self) -> list[str]:
+        """Keys of the models that should be kept loaded, from the most requested."""
+        ranked = sorted(self.scores().items(), key=lambda item: item[1], reverse=True)
+        return [key for key, score in ranked[: self.size] if score >= self.min_score]